@@ -0,0 +1,205 @@
+"""
+Binary snapshot of the positions of all users, shared between the algo process and the UI.
+
+The file is a fixed-size header followed by fixed-width records (`SNAPSHOT_DTYPE`), memory mapped
+by both sides. The algo process writes the records in place; the header carries a version counter
+which is odd while a write is in progress (a seqlock), so the UI only copies the records when the
+version has changed and no write is running.
+"""
+import mmap
+import os
+import struct
+import typing
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from Libs.Utils import exception_handler, settings
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+SNAPSHOT_MAGIC = b"PSNP"
+SNAPSHOT_LAYOUT = 1  # bump when SNAPSHOT_DTYPE changes
+# magic, layout, version (seqlock), record count, capacity
+_HEADER = struct.Struct("<4sIQII")
+HEADER_SIZE = 64
+_VERSION_OFFSET = 8
+
+SNAPSHOT_DTYPE = np.dtype([
+    ('user_id', 'S32'),
+    ('tradingsymbol', 'S48'),
+    ('exchange', 'S8'),
+    ('quantity', np.int64),
+    ('multiplier', np.int8),  # 0 when not known
+    ('entry_price', np.float64),  # prices and times are NaN when not set
+    ('entry_time', np.float64),  # epoch seconds
+    ('exit_price', np.float64),
+    ('exit_time', np.float64),
+    ('target_price', np.float64),
+    ('sl_price', np.float64),
+    ('Row_Type', 'S1'),
+    ('profit', np.float64),
+    ('ltp', np.float64),
+    ('Trend', 'S4'),
+])
+_TEXT_FIELDS = ('user_id', 'tradingsymbol', 'exchange', 'Row_Type', 'Trend')
+_TIME_FIELDS = ('entry_time', 'exit_time')
+FRAME_COLUMNS = ['tradingsymbol', 'exchange', 'quantity', 'multiplier', 'entry_price', 'entry_time', 'exit_price',
+                 'exit_time', 'target_price', 'sl_price', 'Row_Type', 'profit', 'ltp', 'Trend', 'user_id']
+
+
+def _float(value) -> float:
+    if value is None:
+        return np.nan
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def to_records(positions: typing.Sequence[typing.Dict[str, typing.Any]]) -> np.ndarray:
+    """encode positions (rows of the positions ledger) as snapshot records"""
+    records = np.zeros(len(positions), dtype=SNAPSHOT_DTYPE)
+    for i, position in enumerate(positions):
+        record = records[i]
+        for field in SNAPSHOT_DTYPE.names:
+            value = position.get(field)
+            if field in _TEXT_FIELDS:
+                record[field] = str(value or "").encode("utf-8")[:SNAPSHOT_DTYPE[field].itemsize]
+            elif field in ('multiplier', 'quantity'):
+                record[field] = value or 0
+            else:
+                record[field] = _float(value)
+    return records
+
+
+def to_frame(records: np.ndarray) -> pd.DataFrame:
+    """decode snapshot records into the positions DataFrame shown in the positions table"""
+    frame = pd.DataFrame({field: records[field] for field in FRAME_COLUMNS})
+    for field in _TEXT_FIELDS:
+        frame[field] = [value.decode("utf-8", errors="replace") for value in records[field]]
+    for field in _TIME_FIELDS:
+        frame[field] = [None if np.isnan(epoch_secs) else
+                        datetime.fromtimestamp(epoch_secs).strftime(settings.DATETIME_FMT_STRING)
+                        for epoch_secs in records[field]]
+    frame['multiplier'] = frame['multiplier'].replace(0, np.nan)
+    return frame
+
+
+def _file_size(capacity: int) -> int:
+    return HEADER_SIZE + capacity * SNAPSHOT_DTYPE.itemsize
+
+
+class PositionsSnapshotWriter:
+    """writer side (algo process) of the snapshot file"""
+
+    def __init__(self, path: str, capacity: int = settings.POSITIONS_SNAPSHOT_CAPACITY):
+        self.path = path
+        size = _file_size(capacity)
+        # an existing file is reused instead of truncated, the UI may have it mapped already
+        mode = "r+b" if os.path.exists(path) else "w+b"
+        self._file = open(path, mode)
+        existing_size = os.fstat(self._file.fileno()).st_size
+        if existing_size < size:
+            self._file.truncate(size)
+        else:
+            size = existing_size
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.capacity = (size - HEADER_SIZE) // SNAPSHOT_DTYPE.itemsize
+        self.count = 0
+        _, _, version, _, _ = _HEADER.unpack_from(self._mmap, 0)
+        self.version = version + (version % 2) + 2  # a new version (empty) over the last one a reader may have seen
+        self._write_header()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mmap, 0, SNAPSHOT_MAGIC, SNAPSHOT_LAYOUT, self.version, self.count, self.capacity)
+
+    def _set_version(self, version: int):
+        self.version = version
+        struct.pack_into("<Q", self._mmap, _VERSION_OFFSET, version)
+
+    def _grow(self, capacity: int) -> bool:
+        try:
+            self._mmap.resize(_file_size(capacity))
+        except (OSError, SystemError, ValueError):  # e.g. the file is mapped by the UI on windows
+            logger.error(f"Could not grow the positions snapshot to {capacity} records", exc_info=True)
+            return False
+        self.capacity = capacity
+        return True
+
+    def write(self, records: np.ndarray, keep: int = 0) -> int:
+        """
+        publish the positions
+
+        :param records: records (`SNAPSHOT_DTYPE`) to write after the kept ones
+        :param keep: number of records at the start of the file left as they are (already written)
+        :return: number of `records` written, less than all of them when the file is full and cannot grow
+        """
+        keep = min(keep, self.capacity)
+        count = keep + len(records)
+        if count > self.capacity and not self._grow(max(count, 2 * self.capacity)):
+            records = records[:self.capacity - keep]
+            count = keep + len(records)
+        self._set_version(self.version + 1)  # odd: write in progress
+        start = HEADER_SIZE + keep * SNAPSHOT_DTYPE.itemsize
+        self._mmap[start:start + records.nbytes] = records.tobytes()
+        self.count = count
+        self._write_header()
+        self._set_version(self.version + 1)
+        return len(records)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class PositionsSnapshotReader:
+    """reader side (UI) of the snapshot file, maps the file read-only"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.version = None  # version of the last read
+        self._file = None
+        self._mmap = None
+
+    def _open(self) -> bool:
+        if self._mmap is not None:
+            if len(self._mmap) >= os.fstat(self._file.fileno()).st_size:
+                return True
+            self.close()  # the writer grew the file, map it again
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER_SIZE:
+            return False
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return True
+
+    def current_version(self) -> typing.Optional[int]:
+        if not self._open():
+            return None
+        magic, layout, version, _, _ = _HEADER.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC or layout != SNAPSHOT_LAYOUT:
+            return None
+        return version
+
+    def read_if_changed(self) -> typing.Optional[np.ndarray]:
+        """
+        :return: copy of the records, None if the version did not change since the last read (or a write is running)
+        """
+        version = self.current_version()
+        if version is None or version % 2 or version == self.version:
+            return None
+        _, _, _, count, _ = _HEADER.unpack_from(self._mmap, 0)
+        if HEADER_SIZE + count * SNAPSHOT_DTYPE.itemsize > len(self._mmap):
+            self.close()  # grown since mapped, read on the next check
+            return None
+        records = np.frombuffer(self._mmap, dtype=SNAPSHOT_DTYPE, count=count, offset=HEADER_SIZE).copy()
+        if _HEADER.unpack_from(self._mmap, 0)[2] != version:  # written meanwhile
+            return None
+        self.version = version
+        return records
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+        self._mmap = self._file = None
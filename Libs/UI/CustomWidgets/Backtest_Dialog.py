@@ -0,0 +1,24 @@
+import pandas as pd
+from PyQt5 import QtWidgets
+
+from Libs.Storage import app_data
+from Libs.UI.Models_n_Delegates.Model__Backtest import BT_CSV_View
+
+
+class BacktestDialog(QtWidgets.QDialog):
+    """trades of a backtest of the strategy table, in the columns of the positions table"""
+
+    def __init__(self, trades: pd.DataFrame, message: str, parent=None):
+        super(BacktestDialog, self).__init__(parent)
+        self.setWindowTitle("Backtest Results")
+        self.resize(1000, 500)
+
+        self.layout = QtWidgets.QVBoxLayout(self)
+        self.label_info = QtWidgets.QLabel(message, self)
+        self.layout.addWidget(self.label_info)
+        self.table_view = QtWidgets.QTableView(self)
+        self._model = BT_CSV_View(header_labels=app_data.POSITIONS_COLUMNS)
+        self._model.populate(trades[app_data.POSITIONS_COLUMNS])
+        self.table_view.setModel(self._model)
+        self.table_view.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Stretch)
+        self.layout.addWidget(self.table_view)
@@ -0,0 +1,43 @@
+import typing
+
+import pandas as pd
+from PyQt5 import QtWidgets, QtCore
+
+from Libs.UI.Models_n_Delegates.Model__Backtest import BT_CSV_View
+from Libs.Utils import settings
+from Libs.tradexcb_algo.latency import LATENCY_COLUMNS
+
+
+class LatencyDialog(QtWidgets.QDialog):
+    """live view of the tick-to-order latency percentiles, refreshed while the dialog is open"""
+
+    def __init__(self, fetch_summary: typing.Callable[[], typing.Optional[pd.DataFrame]], parent=None):
+        super(LatencyDialog, self).__init__(parent)
+        self.fetch_summary = fetch_summary
+        self.setWindowTitle("Order Latency")
+        self.resize(800, 400)
+
+        self.layout = QtWidgets.QVBoxLayout(self)
+        self.label_info = QtWidgets.QLabel("Latencies in milliseconds, since the trading was started", self)
+        self.layout.addWidget(self.label_info)
+        self.table_view = QtWidgets.QTableView(self)
+        self._model = BT_CSV_View(header_labels=LATENCY_COLUMNS)
+        self.table_view.setModel(self._model)
+        self.table_view.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Stretch)
+        self.layout.addWidget(self.table_view)
+
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.timeout.connect(self.refresh)
+        self._refresh_timer.start(settings.LATENCY_VIEW_INTERVAL)
+        self.refresh()
+
+    def refresh(self):
+        summary_df = self.fetch_summary()
+        if summary_df is None:
+            self._model.clear()
+        else:
+            self._model.populate(summary_df[LATENCY_COLUMNS])
+
+    def closeEvent(self, e) -> None:
+        self._refresh_timer.stop()
+        super(LatencyDialog, self).closeEvent(e)
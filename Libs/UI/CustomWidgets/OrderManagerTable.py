@@ -35,6 +35,9 @@ class OMSTable(QtWidgets.QTableView):
     def update_data(self, data: typing.Dict[str, typing.List[typing.Any]]):
         self.__model.populate(data_dict=data)
 
+    def apply_delta(self, delta: typing.Dict[str, typing.Any]):
+        self.__model.apply_delta(delta)
+
     def set_cancel_order_queue(self, queue: multiprocessing.Queue):
         self.__button_delegate.set_cancel_orders_queue(queue)
 
@@ -33,8 +33,8 @@ class PositionsView(QtWidgets.QTableView):
         self.setSelectionBehavior(self.SelectRows)
         self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
 
-        self.watch_loc = settings.DATA_FILES.get("POSITIONS_FILE_PATH")  # check for filenames positions log
-        self.handler = FS__EventHandLer.Position_CSVModifyHandler(self.watch_loc)
+        self.watch_loc = settings.DATA_FILES.get("POSITIONS_SNAPSHOT_PATH")  # positions published by the algo
+        self.handler = FS__EventHandLer.Position_SnapshotHandler(self.watch_loc)
         self.handler.file_changed.connect(self.reset_model_data)
         self.header_labels = app_data.POSITIONS_COLUMNS
         self._model = Model__PositionsTable.PositionsModel(self.header_labels)
@@ -97,7 +97,7 @@ class PositionsView(QtWidgets.QTableView):
         self.scrollToBottom()
 
     def start_check(self):
-        """start checking FutureLog file for modification"""
+        """start checking the positions snapshot for new versions"""
         self.handler.update_view()  # update view emits - file-changed signal to update the model
         logger.info("Positions Logging started")
 
@@ -84,6 +84,7 @@ class OMSModel(QtCore.QAbstractTableModel):
         super(OMSModel, self).__init__(parent)
         self.__data = {}
         self.__key_list = []
+        self.__row_index = {}  # instrument_df_key -> row
         self.header_labels = app_data.OMS_TABLE_COLUMNS
 
     def rowCount(self, parent=QtCore.QModelIndex()):
@@ -101,8 +102,56 @@ class OMSModel(QtCore.QAbstractTableModel):
             self.__data = deepcopy(data_dict)
             print("From UI model::", self.__data)
             self.__key_list = list(data_dict.keys())
+            self.__update_row_index()
             self.endResetModel()
 
+    def __update_row_index(self):
+        self.__row_index = {key: row for row, key in enumerate(self.__data.get("instrument_df_key", []))}
+
+    def __append_row(self, row_data: typing.Dict[str, typing.Any]):
+        for col_name in self.header_labels:
+            self.__data[col_name].append(row_data.get(col_name, 0 if col_name == "Close Position?" else None))
+        self.__row_index[row_data["instrument_df_key"]] = len(self.__data["instrument_df_key"]) - 1
+
+    def apply_delta(self, delta: typing.Dict[str, typing.Any]):
+        """
+        apply an orderbook message of the algo process (see `tradexcb_algo.orderbook_delta`):
+        rows are patched, inserted or removed in place, only a full orderbook resets the model
+        """
+        if delta['reset']:
+            self.beginResetModel()
+            self.__data = {col_name: [] for col_name in self.header_labels}
+            self.__key_list = list(self.header_labels)
+            self.__row_index = {}
+            for row_data in delta['rows'].values():
+                self.__append_row(row_data)
+            self.endResetModel()
+            return
+
+        for key in delta['removed']:
+            row = self.__row_index.get(key)
+            if row is None:
+                continue
+            self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+            for col_name in self.__key_list:
+                del self.__data[col_name][row]
+            self.__update_row_index()
+            self.endRemoveRows()
+
+        last_col = self.columnCount() - 1
+        for key, row_data in delta['rows'].items():
+            row = self.__row_index.get(key)
+            if row is None:
+                new_row = self.rowCount()
+                self.beginInsertRows(QtCore.QModelIndex(), new_row, new_row)
+                self.__append_row(row_data)
+                self.endInsertRows()
+            else:
+                for col_name, value in row_data.items():
+                    if col_name in self.__data and col_name != "Close Position?":  # the close flag is set by the UI
+                        self.__data[col_name][row] = value
+                self.dataChanged.emit(self.index(row, 0), self.index(row, last_col))
+
     def data(self, index, role=Qt.DisplayRole):
         col_name = self.header_labels[index.column()]
         if role == Qt.DisplayRole:
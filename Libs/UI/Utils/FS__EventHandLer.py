@@ -1,9 +1,12 @@
 import os.path
 import re
 
+import numpy as np
 import pandas as pd
 from PyQt5 import QtCore
 
+from Libs.Files import positions_snapshot
+from Libs.tradexcb_algo import sharding
 from Libs.globals import *
 
 logger = exception_handler.getFutureLogger(__name__)
@@ -135,3 +138,45 @@ class Position_CSVModifyHandler(QtCore.QObject):
                 pass
         except (FileNotFoundError, FileExistsError):
             pass
+
+
+class Position_SnapshotHandler(QtCore.QObject):
+    """
+    emits the positions DataFrame whenever the algo process publishes a new version of the positions snapshot.
+    Checking for a new version only reads the header of the (memory mapped) snapshot file.
+    With a sharded algo every shard has its own snapshot file, their positions are shown together.
+    """
+    file_changed = QtCore.pyqtSignal(tuple)
+
+    def __init__(self, watch_loc, shard_count: int = settings.STRATEGY_SHARDS):
+        super(Position_SnapshotHandler, self).__init__()
+        self.watch_loc = watch_loc
+        self._readers = [positions_snapshot.PositionsSnapshotReader(sharding.shard_path(self.watch_loc, shard_index))
+                         for shard_index in range(max(int(shard_count), 1))]
+        self._records = [positions_snapshot.to_records([]) for _ in self._readers]  # last read records of each
+        self._check_timer = QtCore.QTimer()
+        self._check_timer.timeout.connect(self.update_view)
+        self._check_timer.start(100)
+
+    def deleteLater(self) -> None:
+        self._check_timer.stop()
+        for reader in self._readers:
+            reader.close()
+        super(Position_SnapshotHandler, self).deleteLater()
+
+    def get_headers(self) -> typing.List:
+        return list(positions_snapshot.FRAME_COLUMNS)
+
+    def update_view(self):
+        changed = False
+        for shard_index, reader in enumerate(self._readers):
+            try:
+                records = reader.read_if_changed()
+            except (OSError, ValueError):
+                continue
+            if records is not None:
+                self._records[shard_index] = records
+                changed = True
+        if changed:
+            records = self._records[0] if len(self._records) == 1 else np.concatenate(self._records)
+            self.file_changed.emit((positions_snapshot.to_frame(records),))
@@ -10,9 +10,6 @@ from Libs.globals import *
 
 logger = getAlgoLogger(__name__)
 
-nine_fifteen = datetime.today().replace(hour=9, minute=15, second=0, microsecond=0)  # start time
-three_35 = datetime.today().replace(hour=15, minute=35, second=0, microsecond=0)  # stop time
-
 
 def dict_hash(dictionary: typing.Dict[str, typing.Any]) -> str:
     """MD5 hash of a dictionary."""
@@ -35,9 +32,12 @@ def is_refresh_required(time_frame):
     :param time_frame: time frame in minutes
     :return: bool, str
     """
-    if (datetime.now() >= three_35 or datetime.now() < nine_fifteen) or not is_weekday():
+    now = datetime.now()
+    nine_fifteen = now.replace(hour=9, minute=15, second=0, microsecond=0)  # start time (of today)
+    three_35 = now.replace(hour=15, minute=35, second=0, microsecond=0)  # stop time
+    if (now >= three_35 or now < nine_fifteen) or not is_weekday():
         return False, "Last data updated 03.35pm, Next day update starts at 9.15am"
-    pending_wait = ((time_frame - settings.adjust_minutes) * 60) - (datetime.now() - nine_fifteen).seconds % (
+    pending_wait = ((time_frame - settings.adjust_minutes) * 60) - (now - nine_fifteen).seconds % (
             (time_frame - settings.adjust_minutes) * 60)  # pending wait in secs.
     if pending_wait <= 1:  # tolerance of 1s
         return True, str(int(pending_wait))
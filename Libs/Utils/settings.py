@@ -21,9 +21,89 @@ DATETIME_FMT_STRING = "%Y-%m-%d %H:%M:%S"
 DATA_FILES_DIR = os.path.realpath(os.path.join("Libs", "Files", "DataFiles"))
 MIN_HEIGHT = 550 if os.name == "posix" else 450
 INSTRUMENTS_EXPIRY_THRESHOLD = 60  # in days
+STRATEGY_TICK_DRIVEN = True  # evaluate rows as their instruments tick, instead of polling every row once a second
+STRATEGY_HOUSEKEEPING_INTERVAL = 1.0  # in secs. (positions file, order book export, timed checks for all rows)
+POSITIONS_SNAPSHOT_CAPACITY = 20000  # initial number of position records in the positions snapshot file
+ORDER_CACHE_TTL = 1.0  # in secs. order book of an account is downloaded at most once in this interval
+ORDER_CACHE_TTL_STREAMING = 30.0  # in secs. same, while the broker pushes the order updates
+ALGO_MONITOR_INTERVAL = 250  # in ms. interval of the UI checking the algo process for orderbook updates/errors
+EXIT_POLL_INTERVAL = 0.2  # in secs. status check interval of a cancelled SL order, before squaring off
+EXIT_CANCEL_CONFIRM_TIMEOUT = 2.0  # in secs. no square off if the SL order cancellation is not confirmed by then
+STRATEGY_SHARDS = 1  # algo processes sharing the strategy rows (each opens its own broker sessions and websockets)
+KITE_WEBSOCKETS_PER_API_KEY = 3  # kite limit, the algo does not start if its shards need more (see sharding)
+STRATEGY_SHARD_BY = "instrument"  # strategy table column the rows are partitioned by ("instrument"/"strategy_name")
+# pre-trade limits of the entry orders of every account, None for no limit (see risk_gate), split between the shards
+RISK_LIMITS = {
+    "max_order_quantity": None,
+    "max_instrument_quantity": None,
+    "max_orders_per_second": None,
+    "max_notional": None,
+    "max_loss": None
+}
+RISK_ACCOUNT_LIMITS = {}  # {account Name: {limit: value}}, overrides RISK_LIMITS for an account
+SESSION_PRE_OPEN = "09:00"  # pre-market tasks of the strategy (see tradexcb_algo.market_session)
+SESSION_START = "09:16"  # the strategy starts evaluating the rows, a minute after the market opens
+SESSION_SQUARE_OFF = None  # "HH:MM" to square off all the positions every day, None to keep them until exited
+SESSION_CLOSE = "15:30"
+SESSION_STOP_AFTER_CLOSE = True  # stop the algo at close, else it sleeps until the next session (multi-day runs)
+SESSION_STOP_CHECK_INTERVAL = 5.0  # in secs. stop requests are checked this often while the market is closed
+# trading holidays of the exchange (NSE): the dates of DATA_FILES['MARKET_HOLIDAYS_PATH'] and MARKET_HOLIDAYS, to be
+# updated from the exchange circular every year. The national holidays of the `holidays` package (not the exchange
+# calendar, NSE only closures are missing) are used only for the years without any exchange holiday listed.
+MARKET_HOLIDAYS_COUNTRY = "IN"
+MARKET_HOLIDAYS = []  # more exchange holidays, "YYYY-MM-DD"
+STRATEGY_PROFILING = False  # time the phases of the strategy loop, summary in the algo log every report interval
+STRATEGY_PROFILE_WINDOW = 1000  # cycles kept for the rolling statistics of each phase
+STRATEGY_PROFILE_REPORT_INTERVAL = 60.0  # in secs.
+STRATEGY_PLUGIN_MODULES = []  # modules registering more strategies (see tradexcb_algo.strategies)
+ORDER_FANOUT_MAX_WORKERS = 64  # threads sending the orders of all the users in parallel
+ORDER_FANOUT_DEFAULT_CONCURRENCY = 8  # max. calls in flight per account of a broker, unless listed below
+ORDER_FANOUT_BROKER_CONCURRENCY = {
+    "zerodha": 10,
+    "alice blue": 8,
+    "angel": 8
+}
+ORDER_PLACE_RETRIES = 2  # order placements sent again after a timeout/network error, if not in the order book
+ORDER_PLACE_RETRY_DELAY = 0.5  # in secs. before checking the order book for an order not acknowledged
+RATE_LIMITS = {  # (requests per sec., burst) of the REST endpoint classes of each broker, per account
+    "zerodha": {"order": (10, 10), "orderbook": (10, 10), "historical": (3, 3), "quote": (1, 1)},
+    "alice blue": {"order": (10, 10), "orderbook": (5, 5), "historical": (3, 3), "quote": (5, 5)},
+    "angel": {"order": (10, 10), "orderbook": (1, 1), "historical": (3, 3), "quote": (10, 10)}
+}
+RATE_LIMIT_DEFAULT = (5, 5)  # endpoint classes/brokers not listed above
+RATE_LIMIT_WAIT_WARNING = 1.0  # in secs. log the broker calls waiting this long for the rate limit
+RATE_LIMITER_ADDRESS = ("127.0.0.1", 50611)  # local service sharing the rate limits between the processes
+RATE_LIMITER_AUTHKEY = b"TradeXCB-rate-limiter"
+RATE_LIMITER_RETRY_INTERVAL = 5.0  # in secs. reconnect interval, while the service can not be reached
+PAPER_EXCHANGE = True  # paper trading sends its orders to a simulated exchange (see tradexcb_algo.paper_exchange)
+PAPER_LATENCY = (0.05, 0.01)  # in secs. (mean, std. deviation) time for an order to reach the simulated exchange
+PAPER_SLIPPAGE_TICKS = 1  # market orders of the simulated exchange fill this many ticks worse than the ltp
+PAPER_PARTICIPATION = 0.25  # share of the quantity traded at a resting limit order's price counted towards it
+PAPER_SEED = None  # random seed of the simulated latencies, None for a different sequence every run
+BACKTEST_DAYS = 1  # the "Backtesting" trading mode runs the strategy table over the candles of the last days
+BACKTEST_TIMEFRAME = "1"  # in minutes. interval of the historical candles of the backtest
+BACKTEST_CACHE_DIR = os.path.join(DATA_FILES_DIR, "backtest_candles")  # downloaded candles of the past days
+SWEEP_WORKERS = None  # processes of the parameter sweep, None for one per CPU
+SWEEP_GRID = {  # values of the strategy parameters tried by the parameter sweep (see tradexcb_algo.param_sweep)
+    "buy_ltp_percent": [0.0, 0.1, 0.2, 0.5],
+    "sell_ltp_percent": [0.0, 0.1, 0.2, 0.5],
+    "stoploss": [0.25, 0.5, 1.0],
+    "target": [0.5, 1.0, 2.0],
+    "wait_time": [1, 5, 15],
+}
+STATE_JOURNAL = True  # checkpoint the strategy state, restored on a restart the same day (see state_journal)
+LATENCY_VIEW_INTERVAL = 1000  # in ms. refresh interval of the latency view of the UI
 DATA_FILES = {
     "tradexcb_excel_file": os.path.join(DATA_FILES_DIR, "tradexcb_strategy.xlsx"),
     "POSITIONS_FILE_PATH": os.path.join(DATA_FILES_DIR, "PNLATRTS_All_User.csv"),
+    "POSITIONS_SNAPSHOT_PATH": os.path.join(DATA_FILES_DIR, "positions_snapshot.bin"),
+    "LATENCY_REPORT_PATH": os.path.join(DATA_FILES_DIR, "latency_report.csv"),
+    "SQUARE_OFF_REPORT_PATH": os.path.join(DATA_FILES_DIR, "square_off_report.csv"),
+    "PAPER_FILLS_PATH": os.path.join(DATA_FILES_DIR, "paper_fills.csv"),
+    "BACKTEST_RESULTS_PATH": os.path.join(DATA_FILES_DIR, "backtest_trades.csv"),
+    "SWEEP_RESULTS_PATH": os.path.join(DATA_FILES_DIR, "parameter_sweep.csv"),
+    "STATE_JOURNAL_PATH": os.path.join(DATA_FILES_DIR, "strategy_state.db"),
+    "MARKET_HOLIDAYS_PATH": os.path.join(DATA_FILES_DIR, "market_holidays.csv"),
     "INSTRUMENTS_CSV": os.path.join(DATA_FILES_DIR, "Instruments.csv"),
     "symbols_mapping_csv": os.path.join(DATA_FILES_DIR, "SYMBOL_MAPPING.csv")
 }
@@ -12,11 +12,13 @@ from Libs.Files import handle__SaveOpen, TradingSymbolMapping as SymbolMapping,
 from Libs.Storage import Cloud, manage_local
 from Libs.UI import Interact, Theme, home
 from Libs.UI.CustomWidgets import (Image_View_Label, LogTable, PositionsTable, Strategy, PNLProfit_Dialog,
-                                   TradingSymbolTable, NotificationWidget, API_Det_TableView, OrderManagerTable)
+                                   TradingSymbolTable, NotificationWidget, API_Det_TableView, OrderManagerTable,
+                                   LatencyView_Dialog, Backtest_Dialog)
 from Libs.UI.Utils import widget_handling
 from Libs.UI.custom_style_sheet import CustomStyleSheet
 from Libs.Utils import calculations, config
 from Libs.globals import *
+from Libs.tradexcb_algo import backtest
 from Libs.tradexcb_algo.AlgoManager import AlgoManager
 
 BASE_DIR = os.path.dirname(__file__)
@@ -34,6 +36,8 @@ class ApiHome(QtWidgets.QMainWindow):
         self.oms_frame_layout = None
         self.oms_view: typing.Union[None, OrderManagerTable.OMSTable] = None
         self.grouped_positions_view: typing.Union[None, 'PNLProfit_Dialog.PNLProfitDialog'] = None
+        self.latency_view: typing.Union[None, 'LatencyView_Dialog.LatencyDialog'] = None
+        self.backtest_view: typing.Union[None, 'Backtest_Dialog.BacktestDialog'] = None
         self.multi_client_view: typing.Union[None, 'API_Det_TableView.API_Det_TableView'] = None
         self._notif_timer = None
         self.notifications_downloading = False
@@ -98,6 +102,12 @@ class ApiHome(QtWidgets.QMainWindow):
         self.repair_menu = QtWidgets.QMenu("Repair")
         self.repair_menu.addAction("Clean cached files", self.repair_cached_files)
         self.ui.menubar.addAction(self.repair_menu.menuAction())
+        self.monitor_menu = QtWidgets.QMenu("Monitor")
+        self.monitor_menu.addAction("Order Latency", self.show_latency_view)
+        self.ui.menubar.addAction(self.monitor_menu.menuAction())
+        self.trade_menu = QtWidgets.QMenu("Trade")
+        self.trade_menu.addAction("Square Off All Positions", self.square_off_all)
+        self.ui.menubar.addAction(self.trade_menu.menuAction())
 
         # ------------ add available themes -------------
         self.ui.menuChoose_Theme.deleteLater()
@@ -389,10 +399,9 @@ class ApiHome(QtWidgets.QMainWindow):
         self.stop_trading()
         logger.info("Strategy algorithm Stopped successfully")
 
-    def update_orderbook_data(self, data: typing.Dict[str, typing.List[typing.Any]]):
-        """Updates orderbook data"""
-        self.oms_view.update_data(data)  # reset the model data with new data
-        self.oms_view.update()  # update the view
+    def update_orderbook_data(self, delta: typing.Dict[str, typing.Any]):
+        """Updates orderbook data with the changed rows sent by the algo"""
+        self.oms_view.apply_delta(delta)  # patch the changed rows of the model
 
     def start_trading(self):
         """
@@ -417,10 +426,23 @@ class ApiHome(QtWidgets.QMainWindow):
             self.strategy_algorithm_object = AlgoManager()
             self.oms_view.set_cancel_order_queue(self.strategy_algorithm_object.get_cancel_order_queue())
             self.strategy_algorithm_object.error_stop.connect(self.error_stop_trade_algorithm)
-            self.strategy_algorithm_object.orderbook_data.connect(self.update_orderbook_data)
+            self.strategy_algorithm_object.orderbook_delta.connect(self.update_orderbook_data)
+            self.strategy_algorithm_object.square_off_done.connect(self.square_off_complete)
             self.strategy_algorithm_object.start_algo(trading_mode_index)  # pass paper_trade value (0 for live trade)
         else:  # need to run backtesting script
-            pass
+            backtest_runnable = UI__Runnable.OptDataUpdateWorker(backtest.run_strategy_table)
+            backtest_runnable.signals.result.connect(self.show_backtest_results)
+            backtest_runnable.signals.stopped.connect(self.stop_trading)
+            self.thread_pool.start(backtest_runnable)
+            self.ui.statusbar.showMessage("Running the backtest of the strategy table", 5 * 1000)
+
+    def show_backtest_results(self, result: typing.Tuple[typing.Optional[pd.DataFrame], str]):
+        trades, message = result
+        if trades is None:
+            Interact.show_message(self, "Backtest failed", message, "warning")
+            return
+        self.backtest_view = Backtest_Dialog.BacktestDialog(trades, message)
+        self.backtest_view.show()
 
     def refresh_stylesheet(self):
         if not self.pause_stylesheet_timer:
@@ -668,6 +690,34 @@ class ApiHome(QtWidgets.QMainWindow):
         self.grouped_positions_view = PNLProfit_Dialog.PNLProfitDialog(positions_df)
         self.grouped_positions_view.show()
 
+    @QtCore.pyqtSlot()
+    def square_off_all(self):
+        """kill switch: square off all the positions and cancel the pending entries of all the accounts"""
+        if self.strategy_algorithm_object is None or not self.strategy_algorithm_object.is_running:
+            Interact.show_message(self, "Algorithm not running", "There are no positions to square off", "warning")
+            return
+        response = Interact.show_message(self, "Square Off All Positions",
+                                         "<b>All the open positions of all the accounts will be squared off and the "
+                                         "pending entries cancelled. No new entries will be taken.</b>"
+                                         "<br><h3>Do you want to continue?</h3>", mode="question")
+        if response == QtWidgets.QMessageBox.Yes:
+            self.strategy_algorithm_object.square_off_all()
+            logger.info("Square off of all the positions requested")
+
+    def square_off_complete(self, summary: str):
+        logger.info(summary)
+        Interact.show_message(self, "Square Off Complete", summary, "info")
+
+    @QtCore.pyqtSlot()
+    def show_latency_view(self):
+        def fetch_summary():
+            if self.strategy_algorithm_object is None:
+                return None
+            return self.strategy_algorithm_object.latency_summary()
+
+        self.latency_view = LatencyView_Dialog.LatencyDialog(fetch_summary)
+        self.latency_view.show()
+
     @QtCore.pyqtSlot()
     def save_error_logs(self):
         def copy_log_text_to_file(file_path: str):
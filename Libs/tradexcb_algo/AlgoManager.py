@@ -3,10 +3,12 @@ import typing
 import time
 import datetime
 import multiprocessing
+import queue
 from PyQt5 import QtCore
-from . import main_strategy
+from . import main_strategy, sharding, latency, square_off
+from .main_broker_api import rate_limiter
 
-from Libs.Utils import exception_handler
+from Libs.Utils import exception_handler, settings
 from Libs.Storage import app_data
 
 logger = exception_handler.getAlgoLogger(__name__)
@@ -53,15 +55,29 @@ def algo(manager_dict: typing.Dict, cancel_orders_queue: multiprocessing.Queue):
 
 
 class AlgoManager(QtCore.QObject):
+    """
+    runs the strategy algo in `shard_count` processes (see `sharding`), each trading its share of the strategy rows
+    """
     error_stop = QtCore.pyqtSignal(str)
-    orderbook_data = QtCore.pyqtSignal(dict)
+    orderbook_delta = QtCore.pyqtSignal(dict)  # see `orderbook_delta` for the message format
+    square_off_done = QtCore.pyqtSignal(str)  # summary of the square off of all the positions of all the shards
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, shard_count: int = settings.STRATEGY_SHARDS):
         super(AlgoManager, self).__init__(parent)
-        self.algo_process = None
+        self.shard_count = max(int(shard_count), 1)
+        self.algo_processes = []
         self._monitor_timer = None
-        self.manager_dict = multiprocessing.Manager().dict()  # to handle shared data between processes
-        self.cancel_order_queue = multiprocessing.Queue()
+        self._manager = multiprocessing.Manager()
+        # to handle shared data between processes, one per shard
+        self.manager_dicts = [self._manager.dict() for _ in range(self.shard_count)]
+        self.manager_dict = self.manager_dicts[0]
+        self.cancel_order_queue = sharding.ShardedCancelQueue([multiprocessing.Queue()
+                                                               for _ in range(self.shard_count)])
+        self.orderbook_queue = multiprocessing.Queue()  # shared by all the shards
+        self._square_off_shards: typing.Set[int] = set()  # shards whose square off report is awaited
+        self.orderbook_merger = sharding.OrderbookMerger(self.shard_count, on_resync=self.request_orderbook_resync,
+                                                         cancel_queue=self.cancel_order_queue)
+        rate_limiter.start_service()  # broker request rate limits shared by the shards and the UI
 
     def get_cancel_order_queue(self):
         return self.cancel_order_queue
@@ -69,48 +85,97 @@ class AlgoManager(QtCore.QObject):
     def start_algo(self, paper_trade: int):
         # algo_process = multiprocessing.Process(target=main_strategy.main,
         #                                        args=(self.manager_dict, self.cancel_order_queue))
-        self.algo_process = multiprocessing.Process(target=main_strategy.main,
-                                                    args=(self.manager_dict, self.cancel_order_queue))
-        self.manager_dict['paper_trade'] = paper_trade
-        self.manager_dict['algo_running'] = True
-        self.manager_dict['algo_error'] = None
-        self.manager_dict['force_stop'] = False
-        self.manager_dict['orderbook_data'] = None
-        self.algo_process.start()
+        self.algo_processes = []
+        for shard_index, manager_dict in enumerate(self.manager_dicts):
+            manager_dict['paper_trade'] = paper_trade
+            manager_dict['algo_running'] = True
+            manager_dict['algo_error'] = None
+            manager_dict['force_stop'] = False
+            manager_dict['update_rows'] = 0
+            manager_dict['orderbook_resync'] = False
+            manager_dict['latency'] = {}
+            shard = sharding.ShardSpec(shard_index, self.shard_count, settings.STRATEGY_SHARD_BY)
+            self.algo_processes.append(multiprocessing.Process(
+                target=main_strategy.main,
+                args=(manager_dict, self.cancel_order_queue.queues[shard_index], self.orderbook_queue, shard)))
+        for algo_process in self.algo_processes:
+            algo_process.start()
         self.start_algo_monitor()
 
     def activate_update_rows(self):
         """setting this to 1 will load all rows from Excel file again"""
-        self.manager_dict['update_rows'] = 1
+        for manager_dict in self.manager_dicts:
+            manager_dict['update_rows'] = 1
 
     def stop_algo(self):
-        self.manager_dict['force_stop'] = True  # activate force-stop, it'll stop the algo in the next iteration
+        for manager_dict in self.manager_dicts:
+            manager_dict['force_stop'] = True  # activate force-stop, it'll stop the algo in the next iteration
+
+    def square_off_all(self):
+        """kill switch: every shard squares off all its positions and cancels its pending entries"""
+        for manager_dict in self.manager_dicts:
+            manager_dict['square_off_report'] = None
+        self._square_off_shards = set(range(self.shard_count))
+        self.cancel_order_queue.put_all(square_off.SQUARE_OFF_ALL)
+
+    def collect_square_off_reports(self):
+        """emit `square_off_done` once every shard has reported its square off"""
+        if not self._square_off_shards:
+            return
+        if all(self.manager_dicts[shard_index].get('square_off_report') for shard_index in self._square_off_shards):
+            self._square_off_shards = set()
+            self.square_off_done.emit(square_off.summary(manager_dict['square_off_report']
+                                                         for manager_dict in self.manager_dicts))
+
+    def request_orderbook_resync(self, shard_index: int):
+        """ask a shard for its full orderbook"""
+        self.manager_dicts[shard_index]['orderbook_resync'] = True
 
     def kill_child_proc(self):
-        try:
-            self.algo_process.terminate()
-            self.algo_process.join()
-            f_logger.info("Existing algo process killed")
-        except Exception as e:
-            logger.error(e, exc_info=True)
+        for algo_process in self.algo_processes:
+            try:
+                algo_process.terminate()
+                algo_process.join()
+                f_logger.info("Existing algo process killed")
+            except Exception as e:
+                logger.error(e, exc_info=True)
 
     def start_algo_monitor(self):
         self._monitor_timer = QtCore.QTimer()
         self._monitor_timer.timeout.connect(self.algo_monitor)
-        self._monitor_timer.start(1500)
+        self._monitor_timer.start(settings.ALGO_MONITOR_INTERVAL)
         f_logger.debug('Algo monitoring started')
 
     def algo_monitor(self):
-        if not self.manager_dict.get('algo_running'):
-            self.error_stop.emit(self.manager_dict.get('algo_error'))
-            self._monitor_timer.stop()
-            f_logger.debug('Algo monitoring stopped')
-            self.manager_dict['algo_error'] = None
-        else:
-            orderbook_data = self.manager_dict.get('orderbook_data')
-            if isinstance(orderbook_data, dict):
-                self.orderbook_data.emit(orderbook_data)
+        for shard_index, manager_dict in enumerate(self.manager_dicts):
+            if not manager_dict.get('algo_running'):
+                algo_error = manager_dict.get('algo_error')
+                if algo_error and self.shard_count > 1:
+                    algo_error = f"Shard {shard_index + 1}/{self.shard_count}: {algo_error}"
+                self.error_stop.emit(algo_error)
+                self._monitor_timer.stop()
+                f_logger.debug('Algo monitoring stopped')
+                manager_dict['algo_error'] = None
+                return
+        self.drain_orderbook_queue()
+        self.collect_square_off_reports()
+
+    def drain_orderbook_queue(self):
+        """emit the pending orderbook messages of all shards, merged into the messages of one orderbook"""
+        while True:
+            try:
+                message = self.orderbook_queue.get_nowait()
+            except queue.Empty:
+                break
+            merged_message = self.orderbook_merger.merge(message)
+            if merged_message is not None:
+                self.orderbook_delta.emit(merged_message)
+
+    def latency_summary(self):
+        """latency percentiles of all the shards and of the UI, per stage/broker/account (see `latency.summary`)"""
+        return latency.summary([manager_dict.get('latency') or {} for manager_dict in self.manager_dicts]
+                               + [rate_limiter.get_rate_limiter().latency.export()])
 
     @property
     def is_running(self):
-        return self.algo_process.is_alive()
+        return any(algo_process.is_alive() for algo_process in self.algo_processes)
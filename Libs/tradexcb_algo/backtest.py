@@ -0,0 +1,251 @@
+"""
+Backtest of the strategy table ("Backtesting" trading mode) over historical candles or ticks.
+
+The rows are loaded with `StrategyRowLoader`, the same as for trading, and run with the rules of the Default
+strategy in paper trading: entry price from the ltp (`buy_ltp_percent`/`sell_ltp_percent`), entry filled when
+the ltp crosses it or cancelled after `wait_time` minutes, exit at the target/stoploss, new entry on the next
+price after an exit/cancellation.
+
+Prices are the ltp series the strategy would have seen. Candles are expanded to 4 prices each (open, low,
+high, close for a rising candle, open, high, low, close for a falling one) spread over the candle interval,
+so the targets/stoplosses touched within a candle are hit. Instead of stepping price by price, every phase of
+a trade is one NumPy search over the instrument's arrays (`_first`): the price filling (or the time expiring)
+the entry, then the price hitting the target/stoploss. A row costs a few searches per trade.
+
+Trades come out in the columns of the positions table (`app_data.POSITIONS_COLUMNS`), for a single lot
+unless `lots` is given.
+"""
+import os
+import sys
+import typing
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from Libs.Files import handle_user_details
+from Libs.Storage import app_data
+from Libs.Utils import exception_handler, settings
+from . import strategies
+from .instrument_state import InstrumentStateStore, LEVEL_NONE
+from .main_broker_api.All_Broker import All_Broker
+from .row_loader import StrategyRowLoader
+from .sharding import ShardSpec
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+BACKTEST_USER_ID = 'Backtest'  # user_id of the trades
+_SEARCH_WINDOW = 256  # first prices searched for a trigger, the window grows 4x while nothing is found
+
+
+class PriceSeries(typing.NamedTuple):
+    times: np.ndarray  # epoch seconds (of the exchange's wall clock)
+    ltp: np.ndarray
+
+
+def candle_series(candles: pd.DataFrame, interval: float = 60.0) -> PriceSeries:
+    """
+    prices within OHLC candles, 4 per candle spread over `interval` seconds
+
+    :param candles: open/high/low/close columns, indexed (or with a 'date' column) by the candle start time
+    """
+    start = pd.DatetimeIndex(candles['date'] if 'date' in candles.columns else candles.index)
+    start = (start.tz_localize(None) - pd.Timestamp(0)).total_seconds().to_numpy()
+    open_, high, low, close = (candles[column].to_numpy(dtype=np.float64)
+                               for column in ('open', 'high', 'low', 'close'))
+    rising = close >= open_
+    ltp = np.column_stack([open_, np.where(rising, low, high), np.where(rising, high, low), close]).ravel()
+    times = (start[:, None] + np.arange(4) * interval / 4).ravel()
+    return PriceSeries(times, ltp)
+
+
+def tick_series(ticks: pd.DataFrame) -> PriceSeries:
+    """prices of ticks: 'ltp' column, indexed (or with a 'date' column) by the tick time"""
+    times = pd.DatetimeIndex(ticks['date'] if 'date' in ticks.columns else ticks.index)
+    times = (times.tz_localize(None) - pd.Timestamp(0)).total_seconds().to_numpy()
+    return PriceSeries(times, ticks['ltp'].to_numpy(dtype=np.float64))
+
+
+def _first(condition: typing.Callable[[int, int], np.ndarray], start: int, size: int) -> int:
+    """
+    position of the first price at or after `start` for which `condition(lo, hi)` (mask of prices lo:hi) holds
+
+    :return: `size` if none
+    """
+    window = _SEARCH_WINDOW
+    while start < size:
+        stop = min(start + window, size)
+        hits = np.flatnonzero(condition(start, stop))
+        if len(hits):
+            return start + hits[0].item()
+        start, window = stop, window * 4
+    return size
+
+
+def _time_text(epoch_secs: float) -> typing.Optional[str]:
+    if np.isnan(epoch_secs):
+        return None
+    return (datetime(1970, 1, 1) + timedelta(seconds=epoch_secs)).strftime(settings.DATETIME_FMT_STRING)
+
+
+class Backtest:
+    """
+    the rows of a strategy table, run over the price series of their instruments
+
+    :param lots: lots traded by every entry
+    """
+
+    def __init__(self, lots: int = 1):
+        self.lots = lots
+        self.store = InstrumentStateStore([BACKTEST_USER_ID])
+
+    # the row loader's interface of `StrategyEngine`
+    def add_row(self, key, row: typing.Dict[str, typing.Any]) -> int:
+        return self.store.add_row(key, dict(row, strategy=strategies.strategy_code(row.get('strategy_name'))))
+
+    def update_row(self, idx: int, row: typing.Dict[str, typing.Any]):
+        self.store.update_row(idx, dict(row, strategy=strategies.strategy_code(row.get('strategy_name'))))
+
+    def run(self, prices: typing.Dict[int, PriceSeries]) -> pd.DataFrame:
+        """
+        :param prices: price series of each instrument token
+        :return: trades of all the rows (the positions still open at the end marked to the last price)
+        """
+        default_code = strategies.strategy_code(strategies.DefaultStrategy.name)
+        state = self.store.state
+        trades = []
+        for token, indices in self.store.token_index.items():
+            series = prices.get(token)
+            if series is None or not len(series.ltp):
+                logger.warning(f"No prices of {self.store.info[indices[0]].tradingsymbol} to backtest")
+                continue
+            for idx in indices:
+                if not state['active'][idx]:
+                    continue
+                if state['strategy'][idx] != default_code:
+                    logger.warning(f"Row {self.store.info[idx].key} not backtested, only the "
+                                   f"{strategies.DefaultStrategy.name} strategy can be")
+                    continue
+                trades.extend(self.run_row(idx, series))
+        return pd.DataFrame(trades, columns=app_data.POSITIONS_COLUMNS)
+
+    def run_row(self, idx: int, series: PriceSeries) -> typing.List[typing.Dict[str, typing.Any]]:
+        """trades of the row at `idx` over the prices of its instrument"""
+        store = self.store
+        record = store.state[idx]
+        side = record['side'].item()
+        times, ltp = series
+        signed_ltp = ltp * side  # prices compared as price * side, for BUY and SELL rows alike
+        priced = ~np.isnan(ltp)
+        size = len(ltp)
+        has_target = record['target_type'] != LEVEL_NONE
+        trades = []
+        position = _first(lambda lo, hi: priced[lo:hi], 0, size)
+        with np.errstate(invalid='ignore'):
+            while position < size:
+                # ------------ entry taken at this price: filled, or cancelled once wait_time is over ------------
+                store.reset_position(idx)
+                store.set_entry_levels(idx, ltp[position].item())
+                entry_price = record['entry_price'].item()
+                deadline = times[position] + record['wait_time'] * 60
+                filled_at = _first(lambda lo, hi: (signed_ltp[lo:hi] <= entry_price * side) |
+                                                  (times[lo:hi] > deadline), position, size)
+                if filled_at == size:
+                    break
+                if not signed_ltp[filled_at] <= entry_price * side:  # cancelled, new entry on the next price
+                    position = _first(lambda lo, hi: priced[lo:hi], filled_at + 1, size)
+                    continue
+
+                # ------------ open position: target (first) or stoploss ------------
+                target_price = record['target_price'].item() * side
+                sl_price = record['sl_price'].item() * side
+                exit_at = _first(lambda lo, hi: (has_target & (signed_ltp[lo:hi] >= target_price)) |
+                                                (signed_ltp[lo:hi] <= sl_price), filled_at + 1, size)
+                if exit_at == size:  # still open, marked to the last price
+                    last = np.flatnonzero(priced)[-1]
+                    trades.append(self._trade(idx, times[filled_at], None, np.nan, ltp[last]))
+                    break
+                trades.append(self._trade(idx, times[filled_at], times[exit_at], ltp[exit_at], ltp[exit_at]))
+                position = _first(lambda lo, hi: priced[lo:hi], exit_at + 1, size)
+        store.reset_position(idx)
+        return trades
+
+    def _trade(self, idx: int, entry_time: float, exit_time: typing.Optional[float], exit_price: float,
+               ltp: float) -> typing.Dict[str, typing.Any]:
+        """trade of the row's current entry, in the columns of the positions table"""
+        record = self.store.state[idx]
+        info = self.store.info[idx]
+        side = record['side'].item()
+        quantity = record['quantity'].item() * self.lots
+        entry_price = record['entry_price'].item()
+        return {'user_id': BACKTEST_USER_ID, 'tradingsymbol': info.tradingsymbol, 'exchange': info.exchange,
+                'quantity': quantity, 'entry_price': entry_price, 'entry_time': _time_text(entry_time),
+                'exit_price': exit_price, 'exit_time': None if exit_time is None else _time_text(exit_time),
+                'target_price': record['target_price'].item(), 'sl_price': record['sl_price'].item(),
+                'Row_Type': 'T' if exit_time is None else 'F', 'profit': (ltp - entry_price) * quantity * side,
+                'ltp': ltp, 'Trend': 'BUY' if side == 1 else 'SELL'}
+
+
+def summary(trades: pd.DataFrame) -> str:
+    """one line summary of the trades of a backtest"""
+    closed = trades[trades['Row_Type'] == 'F']
+    return (f"{len(trades)} trades ({len(trades) - len(closed)} open at the end), "
+            f"{(closed['profit'] > 0).sum()} winning, profit {trades['profit'].sum():.2f}")
+
+
+def load_candles(broker: All_Broker, instrument_tokens: typing.Iterable[int], from_dt: datetime, to_dt: datetime,
+                 timeframe: str = settings.BACKTEST_TIMEFRAME,
+                 cache_dir: typing.Optional[str] = settings.BACKTEST_CACHE_DIR) -> typing.Dict[int, PriceSeries]:
+    """
+    historical candles of the instruments, from the broker. Candles of the days before today are kept in
+    `cache_dir` and not downloaded again by the next backtests.
+
+    :param timeframe: candle interval in minutes
+    """
+    prices = {}
+    for token in instrument_tokens:
+        cache_path = None
+        if cache_dir is not None and to_dt.date() < datetime.now().date():
+            cache_path = os.path.join(cache_dir, f"{token}_{timeframe}_{from_dt:%Y%m%d}_{to_dt:%Y%m%d}.pkl")
+        if cache_path is not None and os.path.exists(cache_path):
+            candles, message = pd.read_pickle(cache_path), 'success'
+        else:
+            candles, message = broker.get_data(token, timeframe, 'minute', from_dt, to_dt)
+            if cache_path is not None and message == 'success' and not candles.empty:
+                os.makedirs(cache_dir, exist_ok=True)
+                candles.to_pickle(cache_path)
+        if message != 'success' or candles.empty:
+            logger.warning(f"No historical data of {token} from {from_dt} to {to_dt}")
+            continue
+        prices[token] = candle_series(candles, interval=int(timeframe) * 60)
+    return prices
+
+
+def run_strategy_table(days: int = settings.BACKTEST_DAYS) -> typing.Tuple[typing.Optional[pd.DataFrame], str]:
+    """
+    backtest of the strategy table over the candles of the last `days` days, with the data of the first account
+    (as the data feed of the trading), trades written to `DATA_FILES['BACKTEST_RESULTS_PATH']`
+
+    :return: trades (None if the backtest could not run), message
+    """
+    try:
+        users = pd.DataFrame(handle_user_details.read_user_api_details())
+        main_user = users.iloc[0].to_dict()
+        main_broker = All_Broker(**main_user)
+        assert main_broker.broker_name.lower() == 'zerodha', "Main Broker for historical data is not ZERODHA"
+    except Exception:
+        logger.error(f"Error in logging in for the backtest data {sys.exc_info()}", exc_info=True)
+        return None, f"Login for the historical data failed, Error : {sys.exc_info()[1]}"
+
+    backtest = Backtest(lots=int(main_user.get('No of Lots') or 1))
+    StrategyRowLoader(backtest, ShardSpec(), All_Broker.instrument_df).reload()
+    to_dt = datetime.now()
+    prices = load_candles(main_broker, backtest.store.token_index, to_dt - timedelta(days=days), to_dt)
+    trades = backtest.run(prices)
+    try:
+        trades.to_csv(settings.DATA_FILES['BACKTEST_RESULTS_PATH'], index=False)
+    except Exception:
+        logger.error(f"Error in exporting the backtest trades {sys.exc_info()}", exc_info=True)
+    message = summary(trades)
+    logger.info(f"Backtest of {len(backtest.store)} rows over {len(prices)} instruments: {message}")
+    return trades, message
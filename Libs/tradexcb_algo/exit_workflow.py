@@ -0,0 +1,246 @@
+"""
+Non-blocking exit of a position, per (row, user).
+
+Exiting a position means: check the SL order of the user, cancel it if still pending, and square off with
+a market order. Every broker call runs on the order fan-out pool; `ExitWorkflow.step` (called from the
+strategy loop) only looks at the finished calls and submits the next ones, so the loop never waits
+for a broker while an exit is in progress.
+
+    CHECK_SL --PENDING--> CANCEL_SL --(wait_for_broker / failed)--> CONFIRM_CANCEL --CANCELLED--> EXIT --> DONE
+             --COMPLETE-> CANCEL_SL (cancel only) --> DONE                       --COMPLETE/timeout--> DONE
+
+A pending entry is cancelled the same way (`cancel_entry`), except that only a filled entry is squared off:
+
+    CHECK_SL --PENDING--> CANCEL_SL --> CONFIRM_CANCEL --CANCELLED/timeout--> DONE
+             --COMPLETE-> EXIT --> DONE                 --COMPLETE----------> EXIT --> DONE
+"""
+import sys
+import time
+import typing
+from concurrent.futures import Future
+
+from Libs.Utils import exception_handler, settings
+from .latency import LatencyRecorder
+from .order_fanout import OrderFanout, FanoutResult
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+CHECK_SL = 'check_sl'
+CANCEL_SL = 'cancel_sl'
+CONFIRM_CANCEL = 'confirm_cancel'
+EXIT = 'exit'
+DONE = 'done'
+
+
+class ExitTask:
+    """exit of one row for one user"""
+    __slots__ = ('idx', 'user', 'sl_order_id', 'exit_order', 'wait_for_broker', 'state', 'due', 'deadline',
+                 'future', 'cancel_only', 'sl_order_status', 'exit_order_id', 'tick_at', 'signal_at', 'cancel_entry',
+                 'error')
+
+    def __init__(self, idx: int, user: str, sl_order_id, exit_order: typing.Dict[str, typing.Any],
+                 wait_for_broker: bool, due: float, tick_at: typing.Optional[float] = None,
+                 signal_at: typing.Optional[float] = None, cancel_entry: bool = False):
+        self.idx = idx
+        self.user = user
+        self.sl_order_id = sl_order_id  # order cancelled first: the SL order, or the entry order (cancel_entry)
+        self.exit_order = exit_order
+        self.wait_for_broker = wait_for_broker
+        self.state = CHECK_SL
+        self.due = due  # monotonic time of the next broker call
+        self.deadline = None  # give up waiting for the cancellation after this
+        self.future: typing.Optional[Future] = None
+        self.cancel_only = False
+        self.sl_order_status = None
+        self.exit_order_id = None
+        self.tick_at = tick_at  # monotonic times of the tick / strategy pass which triggered the exit (latency)
+        self.signal_at = signal_at
+        self.cancel_entry = cancel_entry
+        self.error: typing.Optional[str] = None  # why the exit could not be completed
+
+
+class ExitWorkflow:
+    """
+    exits in progress of all rows
+
+    :param on_task_done: called as `on_task_done(task)` (on the strategy thread) when the exit of a user is over
+    :param on_row_done: called as `on_row_done(idx)` when the exits of all users of the row are over
+    """
+
+    def __init__(self, users_df_dict: typing.Dict[str, typing.Dict[str, typing.Any]], fanout: OrderFanout,
+                 broker_names: typing.Dict[str, str], on_task_done: typing.Callable[[ExitTask], None],
+                 on_row_done: typing.Callable[[int], None], latency: typing.Optional[LatencyRecorder] = None):
+        self.users_df_dict = users_df_dict
+        self.fanout = fanout
+        self.broker_names = broker_names
+        self.on_task_done = on_task_done
+        self.on_row_done = on_row_done
+        self.latency = latency or LatencyRecorder()
+        self.wake: typing.Callable[[], None] = lambda: None  # wakes the strategy loop when a broker call finishes
+        self.clock: typing.Callable[[], float] = time.monotonic  # replaced by the replay clock in a market replay
+        self._tasks: typing.List[ExitTask] = []
+        self._pending_rows: typing.Dict[int, int] = {}  # row -> number of users whose exit is not over
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def is_exiting(self, idx: int) -> bool:
+        return idx in self._pending_rows
+
+    def start(self, idx: int, orders: typing.Dict[str, typing.Tuple[typing.Any, typing.Dict[str, typing.Any]]],
+              wait_for_broker=False, tick_at: typing.Optional[float] = None, signal_at: typing.Optional[float] = None,
+              cancel_entry=False, exit_now: typing.Iterable[str] = ()):
+        """
+        start the exit of a row
+
+        :param orders: {user: (id of the SL order, market order to square off with)}
+        :param wait_for_broker: wait for the cancellation of the SL order to be confirmed before the exit order
+        :param tick_at: monotonic time of the tick which triggered the exit
+        :param signal_at: monotonic time of the strategy pass which triggered the exit
+        :param cancel_entry: `orders` hold the pending entry orders instead, squared off only if filled
+        :param exit_now: users whose order is known to be cancelled/filled already, squared off right away
+            (exits resumed after a restart of the algo)
+        """
+        if not orders:
+            self.on_row_done(idx)
+            return
+        self._pending_rows[idx] = len(orders)
+        exit_now = set(exit_now)
+        for user, (sl_order_id, exit_order) in orders.items():
+            task = ExitTask(idx, user, sl_order_id, exit_order, wait_for_broker, self.clock(), tick_at, signal_at,
+                            cancel_entry)
+            if user in exit_now:
+                task.state = EXIT
+            self._tasks.append(task)
+        self.step()
+
+    def in_flight(self) -> typing.List[Future]:
+        """broker calls submitted and not collected yet"""
+        return [task.future for task in self._tasks if task.future is not None]
+
+    def next_due(self) -> typing.Optional[float]:
+        """monotonic time at which `step` has work to do (None if nothing is scheduled)"""
+        due = [task.due for task in self._tasks if task.future is None]
+        return min(due) if due else None
+
+    def step(self):
+        """collect the finished broker calls and submit the ones which are due"""
+        if not self._tasks:
+            return
+        now = self.clock()
+        for task in self._tasks:
+            if task.future is not None:
+                if not task.future.done():
+                    continue
+                result: FanoutResult = task.future.result()
+                task.future = None
+                self._advance(task, result, now)
+            if task.state != DONE and task.due <= now:
+                self._submit(task)
+
+        finished = [task for task in self._tasks if task.state == DONE]
+        if finished:
+            self._tasks = [task for task in self._tasks if task.state != DONE]
+            for task in finished:
+                self._task_done(task)
+
+    def _task_done(self, task: ExitTask):
+        try:
+            self.on_task_done(task)
+        except Exception:
+            logger.critical(f"Error in Closing Order of {task.user} Error {sys.exc_info()}", exc_info=True)
+        self._pending_rows[task.idx] -= 1
+        if self._pending_rows[task.idx] == 0:
+            del self._pending_rows[task.idx]
+            self.on_row_done(task.idx)
+
+    def _submit(self, task: ExitTask):
+        broker = self.users_df_dict[task.user]['broker']
+        if task.state in (CHECK_SL, CONFIRM_CANCEL):
+            func = lambda user: broker.get_order_status(task.sl_order_id)
+        elif task.state == CANCEL_SL:
+            func = lambda user: broker.cancel_order(task.sl_order_id)
+        else:
+            func = lambda user: self.latency.place_order(broker, user, task.exit_order, task.tick_at, task.signal_at)
+        task.future = self.fanout.submit(func, task.user, self.broker_names.get(task.user))
+        task.future.add_done_callback(lambda future: self.wake())
+
+    def _advance(self, task: ExitTask, result: FanoutResult, now: float):
+        if not result.ok:
+            logger.critical(f"Error in Closing Order Placement for {self.users_df_dict[task.user]['Name']}"
+                            f" Error {result.error!r}", exc_info=result.error)
+            task.error = repr(result.error)
+            task.state = DONE
+            return
+
+        if task.cancel_entry:
+            self._advance_cancel_entry(task, result, now)
+        elif task.state == CHECK_SL:
+            task.sl_order_status, message = result.value
+            self.latency.order_status(task.user, task.sl_order_id, task.sl_order_status)
+            if task.sl_order_status == 'PENDING':
+                task.state = CANCEL_SL
+            elif task.sl_order_status == 'COMPLETE':
+                task.state = CANCEL_SL
+                task.cancel_only = True
+            else:
+                task.state = DONE
+        elif task.state == CANCEL_SL:
+            cancelled = result.value == 'success'
+            if task.cancel_only:
+                task.state = DONE
+            elif task.wait_for_broker or not cancelled:
+                if not cancelled:  # e.g. the SL order got executed meanwhile, its status tells
+                    logger.warning(f"Cancelling the SL order {task.sl_order_id} of {task.user} failed: "
+                                   f"{result.value}")
+                task.state = CONFIRM_CANCEL
+                task.due = now + settings.EXIT_POLL_INTERVAL
+                task.deadline = now + settings.EXIT_CANCEL_CONFIRM_TIMEOUT
+            else:
+                task.state = EXIT
+        elif task.state == CONFIRM_CANCEL:
+            order_status, message = result.value
+            if order_status == 'COMPLETE':  # the SL order got executed meanwhile, position is already closed
+                task.sl_order_status = order_status
+                task.state = DONE
+            elif order_status in ('CANCELLED', 'REJECTED'):
+                task.state = EXIT
+            elif now < task.deadline:
+                task.due = now + settings.EXIT_POLL_INTERVAL
+            else:  # the SL order may still execute, squaring off as well could close the position twice
+                task.sl_order_status = order_status
+                task.error = "SL order cancellation not confirmed"
+                logger.error(f"{task.error} for {task.user} (order {task.sl_order_id}, {order_status}), "
+                             f"the position is not squared off")
+                task.state = DONE
+        elif task.state == EXIT:
+            self._exit_placed(task, result)
+
+    def _advance_cancel_entry(self, task: ExitTask, result: FanoutResult, now: float):
+        if task.state in (CHECK_SL, CONFIRM_CANCEL):
+            task.sl_order_status, message = result.value
+            self.latency.order_status(task.user, task.sl_order_id, task.sl_order_status)
+            if task.sl_order_status == 'COMPLETE':  # entry filled, square off the position
+                task.state = EXIT
+            elif task.sl_order_status == 'PENDING' and task.state == CHECK_SL:
+                task.state = CANCEL_SL
+            elif task.sl_order_status == 'PENDING' and now < task.deadline:
+                task.due = now + settings.EXIT_POLL_INTERVAL
+            else:
+                if task.sl_order_status == 'PENDING':
+                    task.error = "Entry order cancellation not confirmed"
+                task.state = DONE
+        elif task.state == CANCEL_SL:
+            task.state = CONFIRM_CANCEL
+            task.due = now + settings.EXIT_POLL_INTERVAL
+            task.deadline = now + settings.EXIT_CANCEL_CONFIRM_TIMEOUT
+        elif task.state == EXIT:
+            self._exit_placed(task, result)
+
+    @staticmethod
+    def _exit_placed(task: ExitTask, result: FanoutResult):
+        task.exit_order_id, message = result.value
+        if task.exit_order_id is None:
+            task.error = message
+        logger.info(f"Order Placed for {task.user} Order_id {task.exit_order_id}")
+        task.state = DONE
@@ -0,0 +1,281 @@
+import typing
+from datetime import datetime
+
+import numpy as np
+
+from Libs.Utils import calculations
+
+# ------------ row status ------------
+STATUS_IDLE = 0  # waiting to take an entry
+STATUS_ENTRY_PLACED = 1  # entry order placed, waiting for the price to cross the entry price
+STATUS_IN_POSITION = 2  # entry executed, watching target/stoploss
+STATUS_EXITING = 3  # exit triggered, waiting for the exit orders of the users to go out
+
+# ------------ target_type / stoploss_type codes ------------
+LEVEL_NONE = 0  # 'No Target Order' / 'No SL Order'
+LEVEL_PERCENTAGE = 1
+LEVEL_VALUE = 2
+
+ORDER_KINDS = ('entry', 'sl', 'target', 'exit')  # exit: market order squaring off the entry
+
+ROW_STATE_DTYPE = np.dtype([
+    ('instrument_token', np.int64),
+    ('token_slot', np.int32),  # position of instrument_token in `InstrumentStateStore.tokens`
+    ('side', np.int8),  # +1 for BUY, -1 for SELL rows (transaction_type)
+    ('status', np.int8),
+    ('multiplier', np.int8),  # side of the open trade, 0 when there is none
+    ('entry_price', np.float64),  # all prices and times are NaN when not set
+    ('entry_time', np.float64),  # epoch seconds
+    ('exit_price', np.float64),
+    ('exit_time', np.float64),
+    ('target_price', np.float64),
+    ('sl_price', np.float64),
+    ('ltp', np.float64),
+    ('profit', np.float64),
+    ('buy_ltp_percent', np.float64),
+    ('sell_ltp_percent', np.float64),
+    ('wait_time', np.float64),  # in minutes
+    ('target', np.float64),
+    ('stoploss', np.float64),
+    ('target_type', np.int8),
+    ('stoploss_type', np.int8),
+    ('tick_size', np.float64),
+    ('lot_size', np.int32),
+    ('quantity', np.int64),  # lots * lot_size, for a single lot of the user
+    ('close_positions', np.int8),
+    ('active', np.bool_),
+    ('strategy', np.int16),  # code of the strategy of the row (see `strategies`)
+])
+
+
+def level_type_code(level_type: typing.Optional[str]) -> int:
+    """maps the target_type/stoploss_type text of the strategy table to its code"""
+    level_type = (level_type or "").strip().lower()
+    if level_type == 'percentage':
+        return LEVEL_PERCENTAGE
+    elif level_type == 'value':
+        return LEVEL_VALUE
+    return LEVEL_NONE
+
+
+class RowInfo:
+    """static (text) details of a strategy row, which never change during the session"""
+    __slots__ = ('key', 'tradingsymbol', 'exchange', 'exchange_token', 'instrument', 'transaction_type',
+                 'order_type', 'product_type', 'stoploss_type', 'target_type', 'strategy_name')
+
+    def __init__(self, key, **kwargs):
+        self.key = key
+        for name in self.__slots__[1:]:
+            setattr(self, name, kwargs.get(name))
+
+
+class InstrumentStateStore:
+    """
+    Columnar store of the strategy rows.
+
+    Every numeric field of all rows lives in one NumPy structured array (`state`), so the per-cycle
+    scans work on typed columns. Text details are kept once per row in `info`, and the order ids/statuses/tags
+    of each user are 2-D object arrays of shape (rows, users).
+    Rows are addressed by index, `index_of` maps the instruments_df_dict key of a row to it.
+    """
+
+    def __init__(self, users: typing.Iterable[str], capacity: int = 64):
+        self.users = list(users)
+        self.user_index = {user: col for col, user in enumerate(self.users)}
+        self.size = 0
+        self._state = np.zeros(capacity, dtype=ROW_STATE_DTYPE)
+        self.info: typing.List[RowInfo] = []
+        self.key_index: typing.Dict[typing.Any, int] = {}
+        self.token_index: typing.Dict[int, typing.List[int]] = {}
+        self.tokens: typing.List[int] = []  # distinct instrument tokens, in order of first appearance
+        self.token_slots: typing.Dict[int, int] = {}  # instrument token -> position in `tokens`
+        self._order_ids = {kind: np.full((capacity, len(self.users)), None, dtype=object) for kind in ORDER_KINDS}
+        self._order_status = {kind: np.full((capacity, len(self.users)), None, dtype=object) for kind in ORDER_KINDS}
+        self._order_tags = {kind: np.full((capacity, len(self.users)), None, dtype=object) for kind in ORDER_KINDS}
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return key in self.key_index
+
+    @property
+    def state(self) -> np.ndarray:
+        """structured array view of the used rows"""
+        return self._state[:self.size]
+
+    @property
+    def keys(self) -> typing.List[typing.Any]:
+        return [info.key for info in self.info]
+
+    def index_of(self, key) -> int:
+        return self.key_index[key]
+
+    def order_ids(self, kind: str) -> np.ndarray:
+        return self._order_ids[kind][:self.size]
+
+    def order_status(self, kind: str) -> np.ndarray:
+        return self._order_status[kind][:self.size]
+
+    def _grow(self):
+        capacity = max(2 * len(self._state), 1)
+        state = np.zeros(capacity, dtype=ROW_STATE_DTYPE)
+        state[:self.size] = self._state[:self.size]
+        self._state = state
+        for arrays in (self._order_ids, self._order_status, self._order_tags):
+            for kind, old in arrays.items():
+                new = np.full((capacity, len(self.users)), None, dtype=object)
+                new[:self.size] = old[:self.size]
+                arrays[kind] = new
+
+    def add_row(self, key, row: typing.Dict[str, typing.Any]) -> int:
+        """
+        Append a strategy row
+
+        :param key: instruments_df_dict key of the row
+        :param row: row of the strategy table, along with instrument details
+            (instrument_token, tradingsymbol, lot_size, tick_size, exchange_token) and its strategy code
+        :return: index of the row in the store
+        """
+        if self.size == len(self._state):
+            self._grow()
+        idx = self.size
+        self.size += 1
+
+        transaction_type = str(row['transaction_type']).upper()
+        record = self._state[idx]
+        record['instrument_token'] = int(row['instrument_token'])
+        record['side'] = 1 if transaction_type == 'BUY' else -1
+        record['status'] = STATUS_IDLE
+        record['multiplier'] = 0
+        for field in ('entry_price', 'entry_time', 'exit_price', 'exit_time', 'target_price', 'sl_price',
+                      'ltp', 'profit'):
+            record[field] = np.nan
+        for field in ('buy_ltp_percent', 'sell_ltp_percent', 'wait_time', 'target', 'stoploss'):
+            record[field] = np.nan if row.get(field) is None else float(row[field])
+        record['target_type'] = level_type_code(row.get('target_type'))
+        record['stoploss_type'] = level_type_code(row.get('stoploss_type'))
+        record['tick_size'] = float(row['tick_size'])
+        record['lot_size'] = int(row['lot_size'])
+        record['quantity'] = int(row['quantity'])
+        record['close_positions'] = 0
+        record['active'] = True
+        record['strategy'] = row.get('strategy', 0)
+
+        details = {name: row.get(name) for name in RowInfo.__slots__[1:]}
+        details['transaction_type'] = transaction_type
+        self.info.append(RowInfo(key, **details))
+        self.key_index[key] = idx
+        token = record['instrument_token'].item()
+        if token not in self.token_slots:
+            self.token_slots[token] = len(self.tokens)
+            self.tokens.append(token)
+        record['token_slot'] = self.token_slots[token]
+        self.token_index.setdefault(token, []).append(idx)
+        return idx
+
+    def update_row(self, idx: int, row: typing.Dict[str, typing.Any]):
+        """
+        Update the parameters of a row (same instrument and transaction type) from its edited strategy table row,
+        levels of an open trade are kept (the new parameters apply from the next entry)
+        """
+        record = self._state[idx]
+        record['active'] = True
+        record['strategy'] = row.get('strategy', record['strategy'])
+        for field in ('buy_ltp_percent', 'sell_ltp_percent', 'wait_time', 'target', 'stoploss'):
+            record[field] = np.nan if row.get(field) is None else float(row[field])
+        record['target_type'] = level_type_code(row.get('target_type'))
+        record['stoploss_type'] = level_type_code(row.get('stoploss_type'))
+        record['tick_size'] = float(row['tick_size'])
+        record['lot_size'] = int(row['lot_size'])
+        record['quantity'] = int(row['quantity'])
+        info = self.info[idx]
+        for name in RowInfo.__slots__[1:]:
+            if name != 'transaction_type':
+                setattr(info, name, row.get(name))
+
+    def retire_row(self, idx: int):
+        """
+        Take a row out of the strategy (deleted/replaced in the strategy table): it takes no new entries, an open
+        trade is still managed (and can be closed by its key) until it is closed.
+        The key of a row without an open trade is freed for a new row.
+        """
+        record = self._state[idx]
+        record['active'] = False
+        key = self.info[idx].key
+        if record['status'] == STATUS_IDLE and self.key_index.get(key) == idx:
+            del self.key_index[key]
+
+    def reset_position(self, idx: int):
+        """clear the trade details of a row, so that it can take a fresh entry"""
+        record = self._state[idx]
+        record['status'] = STATUS_IDLE
+        record['multiplier'] = 0
+        for field in ('entry_price', 'entry_time', 'exit_price', 'exit_time', 'target_price', 'sl_price'):
+            record[field] = np.nan
+        record['close_positions'] = 0
+        for arrays in (self._order_ids, self._order_status, self._order_tags):  # orders of the trade
+            for orders in arrays.values():
+                orders[idx] = None
+
+    def set_entry_levels(self, idx: int, ltp: float):
+        """entry price of a new entry of the row taken at `ltp`, and its target/stoploss prices"""
+        record = self._state[idx]
+        info = self.info[idx]
+        side = record['side'].item()
+        tick_size = record['tick_size'].item()
+        ltp_percent = record['buy_ltp_percent'] if side == 1 else record['sell_ltp_percent']
+        entry_price = calculations.get_entry_price(info.order_type, info.transaction_type, ltp, ltp_percent,
+                                                   tick_size)
+        record['entry_price'] = entry_price
+
+        target = record['target']
+        if record['target_type'] == LEVEL_PERCENTAGE:
+            record['target_price'] = calculations.fix_values(entry_price * (1 + side * target / 100), tick_size)
+        elif record['target_type'] == LEVEL_VALUE:
+            record['target_price'] = calculations.fix_values(entry_price + side * target, tick_size)
+
+        stoploss = record['stoploss']
+        if record['stoploss_type'] == LEVEL_PERCENTAGE:
+            record['sl_price'] = calculations.fix_values(entry_price * (1 - side * stoploss / 100), tick_size)
+        elif record['stoploss_type'] == LEVEL_VALUE:
+            record['sl_price'] = calculations.fix_values(entry_price - side * stoploss, tick_size)
+
+    def set_order(self, kind: str, idx: int, user: str, order_id=None, order_status=None, tag=None):
+        col = self.user_index[user]
+        if order_id is not None:
+            self._order_ids[kind][idx, col] = order_id
+        if order_status is not None:
+            self._order_status[kind][idx, col] = order_status
+        if tag is not None:
+            self._order_tags[kind][idx, col] = tag
+
+    def get_order(self, kind: str, idx: int, user: str):
+        """:return: order_id, order_status"""
+        col = self.user_index[user]
+        return self._order_ids[kind][idx, col], self._order_status[kind][idx, col]
+
+    def get_tag(self, kind: str, idx: int, user: str) -> typing.Optional[str]:
+        """tag of the logical order (see `order_tags`), set before the order is sent"""
+        return self._order_tags[kind][idx, self.user_index[user]]
+
+    @staticmethod
+    def to_datetime(epoch_secs: float) -> typing.Optional[datetime]:
+        return None if np.isnan(epoch_secs) else datetime.fromtimestamp(epoch_secs)
+
+    def as_dict(self, idx: int, **extra) -> typing.Dict[str, typing.Any]:
+        """the row in the shape of the old instruments_df_dict rows (for export / positions)"""
+        record = self._state[idx]
+        info = self.info[idx]
+
+        def _value(field):
+            value = record[field].item()
+            return None if isinstance(value, float) and np.isnan(value) else value
+
+        row = {field: _value(field) for field in ROW_STATE_DTYPE.names}
+        row.update({name: getattr(info, name) for name in RowInfo.__slots__})
+        row['multiplier'] = row['multiplier'] or None
+        row['entry_time'] = self.to_datetime(record['entry_time'])
+        row['exit_time'] = self.to_datetime(record['exit_time'])
+        row.update(extra)
+        return row
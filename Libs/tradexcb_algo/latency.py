@@ -0,0 +1,175 @@
+"""
+Tick-to-order latency of the strategy, per stage, broker and account.
+
+Every stage is timed with the monotonic clock and recorded into a fixed log-scale histogram
+(`LatencyHistogram`), so recording is O(1) and the histograms of several algo processes (shards) can be
+merged exactly. The stages of an order:
+
+    tick received (on_ticks) --tick_to_signal--> row evaluated by its strategy
+        --signal_to_send--> place_order sent --send_to_ack--> order id returned by the broker
+        --(send_to_fill)--> fill detected (order update pushed / status checked)
+
+plus `tick_to_ack` (end to end), `evaluate` (time taken by a strategy pass) and `rate_limit_wait` (time a
+broker call waited for the request rate limit, see `main_broker_api.rate_limiter`).
+"""
+import bisect
+import math
+import threading
+import time
+import typing
+from datetime import datetime
+
+import pandas as pd
+
+STAGE_TICK_TO_SIGNAL = 'tick_to_signal'
+STAGE_EVALUATE = 'evaluate'
+STAGE_SIGNAL_TO_SEND = 'signal_to_send'
+STAGE_SEND_TO_ACK = 'send_to_ack'
+STAGE_TICK_TO_ACK = 'tick_to_ack'
+STAGE_SEND_TO_FILL = 'send_to_fill'
+STAGE_RATE_LIMIT_WAIT = 'rate_limit_wait'
+STAGES = (STAGE_TICK_TO_SIGNAL, STAGE_EVALUATE, STAGE_SIGNAL_TO_SEND, STAGE_SEND_TO_ACK, STAGE_TICK_TO_ACK,
+          STAGE_SEND_TO_FILL, STAGE_RATE_LIMIT_WAIT)
+
+ALL = 'All'  # broker/account of the rows aggregated over all accounts (of a broker)
+LATENCY_COLUMNS = ['stage', 'broker', 'account', 'count', 'p50_ms', 'p99_ms', 'max_ms']
+
+# bucket upper bounds in seconds: 10us to ~100s, each bucket 10% wider than the previous one
+BUCKET_BOUNDS = tuple(1e-5 * 1.1 ** i for i in range(int(math.log(1e7) / math.log(1.1)) + 1))
+FILL_STATUSES = ('COMPLETE',)
+CLOSED_STATUSES = ('COMPLETE', 'CANCELLED', 'REJECTED')
+
+Key = typing.Tuple[str, typing.Optional[str], typing.Optional[str]]  # stage, broker, account
+
+
+class LatencyHistogram:
+    """counts of latencies per bucket of `BUCKET_BOUNDS` (the last bucket counts everything above)"""
+    __slots__ = ('counts', 'count', 'max')
+
+    def __init__(self, counts: typing.Optional[typing.List[int]] = None, count: int = 0, maximum: float = 0.0):
+        self.counts = list(counts) if counts is not None else [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = count
+        self.max = maximum
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: 'LatencyHistogram'):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        """upper bound (seconds) of the bucket holding the `percent` percentile, at most the max recorded"""
+        if not self.count:
+            return math.nan
+        rank = max(math.ceil(self.count * percent / 100), 1)
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(BUCKET_BOUNDS[bucket], self.max) if bucket < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def state(self) -> typing.Tuple[typing.List[int], int, float]:
+        """picklable state, see `from_state`"""
+        return list(self.counts), self.count, self.max
+
+    @classmethod
+    def from_state(cls, state: typing.Tuple[typing.List[int], int, float]) -> 'LatencyHistogram':
+        return cls(*state)
+
+
+class LatencyRecorder:
+    """latency histograms of an algo process, keyed by (stage, broker, account); safe to use from any thread"""
+
+    def __init__(self):
+        self._histograms: typing.Dict[Key, LatencyHistogram] = {}
+        self._sent_orders: typing.Dict[typing.Tuple[str, str], typing.Tuple[float, typing.Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, broker: typing.Optional[str] = None,
+               account: typing.Optional[str] = None):
+        with self._lock:
+            histogram = self._histograms.get((stage, broker, account))
+            if histogram is None:
+                histogram = self._histograms[(stage, broker, account)] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def place_order(self, broker, account: str, order: typing.Dict[str, typing.Any],
+                    tick_at: typing.Optional[float] = None, signal_at: typing.Optional[float] = None):
+        """
+        `broker.place_order(**order)`, recording the send/ack latencies of the order
+
+        :param tick_at: monotonic time of the tick which triggered the order (if known)
+        :param signal_at: monotonic time the strategy evaluated the row
+        :return: order_id, message
+        """
+        broker_name = getattr(broker, 'broker_name', None)
+        sent_at = time.monotonic()
+        order_id, message = broker.place_order(**order)
+        ack_at = time.monotonic()
+        if signal_at is not None:
+            self.record(STAGE_SIGNAL_TO_SEND, sent_at - signal_at, broker_name, account)
+        self.record(STAGE_SEND_TO_ACK, ack_at - sent_at, broker_name, account)
+        if tick_at is not None:
+            self.record(STAGE_TICK_TO_ACK, ack_at - tick_at, broker_name, account)
+        if order_id is not None and order.get('order_type') == 'MARKET':  # others fill when the price gets there
+            with self._lock:
+                self._sent_orders[(account, str(order_id))] = (sent_at, broker_name)
+        return order_id, message
+
+    def order_status(self, account: str, order_id, status: typing.Optional[str]):
+        """status of an order seen by the strategy (pushed or checked), records the fill latency of market orders"""
+        if status not in CLOSED_STATUSES or order_id is None:
+            return
+        with self._lock:
+            sent = self._sent_orders.pop((account, str(order_id)), None)
+        if sent is not None and status in FILL_STATUSES:
+            sent_at, broker_name = sent
+            self.record(STAGE_SEND_TO_FILL, time.monotonic() - sent_at, broker_name, account)
+
+    def export(self) -> typing.Dict[Key, typing.Tuple[typing.List[int], int, float]]:
+        """picklable copy of the histograms (for the UI / other processes), see `summary`"""
+        with self._lock:
+            return {key: histogram.state() for key, histogram in self._histograms.items()}
+
+    def dump(self, file_path: str, others: typing.Iterable['LatencyRecorder'] = ()):
+        """write the summary of the histograms, merged with the ones of `others` (end of day report)"""
+        report = summary([self.export()] + [other.export() for other in others])
+        report['date'] = datetime.now().strftime('%Y-%m-%d')
+        report.to_csv(file_path, index=False)
+
+
+def summary(exports: typing.Iterable[typing.Dict[Key, typing.Tuple[typing.List[int], int, float]]]) -> pd.DataFrame:
+    """
+    p50/p99/max (milliseconds) of each stage per account, per broker (account 'All') and over all brokers,
+    out of the exported histograms of one or more algo processes
+    """
+    merged: typing.Dict[Key, LatencyHistogram] = {}
+    for exported in exports:
+        for (stage, broker, account), state in exported.items():
+            histogram = LatencyHistogram.from_state(state)
+            keys = {(stage, broker, account)}
+            if account is not None:
+                keys.update({(stage, broker, ALL), (stage, ALL, ALL)})
+            for key in keys:
+                if key in merged:
+                    merged[key].merge(histogram)
+                else:
+                    merged[key] = LatencyHistogram.from_state(histogram.state())
+
+    rows = []
+    for (stage, broker, account), histogram in merged.items():
+        rows.append({'stage': stage, 'broker': broker or ALL, 'account': account or ALL, 'count': histogram.count,
+                     'p50_ms': round(histogram.percentile(50) * 1000, 3),
+                     'p99_ms': round(histogram.percentile(99) * 1000, 3),
+                     'max_ms': round(histogram.max * 1000, 3)})
+    report = pd.DataFrame(rows, columns=LATENCY_COLUMNS)
+    if len(report):
+        report['stage_order'] = report['stage'].map({stage: order for order, stage in enumerate(STAGES)})
+        report = report.sort_values(['stage_order', 'broker', 'account']).drop(columns='stage_order')
+    return report.reset_index(drop=True)
@@ -0,0 +1,122 @@
+"""
+Opt-in profiling of the phases of the strategy loop (`settings.STRATEGY_PROFILING`).
+
+Each phase of a cycle is timed with `with profiler.phase(name):`, wall time (perf_counter) and CPU time
+of the strategy thread (thread_time). The last `window` samples of each phase are kept for rolling
+statistics, and `LoopProfiler.report_due` tells the loop when to log the summary. When profiling is off,
+`NULL_PROFILER` hands out a shared no-op context, so the loop pays one method call per phase.
+"""
+import contextlib
+import time
+import typing
+from collections import deque
+
+import numpy as np
+
+from Libs.Utils import settings
+
+CYCLE = 'cycle'  # whole cycle, wait for ticks excluded
+WAIT = 'wait_for_ticks'  # idle time, not part of the cycle
+
+
+class _PhaseTimer:
+    __slots__ = ('profiler', 'name', '_wall', '_cpu')
+
+    def __init__(self, profiler: 'LoopProfiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.record(self.name, time.perf_counter() - self._wall, time.thread_time() - self._cpu)
+
+
+class LoopProfiler:
+    """
+    rolling wall/CPU time of the phases of the strategy loop
+
+    :param window: samples kept per phase
+    :param report_interval: seconds between two summaries
+    """
+    enabled = True
+
+    def __init__(self, window: int = settings.STRATEGY_PROFILE_WINDOW,
+                 report_interval: float = settings.STRATEGY_PROFILE_REPORT_INTERVAL):
+        self.window = window
+        self.report_interval = report_interval
+        self._wall: typing.Dict[str, deque] = {}
+        self._cpu: typing.Dict[str, deque] = {}
+        self._counts: typing.Dict[str, int] = {}
+        self._next_report = time.monotonic() + report_interval
+        self._cycle: typing.Optional[_PhaseTimer] = None
+
+    def phase(self, name: str) -> _PhaseTimer:
+        return _PhaseTimer(self, name)
+
+    def record(self, name: str, wall: float, cpu: float):
+        if name not in self._wall:
+            self._wall[name] = deque(maxlen=self.window)
+            self._cpu[name] = deque(maxlen=self.window)
+            self._counts[name] = 0
+        self._wall[name].append(wall)
+        self._cpu[name].append(cpu)
+        self._counts[name] += 1
+
+    def start_cycle(self):
+        self._cycle = self.phase(CYCLE).__enter__()
+
+    def end_cycle(self):
+        if self._cycle is not None:
+            self._cycle.__exit__(None, None, None)
+            self._cycle = None
+
+    def report_due(self) -> bool:
+        now = time.monotonic()
+        if now < self._next_report:
+            return False
+        self._next_report = now + self.report_interval
+        return True
+
+    def summary(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """{phase: count, mean/p99/max of the wall time and mean CPU time (ms) of the last `window` samples}"""
+        stats = {}
+        for name, wall_samples in self._wall.items():
+            wall = np.fromiter(wall_samples, dtype=float) * 1000
+            cpu = np.fromiter(self._cpu[name], dtype=float) * 1000
+            stats[name] = {'count': self._counts[name], 'wall_mean_ms': round(float(wall.mean()), 3),
+                           'wall_p99_ms': round(float(np.percentile(wall, 99)), 3),
+                           'wall_max_ms': round(float(wall.max()), 3), 'cpu_mean_ms': round(float(cpu.mean()), 3)}
+        return stats
+
+    def report(self) -> str:
+        """one line summary, slowest phases (by mean wall time) first"""
+        stats = self.summary()
+        parts = [f"{name}: {phase['wall_mean_ms']}/{phase['wall_p99_ms']}/{phase['wall_max_ms']}ms "
+                 f"cpu {phase['cpu_mean_ms']}ms x{phase['count']}"
+                 for name, phase in sorted(stats.items(), key=lambda item: -item[1]['wall_mean_ms'])]
+        return "Strategy loop phases (wall mean/p99/max) - " + ", ".join(parts)
+
+
+class _NullProfiler:
+    """stands in for `LoopProfiler` when profiling is off"""
+    enabled = False
+    _context = contextlib.nullcontext()
+
+    def phase(self, name: str):
+        return self._context
+
+    def start_cycle(self):
+        pass
+
+    def end_cycle(self):
+        pass
+
+    def report_due(self) -> bool:
+        return False
+
+
+NULL_PROFILER = _NullProfiler()
@@ -1,6 +1,9 @@
 import datetime
 import json
 import sys
+import threading
+import time
+import typing
 import urllib.parse as urlparse
 
 import pandas as pd
@@ -10,15 +13,29 @@ import requests
 from alice_blue import *
 # Kite API
 from kiteconnect import KiteConnect, KiteTicker
+from kiteconnect.exceptions import NetworkException
 # Angel one API
 from smartapi import SmartConnect
 
 # IIFL API
+from Libs.Utils import settings
 from Libs.tradexcb_algo.main_broker_api import angel_helper
-from Libs.tradexcb_algo.main_broker_api import main_broker
+from Libs.tradexcb_algo.main_broker_api import main_broker, rate_limiter, order_tags
+from Libs.tradexcb_algo.main_broker_api.order_cache import OrderCache, OrderState
+from Libs.tradexcb_algo.main_broker_api.order_tags import OrderTagIndex
 
 Allcols = main_broker.Allcols
 
+# order book columns of each broker: order id, order status, variety, tag
+ORDER_BOOK_COLUMNS = {
+    'zerodha': ('order_id', 'status', 'variety', 'tag'),
+    'alice blue': ('oms_order_id', 'order_status', None, 'order_tag'),
+    'angel': ('orderid', 'status', 'variety', 'ordertag')
+}
+# errors of an order placement which may have reached the broker without an answer, the order is sent again
+# (same tag) once the order book shows it was not placed
+RETRYABLE_ORDER_ERRORS = (requests.exceptions.Timeout, requests.exceptions.ConnectionError, NetworkException)
+
 
 class All_Broker(main_broker.Broker):
     def __init__(self, **kwargs):
@@ -52,12 +69,128 @@ class All_Broker(main_broker.Broker):
         self.instruments_map = dict()
         self.Instruments = list()
         self.web_socket = None
+        self._tick_condition = threading.Condition()
+        self._ticked_tokens = set()  # tokens which ticked since the last `wait_for_ticks` call
+        self._wake_pending = False  # `wake` called since the last `wait_for_ticks` call
+        self.tick_received_at = dict()  # instrument token -> monotonic time its last tick was received
+        self.order_cache = OrderCache(ttl=settings.ORDER_CACHE_TTL)
+        self._order_stream = None  # websocket pushing the order updates of the account
+        self._order_listeners = []
+        self._tick_listeners = []
+        self.rate_limiter = rate_limiter.get_rate_limiter()
+        self.order_tags = OrderTagIndex(self.all_data_kwargs[Allcols.username.value])
+
+    def throttle(self, endpoint: str) -> float:
+        """
+        wait for the request rate limit of the account for an endpoint class (see `rate_limiter`)
+
+        :return: seconds waited
+        """
+        return self.rate_limiter.acquire(self.broker_name.lower(), self.all_data_kwargs[Allcols.username.value],
+                                         endpoint)
 
     def get_ltp(self, instrument_token):
         return self.latest_ltp[instrument_token]['ltp']
 
+    def notify_ticks(self, instrument_tokens):
+        """Mark `instrument_tokens` as ticked and wake up the strategy waiting in `wait_for_ticks`"""
+        with self._tick_condition:
+            self._ticked_tokens.update(instrument_tokens)
+            self._tick_condition.notify_all()
+
+    def wake(self):
+        """wake up the strategy waiting in `wait_for_ticks` without a tick (kept until the next call if not waiting)"""
+        with self._tick_condition:
+            self._wake_pending = True
+            self._tick_condition.notify_all()
+
+    def wait_for_ticks(self, timeout: float) -> set:
+        """
+        Block until at least one subscribed instrument ticks, `wake` is called, or `timeout` seconds elapse.
+
+        :param timeout: maximum time to wait in seconds
+        :return: set of instrument tokens which ticked since the previous call (empty on timeout)
+        """
+        with self._tick_condition:
+            if not self._ticked_tokens and not self._wake_pending:
+                self._tick_condition.wait(timeout)
+            self._wake_pending = False
+            ticked_tokens, self._ticked_tokens = self._ticked_tokens, set()
+        return ticked_tokens
+
+    def add_tick_listener(self, callback: typing.Callable[[typing.List[int]], None]):
+        """call `callback(instrument_tokens)` on every batch of ticks, before the strategy is woken up"""
+        self._tick_listeners.append(callback)
+
+    def add_order_listener(self, callback: typing.Callable[[OrderState, typing.Optional[int]], None]):
+        """
+        call `callback(order_state, instrument_token)` on every order update pushed by the broker
+        (instrument_token is None if the update does not carry it)
+        """
+        self._order_listeners.append(callback)
+
+    def on_order_update(self, order_id, status, variety=None, instrument_token=None, tag=None):
+        """order update pushed by the broker: update the order cache and notify the listeners"""
+        if order_id is None or status is None:
+            return
+        if str(status).upper() == 'UPDATE':  # modification of the order, status not changed
+            order = self.order_cache.get(order_id)
+            if order is None:
+                return
+            status = order.status
+        self.order_cache.update(order_id, status, variety, tag=tag)
+        order = self.order_cache.get(order_id)
+        for callback in self._order_listeners:
+            try:
+                callback(order, instrument_token)
+            except:
+                self.log_this(f"Error in order update listener {str(sys.exc_info())}")
+
+    def _set_order_stream_live(self, live: bool):
+        """
+        while the order stream is connected the order cache is kept up to date by the pushed updates, and the
+        order book is only downloaded as a safety net. Either way the cache is refreshed, to catch up on the
+        updates missed while disconnected.
+        """
+        self.order_cache.ttl = settings.ORDER_CACHE_TTL_STREAMING if live else settings.ORDER_CACHE_TTL
+        self.order_cache.invalidate()
+        self.log_this(f"Order updates stream {'connected' if live else 'disconnected'}", log_level="info")
+
+    def _attach_order_stream(self, kws: KiteTicker):
+        """route the order updates of a (zerodha) websocket to the order cache"""
+
+        def on_order_update(ws, data):
+            self.on_order_update(data.get('order_id'), data.get('status'), variety=data.get('variety'),
+                                 instrument_token=data.get('instrument_token'), tag=data.get('tag'))
+
+        def on_close(ws, code, reason):
+            self._set_order_stream_live(False)
+
+        kws.on_order_update = on_order_update
+        kws.on_close = on_close
+        self._order_stream = kws
+
+    def start_order_updates(self):
+        """
+        connect the order updates stream of the account (zerodha), if the account does not have one already
+        (the data feed websocket of the main broker carries its order updates)
+        """
+        if self.broker_name.lower() != 'zerodha' or self._order_stream is not None:
+            return
+
+        def on_connect(ws, response):
+            self._set_order_stream_live(True)
+
+        kws = KiteTicker(self.all_data_kwargs[Allcols.apikey.value], self.data["access_token"],
+                         self.all_data_kwargs[Allcols.username.value])
+        kws.debug = False
+        kws.on_connect = on_connect
+        self._attach_order_stream(kws)
+        kws.connect(threaded=True)
+
     def get_ltp_quote(self, instrument_token, name=None, exchange=None):
         if self.broker_name.lower() == 'zerodha':
+            self.throttle(rate_limiter.ENDPOINT_QUOTE)
             return self.broker.ltp(f"{exchange}:{name}")[f"{exchange}:{name}"]['last_price']
 
     def get_live_ticks(self):
@@ -65,7 +198,9 @@ class All_Broker(main_broker.Broker):
         if self.broker_name.lower() == 'zerodha':
             def on_ticks(ws, ticks):
                 # print(ticks)
+                received_at = time.monotonic()
                 try:
+                    ticked_tokens = []
                     for x in ticks:
                         # print("One Tick : ", x)
                         ts = x['last_trade_time']
@@ -78,6 +213,13 @@ class All_Broker(main_broker.Broker):
                         if instrument_token not in self.latest_ltp:
                             self.latest_ltp[instrument_token] = {"ltp": None}
                         self.latest_ltp[instrument_token]['ltp'] = price
+                        self.latest_ltp[instrument_token]['ltq'] = x.get('last_traded_quantity')
+                        self.tick_received_at[instrument_token] = received_at
+                        ticked_tokens.append(instrument_token)
+                    if ticked_tokens:
+                        for callback in self._tick_listeners:
+                            callback(ticked_tokens)
+                        self.notify_ticks(ticked_tokens)
                 except:
                     print(sys.exc_info())
                     self.log_this(log_message="Error in on_ticks", log_level="error")
@@ -87,6 +229,7 @@ class All_Broker(main_broker.Broker):
 
                 self.web_socket = ws
                 subs(self.instrument_list)
+                self._set_order_stream_live(True)
 
             def subs(instrument_token):
                 print(instrument_token)
@@ -100,6 +243,7 @@ class All_Broker(main_broker.Broker):
             kws.debug = False
             kws.on_ticks = on_ticks
             kws.on_connect = on_connect
+            self._attach_order_stream(kws)
             kws.connect(threaded=True)
 
             return
@@ -219,13 +363,65 @@ class All_Broker(main_broker.Broker):
                                 'stoploss' : None ,
                                 'trailing_stoploss' : None,
                                 'tag' : None }
+                       tag: tag of the logical order (see `order_tags`), a new one if None. An order is sent again
+                       with the same tag only if the order book shows the earlier send did not place it.
         :return: order_id,message
         """
+        tag = kwargs.get('tag') or self.order_tags.new_tag(kwargs['tradingsymbol'])
+        message = None
+        for attempt in range(settings.ORDER_PLACE_RETRIES + 1):
+            if self.order_tags.sent(tag):
+                order_id = self._reconcile_order(tag)
+                if order_id is not None:
+                    self.log_this(f"Order {tag} already placed, Order ID : {order_id}", log_level="info")
+                    return order_id, 'success'
+            self.order_tags.mark_sent(tag)
+            order_id, message, error = self._send_order(order_tags.broker_tag(tag), **kwargs)
+            if order_id is not None:
+                self.order_tags.acknowledged(tag, order_id)
+                return order_id, message
+            if not isinstance(error, RETRYABLE_ORDER_ERRORS):
+                break
+            self.log_this(f"Order {tag} not acknowledged, retrying ({attempt + 1}/{settings.ORDER_PLACE_RETRIES})",
+                          log_level="info")
+            time.sleep(settings.ORDER_PLACE_RETRY_DELAY)
+        return None, message
+
+    def _reconcile_order(self, tag: str) -> typing.Optional[str]:
+        """order id of an order sent before with `tag`, looked up in the order book if it was not acknowledged"""
+        order_id = self.order_tags.order_id(tag)
+        if order_id is None:
+            self.refresh_orders(force=True)
+            order = self.order_cache.find_by_tag(order_tags.broker_tag(tag))
+            if order is not None:
+                order_id = order.order_id
+                self.order_tags.acknowledged(tag, order_id)
+        return order_id
+
+    def find_tagged_order(self, tag: str) -> typing.Optional[OrderState]:
+        """
+        the order tagged `tag` in the order cache (e.g. sent before a restart of the algo). A found order is
+        known as placed from then on: placing `tag` again returns its order id instead of sending it twice.
+        """
+        order = self.order_cache.find_by_tag(order_tags.broker_tag(tag))
+        if order is not None:
+            self.order_tags.acknowledged(tag, order.order_id)
+        return order
+
+    def _send_order(self, order_tag: str, **kwargs):
+        """
+        send an order (see `place_order`) to the broker, once
+
+        :param order_tag: tag of the order at the broker
+        :return: order_id, message, error raised by the broker API (None if none)
+        """
         order_id = None
         message = 'success'
+        error = None
         tradingsymbol = kwargs['tradingsymbol']
         instrument_row = self.instrument_df[(self.instrument_df['tradingsymbol'] == kwargs['tradingsymbol']) & (
                 self.instrument_df['exchange'] == kwargs['exchange'])]
+        self.throttle(rate_limiter.ENDPOINT_ORDER)
 
         if self.broker_name.lower() == 'zerodha':
             try:
@@ -245,10 +441,11 @@ class All_Broker(main_broker.Broker):
                                                    stoploss=None if 'stoploss' not in kwargs else kwargs['stoploss'],
                                                    trailing_stoploss=None if 'trailing_stoploss' not in kwargs else
                                                    kwargs['trailing_stoploss'],
-                                                   tag=None)
+                                                   tag=order_tag)
             except:
                 order_id = None
                 message = str(sys.exc_info())
+                error = sys.exc_info()[1]
                 self.log_this(f"Error in Order Placement ")
                 self.log_this(f"{str(sys.exc_info())}")
 
@@ -276,11 +473,13 @@ class All_Broker(main_broker.Broker):
                                                        'squareoff'] is None else kwargs['squareoff'],
                                                    trailing_sl=None if 'trailing_stoploss' not in kwargs or kwargs[
                                                        'trailing_stoploss'] is None else kwargs['trailing_stoploss'],
-                                                   is_amo=False)
+                                                   is_amo=False,
+                                                   order_tag=order_tag)
                 order_id = response['data']['oms_order_id']
             except:
                 order_id = None
                 message = str(sys.exc_info())
+                error = sys.exc_info()[1]
                 self.log_this(f"Error in Order Placement")
                 self.log_this(f"{str(sys.exc_info())}")
 
@@ -312,17 +511,19 @@ class All_Broker(main_broker.Broker):
                         kwargs['trigger_price']),
                     "quantity": str(kwargs['quantity']
 
-                                    )
+                                    ),
+                    "ordertag": order_tag
                 }
                 response = self.broker.placeOrder(orderparams)
                 order_id = response
             except:
                 order_id = None
                 message = str(sys.exc_info())
+                error = sys.exc_info()[1]
                 self.log_this(f"Error in Order Placement")
                 self.log_this(f"{str(sys.exc_info())}")
 
-        return order_id, message
+        return order_id, message, error
 
     def cancel_order(self, order_id):
         """
@@ -331,14 +532,13 @@ class All_Broker(main_broker.Broker):
         :return:
         """
         message = 'success'
-        order_id = order_id
+        cancelled_order_id = order_id
         error_message = f"Error in Cancelling Order {order_id}"
+        self.throttle(rate_limiter.ENDPOINT_ORDER)
 
         if self.broker_name.lower() == 'zerodha':
             try:
-                orders_history = self.get_order_book()
-                order_row = orders_history[orders_history['order_id'].astype(str) == str(order_id)]
-                order_id = self.broker.cancel_order(variety=order_row.iloc[-1]['variety'], order_id=order_id)
+                order_id = self.broker.cancel_order(variety=self.get_cached_order(order_id).variety, order_id=order_id)
             except:
                 order_id = None
                 message = str(sys.exc_info())
@@ -347,8 +547,6 @@ class All_Broker(main_broker.Broker):
 
         elif self.broker_name.lower() == 'alice blue':
             try:
-                orders_history = self.get_order_book()
-                order_row = orders_history[orders_history['oms_order_id'].astype(str) == str(order_id)]
                 order_id = self.broker.cancel_order(order_id)
             except:
                 order_id = None
@@ -358,92 +556,72 @@ class All_Broker(main_broker.Broker):
 
         elif self.broker_name.lower() == 'angel':
             try:
-                orders_history = self.get_order_book()
-                order_row = orders_history[orders_history['orderid'] == str(order_id)]
-                variety = order_row.iloc[-1]['variety']
-                order_id = self.broker.cancelOrder(variety=variety, order_id=order_id)
+                order_id = self.broker.cancelOrder(variety=self.get_cached_order(order_id).variety, order_id=order_id)
             except:
                 order_id = None
                 message = str(sys.exc_info())
                 self.log_this(error_message)
                 self.log_this(f"{str(sys.exc_info())}")
 
+        if message == 'success':
+            self.order_cache.mark_stale(cancelled_order_id)  # status of the cancelled order has changed
         return message
 
+    def refresh_orders(self, force=False) -> bool:
+        """
+        download the order book into the order cache, if the cache is stale
+
+        :param force: download even if the cache is fresh
+        :return: True if the order book was downloaded
+        """
+        if force or self.order_cache.is_stale():
+            self.get_order_book()
+            return True
+        return False
+
+    def get_cached_order(self, order_id) -> typing.Optional[OrderState]:
+        """
+        state of an order from the order cache. An order missing from the cache (placed after the last refresh)
+        or marked stale (cancelled) downloads the order book once more.
+        """
+        refreshed = self.refresh_orders(force=self.order_cache.is_stale(order_id))
+        order = self.order_cache.get(order_id)
+        if order is None and not refreshed:
+            self.refresh_orders(force=True)
+            order = self.order_cache.get(order_id)
+        return order
+
     def get_order_status(self, order_id):
         """
 
-        :return:
+        :return: order status (the live statuses reported as 'PENDING', see `order_cache.normalize_status`), message
         """
         order_status = None
         error_message = 'Error in getting Order Status'
         message = None
 
-        if self.broker_name.lower() == 'zerodha':
-            try:
-
-                order_history = pd.DataFrame(self.broker.orders())
-                order_status = order_history[order_history['order_id'] == str(order_id)]['status'].iloc[-1]
-                # if order_status == 'OPEN':
-                #     order_status = 'PENDING'
-                try:
-                    order_status = order_status.upper()
-                    if order_status == 'OPEN':
-                        order_status = 'PENDING'
-                except (TypeError, ValueError):
-                    order_status = ""
-            except:
-                message = str(sys.exc_info())
-                self.log_this(error_message)
-                self.log_this(f"{str(sys.exc_info())}")
-
-        elif self.broker_name.lower() == 'alice blue':
-            try:
-                orders = self.broker.get_order_history()
-                order_history = pd.DataFrame(orders['data']['pending_orders'] + orders['data']['completed_orders'])
-                order_status = \
-                    order_history[order_history['oms_order_id'].astype(str) == str(order_id)]['order_status'].iloc[-1]
-                if order_status.lower() == 'open':
-                    order_status = 'pending'
-                # if order_status in ['cancelled', 'rejected', 'complete', 'pending']:
-                #     order_status = order_status.upper()
-                try:
-                    order_status = order_status.upper()
-                except (TypeError, ValueError):
-                    order_status = ""
-            except:
-
-                message = str(sys.exc_info())
-                self.log_this(error_message)
-                self.log_this(f"{str(sys.exc_info())}")
-
-        elif self.broker_name.lower() == 'angel':
-            try:
-                order_history = pd.DataFrame(self.broker.orderBook()['data'])
-                order_status = order_history[order_history['orderid'] == order_id]['status'].iloc[-1]
-                if order_status.lower() == 'open':
-                    order_status = 'pending'
-                # if order_status in ['cancelled', 'rejected', 'complete', 'pending']:
-                #     order_status = order_status.upper()
-                try:
-                    order_status = order_status.upper()
-                except (TypeError, ValueError):
-                    order_status = ""
-            except:
-
-                message = str(sys.exc_info())
-                self.log_this(error_message)
-                self.log_this(f"{str(sys.exc_info())}")
+        try:
+            order = self.get_cached_order(order_id)
+            if order is None:
+                raise KeyError(f"Order {order_id} not found in the order book")
+            order_status = order.status
+        except:
+            message = str(sys.exc_info())
+            self.log_this(error_message)
+            self.log_this(f"{str(sys.exc_info())}")
 
         return order_status, message
 
     def get_order_book(self):
         order_history = pd.DataFrame()
         error_message = 'Error in Getting Order Book'
+        self.throttle(rate_limiter.ENDPOINT_ORDERBOOK)
+        fetched_at = time.monotonic()  # updates pushed from now on are newer than the downloaded order book
         if self.broker_name.lower() == 'zerodha':
             try:
 
                 order_history = pd.DataFrame(self.broker.orders())
+                self.order_cache.refresh(order_history, *ORDER_BOOK_COLUMNS['zerodha'], fetched_at=fetched_at)
                 return order_history
 
             except:
@@ -463,6 +641,7 @@ class All_Broker(main_broker.Broker):
                     order_history = pd.DataFrame(orders['data']['pending_orders'] + orders['data']['completed_orders'])
                 else:
                     order_history = pd.DataFrame(columns=cols)
+                self.order_cache.refresh(order_history, *ORDER_BOOK_COLUMNS['alice blue'], fetched_at=fetched_at)
                 return order_history
             except:
                 self.log_this(error_message)
@@ -471,6 +650,7 @@ class All_Broker(main_broker.Broker):
         elif self.broker_name.lower() == 'angel':
             try:
                 order_history = pd.DataFrame(self.broker.orderBook()['data'])
+                self.order_cache.refresh(order_history, *ORDER_BOOK_COLUMNS['angel'], fetched_at=fetched_at)
                 return order_history
             except:
 
@@ -503,6 +683,7 @@ class All_Broker(main_broker.Broker):
                     interval = 'minute'
                 else:
                     interval = str(timeframe) + str(timeframesuffix)
+                self.throttle(rate_limiter.ENDPOINT_HISTORICAL)
                 df = self.broker.historical_data(instrument_token=int(instrument_token), interval=interval,
                                                  from_date=from_dt, to_date=to_dt)
 
@@ -0,0 +1,153 @@
+"""
+Order-state cache of a broker account.
+
+The order book of the account is downloaded at most once per `ttl` seconds (or when invalidated) and kept
+as a dict keyed by order id, so that status checks and cancellations look an order up in O(1) instead of
+downloading and filtering the order book each time. A downloaded order book is merged into the cache: an
+order updated (pushed update / cancellation) after the download started, or already in a final status, is
+kept as cached, since the order book may be older than it.
+"""
+import threading
+import time
+import typing
+
+import pandas as pd
+
+
+# statuses of an order still live at the broker/exchange (it can still execute), all reported as 'PENDING'
+PENDING_STATUSES = frozenset(('OPEN', 'PENDING', 'TRIGGER PENDING', 'OPEN PENDING', 'VALIDATION PENDING',
+                              'PUT ORDER REQ RECEIVED', 'MODIFIED', 'MODIFY PENDING', 'MODIFY VALIDATION PENDING',
+                              'AMO REQ RECEIVED', 'CANCEL PENDING'))
+
+
+# statuses after which an order does not change any more
+FINAL_STATUSES = frozenset(('COMPLETE', 'CANCELLED', 'REJECTED'))
+
+
+class OrderState(typing.NamedTuple):
+    order_id: str
+    status: str  # normalized: upper case, the live statuses (`PENDING_STATUSES`) reported as 'PENDING'
+    variety: typing.Optional[str] = None
+    tag: typing.Optional[str] = None  # tag of the order at the broker (see `order_tags.broker_tag`)
+
+
+def normalize_status(status) -> str:
+    try:
+        status = status.upper()
+    except (TypeError, ValueError, AttributeError):
+        return ""
+    return 'PENDING' if status in PENDING_STATUSES else status
+
+
+class OrderCache:
+    """
+    orders of one account, keyed by order id
+
+    :param ttl: seconds after which the cached order book is stale
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._orders: typing.Dict[str, OrderState] = {}
+        self._tags: typing.Dict[str, str] = {}  # broker tag -> order id
+        self._updated_at: typing.Dict[str, float] = {}  # order id -> monotonic time of its last `update`
+        self._stale: typing.Dict[str, float] = {}  # order id -> monotonic time it was marked stale
+        self._refreshed_at = None  # monotonic time of the last refresh, None if never / invalidated
+        self._invalidated_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._orders)
+
+    def is_stale(self, order_id=None) -> bool:
+        """
+        :param order_id: also stale if this order is marked stale (`mark_stale`)
+        """
+        refreshed_at = self._refreshed_at
+        return (refreshed_at is None or time.monotonic() - refreshed_at >= self.ttl or
+                (order_id is not None and str(order_id) in self._stale))
+
+    def invalidate(self):
+        """mark the cache stale, the next lookup downloads the order book again"""
+        with self._lock:
+            self._refreshed_at = None
+            self._invalidated_at = time.monotonic()
+
+    def mark_stale(self, order_id):
+        """the state of one order has changed at the broker (e.g. cancelled), looking it up downloads the order book"""
+        with self._lock:
+            self._stale[str(order_id)] = time.monotonic()
+
+    def refresh(self, order_book: pd.DataFrame, id_column: str, status_column: str,
+                variety_column: typing.Optional[str] = None, tag_column: typing.Optional[str] = None,
+                fetched_at: typing.Optional[float] = None):
+        """
+        merge the rows of `order_book` into the cached orders (the last row wins for repeated order ids).
+        Orders updated after `fetched_at` or in a final status are kept as cached, orders missing from the
+        order book are dropped unless updated after `fetched_at` (placed after the download started).
+
+        :param order_book: order book of the account, as returned by the broker
+        :param id_column: column of the order id
+        :param status_column: column of the order status
+        :param variety_column: column of the order variety (if the broker has one)
+        :param tag_column: column of the order tag
+        :param fetched_at: monotonic time the download of `order_book` started (default now)
+        """
+        if fetched_at is None:
+            fetched_at = time.monotonic()
+        downloaded = {}
+        if id_column in order_book.columns and status_column in order_book.columns:
+            varieties = order_book[variety_column] if variety_column in order_book.columns else [None] * len(order_book)
+            order_tags = order_book[tag_column] if tag_column in order_book.columns else [None] * len(order_book)
+            for order_id, status, variety, tag in zip(order_book[id_column], order_book[status_column], varieties,
+                                                      order_tags):
+                order_id = str(order_id)
+                tag = tag if isinstance(tag, str) and tag else None
+                downloaded[order_id] = OrderState(order_id, normalize_status(status), variety, tag)
+        with self._lock:
+            orders = {}
+            for order_id, order in downloaded.items():
+                cached = self._orders.get(order_id)
+                if cached is not None and (self._updated_at.get(order_id, fetched_at) > fetched_at or
+                                           (cached.status in FINAL_STATUSES and order.status not in FINAL_STATUSES)):
+                    order = cached._replace(variety=cached.variety or order.variety, tag=cached.tag or order.tag)
+                orders[order_id] = order
+            for order_id, cached in self._orders.items():
+                if order_id not in orders and self._updated_at.get(order_id, fetched_at) > fetched_at:
+                    orders[order_id] = cached
+            self._orders = orders
+            self._tags = {order.tag: order_id for order_id, order in orders.items() if order.tag is not None}
+            self._updated_at = {order_id: updated_at for order_id, updated_at in self._updated_at.items()
+                                if updated_at > fetched_at}
+            self._stale = {order_id: marked_at for order_id, marked_at in self._stale.items()
+                           if marked_at > fetched_at}
+            if self._invalidated_at < fetched_at:
+                self._refreshed_at = fetched_at
+
+    def update(self, order_id, status, variety: typing.Optional[str] = None, tag: typing.Optional[str] = None):
+        """
+        update the state of a single order (e.g. from an order update pushed by the broker). An order in a final
+        status keeps it, updates may arrive out of order.
+        """
+        order_id = str(order_id)
+        status = normalize_status(status)
+        with self._lock:
+            previous = self._orders.get(order_id)
+            if previous is not None:
+                variety = variety or previous.variety
+                tag = tag or previous.tag
+                if previous.status in FINAL_STATUSES and status not in FINAL_STATUSES:
+                    status = previous.status
+            self._orders[order_id] = OrderState(order_id, status, variety, tag or None)
+            self._updated_at[order_id] = time.monotonic()
+            self._stale.pop(order_id, None)
+            if tag:
+                self._tags[tag] = order_id
+
+    def get(self, order_id) -> typing.Optional[OrderState]:
+        return self._orders.get(str(order_id))
+
+    def find_by_tag(self, tag: str) -> typing.Optional[OrderState]:
+        """order sent with the broker tag `tag`"""
+        order_id = self._tags.get(tag)
+        return None if order_id is None else self._orders.get(order_id)
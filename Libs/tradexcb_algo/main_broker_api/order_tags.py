@@ -0,0 +1,63 @@
+"""
+Idempotent order tags of a broker account.
+
+Every logical order gets a unique tag `<epoch microsecs>_<tradingsymbol>_<username>`
+(e.g. 1646844654123456_NIFTY22JULFUT_ABC) when it is first placed. The time is in microseconds so that an algo
+process restarted right away (see `state_journal`) does not hand out the tags of the orders sent before.
+The brokers limit the tag they store with the order (kite: 20 alphanumeric characters), so the order is sent
+with `broker_tag(tag)`, a digest of the tag, as its kite `tag` / alice blue `order_tag` / angel `ordertag` and
+found back in the order book by it.
+
+`OrderTagIndex` keeps tag -> order id of the orders sent. A send failing without an answer (timeout, dropped
+connection) may still have reached the exchange, so before sending an order with the same tag again the
+order book is checked for the broker tag (`All_Broker.place_order`): a logical order is placed at most once.
+"""
+import hashlib
+import threading
+import time
+import typing
+
+BROKER_TAG_LENGTH = 20  # characters
+
+
+def broker_tag(tag: str) -> str:
+    """tag sent to the broker for the order tagged `tag` (hex digest, fits the tag limits of all the brokers)"""
+    return hashlib.blake2b(tag.encode(), digest_size=BROKER_TAG_LENGTH // 2).hexdigest()
+
+
+class OrderTagIndex:
+    """order tags of an account: tag -> order id (None while the order was sent but not acknowledged)"""
+
+    def __init__(self, username: str):
+        self.username = username
+        self._order_ids: typing.Dict[str, typing.Optional[str]] = {}
+        self._new_tags: typing.Set[str] = set()  # tags handed out, not sent yet
+        self._lock = threading.Lock()
+
+    def new_tag(self, tradingsymbol: str) -> str:
+        """unique tag of a new logical order of `tradingsymbol` (suffixed if another order took it already)"""
+        tag = f"{time.time_ns() // 1000}_{tradingsymbol}_{self.username}"
+        with self._lock:
+            unique_tag, count = tag, 1
+            while unique_tag in self._order_ids or unique_tag in self._new_tags:
+                count += 1
+                unique_tag = f"{tag}_{count}"
+            self._new_tags.add(unique_tag)
+        return unique_tag
+
+    def sent(self, tag: str) -> bool:
+        """:return: True if an order tagged `tag` was sent before (acknowledged or not)"""
+        return tag in self._order_ids
+
+    def mark_sent(self, tag: str):
+        with self._lock:
+            self._new_tags.discard(tag)
+            self._order_ids.setdefault(tag, None)
+
+    def order_id(self, tag: str) -> typing.Optional[str]:
+        """order id of the order tagged `tag`, None if it was not acknowledged / not sent"""
+        return self._order_ids.get(tag)
+
+    def acknowledged(self, tag: str, order_id):
+        with self._lock:
+            self._order_ids[tag] = str(order_id)
@@ -0,0 +1,164 @@
+"""
+Request rate limits of the broker REST APIs, shared by all the processes of the app.
+
+Calls are limited per (broker, account, endpoint class) with token buckets (`settings.RATE_LIMITS`, requests
+per second and burst). The buckets live in a small local service (a multiprocessing manager listening on
+`settings.RATE_LIMITER_ADDRESS`) hosted by the first process needing it, usually the UI, so the algo
+processes of all the shards and the UI count their calls against the same buckets.
+
+A call is never failed by the limiter: it reserves the next free slot of its bucket (GCRA, one round trip
+to the service) and sleeps until then, so the calls of a bucket are sent in the order they were queued.
+The time waited is returned and recorded in the latency histograms (stage `rate_limit_wait`). If the
+service can not be reached the limits are applied per process until it can be again.
+"""
+import sys
+import threading
+import time
+import typing
+from multiprocessing.managers import BaseManager
+
+from Libs.Utils import exception_handler, settings
+from Libs.tradexcb_algo.latency import LatencyRecorder, STAGE_RATE_LIMIT_WAIT
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+ENDPOINT_ORDER = 'order'  # place/modify/cancel order
+ENDPOINT_ORDERBOOK = 'orderbook'  # order book/history
+ENDPOINT_HISTORICAL = 'historical'  # historical candles
+ENDPOINT_QUOTE = 'quote'  # ltp/quote
+ENDPOINTS = (ENDPOINT_ORDER, ENDPOINT_ORDERBOOK, ENDPOINT_HISTORICAL, ENDPOINT_QUOTE)
+
+Key = typing.Tuple[str, str, str]  # broker, account, endpoint
+
+
+class TokenBuckets:
+    """
+    token buckets as theoretical arrival times (GCRA): a bucket of `burst` tokens refilled at `rate` per second
+    lets `burst` calls through at once, then one every 1/`rate` seconds
+    """
+
+    def __init__(self):
+        self._arrival: typing.Dict[Key, float] = {}  # key -> monotonic time the bucket is full again
+        self._lock = threading.Lock()
+
+    def reserve(self, key: Key, rate: float, burst: int) -> float:
+        """
+        take the next token of the bucket `key`
+
+        :return: seconds to wait before the call may be sent (0 if a token is available now)
+        """
+        interval = 1.0 / rate
+        now = time.monotonic()
+        with self._lock:
+            arrival = max(self._arrival.get(key, now), now)
+            self._arrival[key] = arrival + interval
+        return max(arrival - (burst - 1) * interval - now, 0.0)
+
+
+_service_buckets = TokenBuckets()  # buckets of the service, in the process hosting it
+
+
+def _get_service_buckets() -> TokenBuckets:
+    return _service_buckets
+
+
+class _LimiterManager(BaseManager):
+    pass
+
+
+_LimiterManager.register('buckets', callable=_get_service_buckets)
+
+
+def start_service(address: typing.Tuple[str, int] = settings.RATE_LIMITER_ADDRESS) -> bool:
+    """
+    host the rate limiter service in this process (background thread)
+
+    :return: False if it could not be started, i.e. another process is already hosting it
+    """
+    try:
+        server = _LimiterManager(address=address, authkey=settings.RATE_LIMITER_AUTHKEY).get_server()
+    except OSError:  # address in use
+        return False
+    threading.Thread(target=server.serve_forever, name='RateLimiterService', daemon=True).start()
+    logger.info(f"Rate limiter service started on {address}")
+    return True
+
+
+class RateLimiter:
+    """client of the rate limiter service, safe to use from any thread"""
+
+    def __init__(self, address: typing.Tuple[str, int] = settings.RATE_LIMITER_ADDRESS,
+                 limits: typing.Dict[str, typing.Dict[str, typing.Tuple[float, int]]] = None):
+        self.address = address
+        self.limits = settings.RATE_LIMITS if limits is None else limits
+        self.latency = LatencyRecorder()
+        self._local_buckets = TokenBuckets()  # used while the service can not be reached
+        self._buckets = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def limit(self, broker_name: str, endpoint: str) -> typing.Tuple[float, int]:
+        """:return: requests per second, burst"""
+        return self.limits.get(broker_name, {}).get(endpoint, settings.RATE_LIMIT_DEFAULT)
+
+    def _connect(self):
+        manager = _LimiterManager(address=self.address, authkey=settings.RATE_LIMITER_AUTHKEY)
+        try:
+            manager.connect()
+        except OSError:  # not running yet, host it here (unless another process just did)
+            start_service(self.address)
+            manager.connect()
+        return manager.buckets()
+
+    def _service(self):
+        """proxy of the service buckets, None while it can not be reached (retried every few seconds)"""
+        with self._lock:
+            if self._buckets is None and time.monotonic() >= self._retry_at:
+                try:
+                    self._buckets = self._connect()
+                except Exception:
+                    self._retry_at = time.monotonic() + settings.RATE_LIMITER_RETRY_INTERVAL
+                    logger.warning(f"Rate limiter service not reachable, limiting the calls of this process only "
+                                   f"{sys.exc_info()}")
+            return self._buckets
+
+    def _reserve(self, key: Key, rate: float, burst: int) -> float:
+        buckets = self._service()
+        if buckets is not None:
+            try:
+                return buckets.reserve(key, rate, burst)
+            except Exception:
+                logger.warning(f"Rate limiter service lost {sys.exc_info()}")
+                with self._lock:
+                    self._buckets = None
+        return self._local_buckets.reserve(key, rate, burst)
+
+    def acquire(self, broker_name: str, account: str, endpoint: str) -> float:
+        """
+        block until a call to `endpoint` of the account may be sent
+
+        :return: seconds waited
+        """
+        rate, burst = self.limit(broker_name, endpoint)
+        if not rate:
+            return 0.0
+        wait = self._reserve((broker_name, account, endpoint), rate, burst)
+        if wait > 0:
+            time.sleep(wait)
+            if wait >= settings.RATE_LIMIT_WAIT_WARNING:
+                logger.warning(f"{broker_name} {endpoint} call of {account} waited {wait:.3f}s for the rate limit")
+        self.latency.record(STAGE_RATE_LIMIT_WAIT, wait, broker_name, account)
+        return wait
+
+
+_rate_limiter: typing.Optional[RateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """rate limiter of this process"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
@@ -1,20 +1,31 @@
 import multiprocessing
+import queue
 import sys
+import threading
 import time
 import typing
 import warnings
-from datetime import datetime, timedelta
+from datetime import datetime
+from functools import partial
 
-import numpy as np
-import openpyxl
 import pandas as pd
 from pandas.core.common import SettingWithCopyWarning
 
 from Libs.Files import handle_user_details
-from Libs.Files.TradingSymbolMapping import StrategiesColumn
-from Libs.Storage import app_data
-from Libs.Utils import settings, exception_handler, calculations
+from Libs.Files.positions_snapshot import PositionsSnapshotWriter
+from Libs.Utils import settings, exception_handler
+from .main_broker_api import rate_limiter
 from .main_broker_api.All_Broker import All_Broker
+from .instrument_state import STATUS_IDLE
+from .loop_profiler import LoopProfiler, NULL_PROFILER, WAIT
+from .market_session import MarketSession, PRE_OPEN, SQUARE_OFF, CLOSE
+from .orderbook_delta import OrderbookDeltaPublisher
+from .paper_exchange import PaperExchange, PaperBroker
+from .row_loader import StrategyRowLoader, ReloadResult
+from .sharding import ShardSpec, shard_path, check_kite_websockets
+from .square_off import SQUARE_OFF_ALL
+from .state_journal import StateJournal
+from .strategy_engine import StrategyEngine
 
 pd.set_option('expand_frame_repr', False)
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -22,70 +33,20 @@ warnings.simplefilter(action='ignore', category=SettingWithCopyWarning)
 
 logger = exception_handler.getAlgoLogger(__name__)
 
-nine_fifteen = datetime.now().replace(hour=9, minute=15, second=0, microsecond=0)
-three_thirty = datetime.now().replace(hour=15, minute=30, second=0, microsecond=0)
-nine_sixteen = datetime.now().replace(hour=9, minute=16, second=0, microsecond=0)
-to_dt = datetime.now()
-from_dt = to_dt - timedelta(days=5)
-to_dt = to_dt.strftime('%Y-%m-%d')
 datetime_format = '%Y-%m-%d %H:%M:%S'
 
 
 # ------------ function to add new rows in run-time ------------
-def add_rows(old_instruments_df_dict, main_broker, users_df_dict,
-             first_run=False):
-    # Workbook
-    wb = openpyxl.load_workbook(settings.DATA_FILES['tradexcb_excel_file'])
-    instrument_sheet = wb['Sheet1']
-    # load openpyexcel sheet to dataframe
-    instruments_df = pd.DataFrame(instrument_sheet.values)
-    columns = instruments_df.iloc[0]
-    instruments_df.columns = columns
-    instruments_df = instruments_df.iloc[1:]
-    instruments_df = instruments_df.astype(StrategiesColumn.tradexcb_numeric_columns)
-
-    # instruments_df = instrument_sheet.range('A1').options(pd.DataFrame, header=1, index=False,
-    #                                                       expand='table').value
-
-    instruments_df['running_trend'] = None
-    instruments_df['multiplier'] = None
-    instruments_df['entry_price'] = None
-    instruments_df['entry_time'] = None
-    instruments_df['exit_price'] = None
-    instruments_df['exit_time'] = None
-    instruments_df['status'] = 0
-    instruments_df['target_price'] = None
-    instruments_df['sl_price'] = None
-    instruments_df['Row_Type'] = 'T'
-    instruments_df['profit'] = None
-    instruments_df['Trend'] = None
-    instruments_df['run_done'] = 0
-    instruments_df['vwap_last'] = 0
-    instruments_df['quantity'] = 1
-    instruments_df['close_positions'] = 0
-    instruments_df_dict = instruments_df.to_dict('index')
-    for each_instrument in instruments_df_dict:
-        this_instrument = instruments_df_dict[each_instrument]
-        this_instrument['entry_order_ids'] = {
-            x: {'order_id': None, 'order_status': None, 'broker': users_df_dict[x]['broker']} for x in users_df_dict}
-        this_instrument['sl_order_ids'] = {
-            x: {'order_id': None, 'order_status': None, 'broker': users_df_dict[x]['broker']} for x in users_df_dict}
-        this_instrument['target_order_ids'] = {
-            x: {'order_id': None, 'order_status': None, 'broker': users_df_dict[x]['broker']} for x in users_df_dict}
-
-        row = All_Broker.instrument_df[
-            (All_Broker.instrument_df['tradingsymbol'] == this_instrument['instrument'])]
-        this_instrument['instrument_row'] = row
-        this_instrument['instrument_token'] = int(row.iloc[-1]['instrument_token'])
-        this_instrument['tradingsymbol'] = row.iloc[-1]['tradingsymbol']
-        this_instrument['lot_size'] = int(row.iloc[-1]['lot_size'])
-        this_instrument['order'] = None
-        this_instrument['tick_size'] = row.iloc[-1]['tick_size']
-        this_instrument['quantity'] = this_instrument['quantity'] * this_instrument['lot_size']
-        this_instrument['exchange_token'] = row.iloc[-1]['exchange_token']
-    instrument_list = [instruments_df_dict[x]['instrument_token'] for x in instruments_df_dict]
-
-    main_broker.instrument_list = instrument_list
+def add_rows(engine: StrategyEngine, row_loader: StrategyRowLoader, first_run=False) -> ReloadResult:
+    """
+    Apply the changes of the strategy workbook (rows of this shard) to the engine's state store,
+    only the added/edited/deleted rows are looked up and only new instruments are subscribed
+
+    :return: keys of the added/updated/retired rows
+    """
+    main_broker = engine.main_broker
+    result = row_loader.reload()
+    main_broker.instrument_list = list(engine.store.token_index)
     if first_run:
         try:
             main_broker.get_live_ticks()
@@ -96,33 +57,200 @@ def add_rows(old_instruments_df_dict, main_broker, users_df_dict,
             logger.error(f"Error in getting live ticks {sys.exc_info()}", exc_info=True)
             raise ValueError(f"Error in getting live ticks {sys.exc_info()}")
 
-    for each_instrument in instrument_list:
+    for each_instrument in result.new_tokens:
         if each_instrument not in main_broker.latest_ltp:
             main_broker.latest_ltp[each_instrument] = {'ltp': None}
-    main_broker.subscribe_instrument(main_broker.instrument_list)
+    if result.new_tokens:
+        main_broker.subscribe_instrument(result.new_tokens)
 
-    for each_key in instruments_df_dict:
-        if each_key not in old_instruments_df_dict:
-            old_instruments_df_dict[each_key] = dict(instruments_df_dict[each_key])
-
-    return old_instruments_df_dict, instruments_df
+    return result
 
 
 # ------------ xxx end xxx ------------
 
-def main(manager_dict: dict, cancel_orders_queue: multiprocessing.Queue):
+def export_positions(engine: StrategyEngine, shard: ShardSpec):
+    """write the positions of all users to the positions csv file (of the shard)"""
+    try:
+        # PNL of all users by the lot executed by the user
+        engine.ledger.to_frame().to_csv(shard_path(settings.DATA_FILES.get('POSITIONS_FILE_PATH'), shard.index))
+    except Exception:
+        logger.error(f"Error in exporting the positions {sys.exc_info()}", exc_info=True)
+
+
+def housekeeping(engine: StrategyEngine, positions_writer: PositionsSnapshotWriter,
+                 orderbook_publisher: OrderbookDeltaPublisher, manager_dict, profiler=NULL_PROFILER) -> bool:
+    """
+    Slow-cadence work of the strategy loop, kept out of the tick path:
+    positions snapshot of all users, order cache refresh of all users, the orderbook export and the latency
+    histograms for the UI.
+
+    :return: False if the algo has to stop
+    """
+    process_name = 'Housekeeping'
+    users_df_dict = engine.users_df_dict
+    try:
+        with profiler.phase('positions_snapshot'):
+            engine.ledger.write_snapshot(positions_writer)  # read by the positions table of the UI
+    except Exception as e:
+        logger.critical(f"{sys.exc_info()}", exc_info=True)
+        manager_dict['algo_error'] = f"{process_name} failed, Error : {sys.exc_info()}"
+        manager_dict['algo_running'] = False
+        return False
+
+    for each_user in users_df_dict:
+        try:
+            this_user = users_df_dict[each_user]
+            if this_user['broker'] is None:
+                continue
+            # downloads the order book only if the order cache is stale (order updates stream disconnected etc.)
+            with profiler.phase('order_refresh'):
+                this_user['broker'].refresh_orders()
+        except Exception as e:
+            logger.critical(f"{sys.exc_info()}", exc_info=True)
+            manager_dict['algo_error'] = f"{process_name} failed, Error : {sys.exc_info()}"
+            manager_dict['algo_running'] = False
+            return False
+
+    # ------- orderbook of all the clients, only the changed rows are sent to the UI ----------
+    if manager_dict.get('orderbook_resync'):
+        manager_dict['orderbook_resync'] = False
+        orderbook_publisher.request_resync()
+    with profiler.phase('orderbook_export'):
+        orderbook_publisher.publish(orderbook_rows(engine))
+    manager_dict['latency'] = {**engine.latency.export(), **rate_limiter.get_rate_limiter().latency.export()}
+    for each_user, mtm in engine.ledger.profit_by_user().items():
+        engine.risk.update_mtm(each_user, mtm)  # for the max_loss check of the entries
+    return True
+
+
+def pre_market(engine: StrategyEngine, row_loader: StrategyRowLoader):
+    """tasks of the pre-open session: the day's edits of the strategy table, fresh order books, entries allowed"""
+    engine.entries_halted = False  # a square off of all the positions halts the entries until the next session
+    try:
+        add_rows(engine, row_loader)
+    except Exception:
+        logger.error(f"Error in reloading the strategy rows {sys.exc_info()}", exc_info=True)
+    for each_user, this_user in engine.users_df_dict.items():
+        if this_user['broker'] is not None:
+            this_user['broker'].refresh_orders(force=True)
+
+
+def run_session_events(engine: StrategyEngine, session: MarketSession, row_loader: StrategyRowLoader,
+                       shard: ShardSpec) -> bool:
+    """
+    run the market session events passed since the last call (see `market_session`)
+
+    :return: False if the algo has to stop (market closed)
+    """
+    for event in session.due():
+        logger.info(f"Market session event : {event}")
+        if event == PRE_OPEN:
+            pre_market(engine, row_loader)
+        elif event == SQUARE_OFF:
+            logger.info("Squaring off all the positions at the square off time")
+            engine.square_off_all()
+        elif event == CLOSE:
+            if settings.SESSION_STOP_AFTER_CLOSE:
+                return False
+            export_positions(engine, shard)
+    return True
+
+
+def forward_commands(cancel_orders_queue: multiprocessing.Queue, commands: queue.Queue,
+                     wake: typing.Callable[[], None]):
+    """
+    move the row keys / commands put by the UI on the cancel orders queue to `commands` as they come, waking up
+    the strategy loop so that they are handled right away (runs on its own thread)
+    """
+    while True:
+        try:
+            command = cancel_orders_queue.get()
+        except (EOFError, OSError):  # queue closed, the UI is gone
+            return
+        commands.put(command)
+        wake()
+
+
+def publish_square_off(engine: StrategyEngine, manager_dict: dict, shard: ShardSpec):
+    """send the report of a square off of all the positions to the UI, once all its exits are over"""
+    report = engine.square_off
+    if report is None or not report.done or report.published:
+        return
+    report.published = True
+    manager_dict['square_off_report'] = report.export()
+    logger.info(f"Square off of all the positions done in {report.elapsed * 1000:.0f} ms, "
+                f"{len(report.records)} orders/positions")
+    try:
+        report.to_frame().to_csv(shard_path(settings.DATA_FILES.get('SQUARE_OFF_REPORT_PATH'), shard.index),
+                                 index=False)
+    except Exception:
+        logger.error(f"Error in exporting the square off report {sys.exc_info()}", exc_info=True)
+
+
+def orderbook_rows(engine: StrategyEngine) -> typing.Dict[typing.Any, typing.Dict[str, typing.Any]]:
+    """
+    rows of the OMS table (orderbook of all the clients), keyed by instrument_df_key
+    (will be used to reference in close positions)
+    """
+    users_df_dict = engine.users_df_dict
+    store = engine.store
+    state = store.state
+    entry_status = store.order_status('entry')
+    today = datetime.now().date()
+    rows = dict()
+    for idx, info in enumerate(store.info):
+        if not state['active'][idx] and state['status'][idx] == STATUS_IDLE:
+            continue  # row deleted/replaced in the strategy table
+        row_data = store.as_dict(idx)
+        entry_time = row_data['entry_time']
+        if isinstance(entry_time, datetime):
+            if entry_time.date() != today:
+                continue
+            entry_time = entry_time.strftime("%H:%M:%S")
+        exit_time = row_data['exit_time']
+        if isinstance(exit_time, datetime):
+            exit_time = exit_time.strftime("%H:%M:%S")
+
+        # concatenate order status for all users
+        order_status = ""
+        for each_user, col in store.user_index.items():
+            order_status += f"{users_df_dict[each_user]['Name']} : {entry_status[idx, col]}\n"
+
+        rows[info.key] = {"Instrument": row_data['tradingsymbol'],
+                          "Entry Price": row_data['entry_price'],
+                          "Entry Time": entry_time,
+                          "Exit Price": row_data['exit_price'],
+                          "Exit Time": exit_time,
+                          "Order Type": row_data['order_type'],
+                          "Quantity": row_data['quantity'],
+                          "Product Type": row_data['product_type'],
+                          "Stoploss": row_data['stoploss'],
+                          "Target": row_data['target'],
+                          "Order Status": order_status,
+                          "instrument_df_key": info.key}
+    return rows
+
+
+def main(manager_dict: dict, cancel_orders_queue: multiprocessing.Queue, orderbook_queue: multiprocessing.Queue,
+         shard: ShardSpec = ShardSpec()):
     """
-    Main function to run the strategy
+    Main function to run the strategy (for the rows of `shard`)
 
     :param cancel_orders_queue: storing all keys for instruments_df_dict
         (rows for which close_position has to be made 1)
+    :param orderbook_queue: orderbook changes for the UI (see `orderbook_delta`)
+    :param shard: the rows this process trades, when the strategy runs in multiple processes (see `sharding`)
 
     :param manager_dict: Dictionary to handle the shared data
     -> manager_dict keys:
         - 'algo_running': bool to check if the algo is running
         - 'algo_error': to store the algo error message
         - 'force_stop': Boolean to stop the strategy algo (don't modify inside algo)
-        - 'orderbook_data': to store the orderbook data
+        - 'orderbook_resync': set by the UI to get the full orderbook in the next orderbook message
+        - 'latency': latency histograms of the process (see `latency`)
+        - 'profiling': time the phases of the strategy loop (default `settings.STRATEGY_PROFILING`)
+        - 'loop_profile': rolling statistics of the phases, when profiling
+        - 'square_off_report': report of the last square off of all the positions (see `square_off`)
     :return: None
     """
     # Variables
@@ -130,8 +258,6 @@ def main(manager_dict: dict, cancel_orders_queue: multiprocessing.Queue):
     users_df_dict = None
     main_broker: typing.Union[None, All_Broker] = None
     users_df = None
-    instruments_df: typing.Union[None, pd.DataFrame] = None
-    # instruments_df_dict = None
 
     # DO login for All users
     process_name = 'User Login Process'
@@ -149,6 +275,13 @@ def main(manager_dict: dict, cancel_orders_queue: multiprocessing.Queue):
         # users_df = users_df.tail(1)
         users_df['broker'] = None
         users_df_dict = users_df.to_dict('index')
+        websockets_error = check_kite_websockets(list(users_df_dict.values()), shard.count,
+                                                 order_streams=not (paper_trade == 1 and settings.PAPER_EXCHANGE))
+        if websockets_error is not None:
+            logger.critical(websockets_error)
+            manager_dict['algo_error'] = f"{process_name} failed, {websockets_error}"
+            manager_dict['algo_running'] = False
+            return
         for each_key in users_df_dict:
             try:
                 this_user = users_df_dict[each_key]
@@ -176,614 +309,184 @@ def main(manager_dict: dict, cancel_orders_queue: multiprocessing.Queue):
         manager_dict['algo_running'] = False
         manager_dict['algo_error'] = f"{process_name} failed, Error : {sys.exc_info()}"
         return
+    paper_exchange: typing.Optional[PaperExchange] = None
+    if paper_trade == 1 and settings.PAPER_EXCHANGE:
+        # orders of all the users go to the simulated exchange, through the same code as live trading
+        paper_exchange = PaperExchange(main_broker.latest_ltp, All_Broker.instrument_df)
+        main_broker.add_tick_listener(paper_exchange.on_ticks)
+        for each_user, this_user in users_df_dict.items():
+            if this_user['broker'] is not None:
+                this_user['broker'] = PaperBroker(paper_exchange, each_user)
+        paper_trade = 0
+        logger.info("Paper trading on the simulated exchange")
+
     process_name = 'Getting All Instruments to Trade'
     manager_dict['update_rows'] = 0  # flag variable to check if any row has been updated (controlled externally)
-    instruments_df_dict = {}
+    engine = StrategyEngine(users_df_dict, main_broker, paper_trade, shard)
     try:
-        instruments_df_dict, instruments_df = add_rows(instruments_df_dict, main_broker,
-                                                       users_df_dict,
-                                                       first_run=True)
+        positions_writer = PositionsSnapshotWriter(shard_path(settings.DATA_FILES.get('POSITIONS_SNAPSHOT_PATH'),
+                                                              shard.index))
+        orderbook_publisher = OrderbookDeltaPublisher(orderbook_queue, shard_index=shard.index)
+        row_loader = StrategyRowLoader(engine, shard, All_Broker.instrument_df)
+        add_rows(engine, row_loader, first_run=True)
+
+        def wake_on_order_update(each_user, order, instrument_token):
+            """evaluate the rows of the instrument as soon as one of its orders changes"""
+            engine.latency.order_status(each_user, order.order_id, order.status)
+            if instrument_token is not None:
+                main_broker.notify_ticks([instrument_token])
+
+        for each_user, this_user in users_df_dict.items():
+            if this_user['broker'] is not None:
+                this_user['broker'].add_order_listener(partial(wake_on_order_update, each_user))
+                this_user['broker'].start_order_updates()
+        engine.exits.wake = main_broker.wake  # advance the exits as their broker calls finish
+        commands = queue.Queue()  # row keys to close / SQUARE_OFF_ALL, from the UI
+        threading.Thread(target=forward_commands, args=(cancel_orders_queue, commands, engine.exits.wake),
+                         name='CommandListener', daemon=True).start()
     except Exception as e:
         logger.critical(f"Error in {process_name}", exc_info=True)
         manager_dict['algo_running'] = False
         manager_dict['algo_error'] = f"{process_name} failed, Error : {sys.exc_info()}, {e.__str__()}"
         return
+
+    process_name = 'Restoring the Strategy State'
+    journal: typing.Optional[StateJournal] = None
+    if settings.STATE_JOURNAL and paper_exchange is None:  # orders of the simulated exchange do not outlive it
+        try:
+            # state of the rows before the algo was restarted (the process is killed on restart)
+            journal = StateJournal(shard_path(settings.DATA_FILES.get('STATE_JOURNAL_PATH'), shard.index),
+                                   paper_trade=paper_trade)
+            engine.journal = journal
+            checkpoint = journal.load()
+            if checkpoint:
+                engine.restore(checkpoint)
+        except Exception as e:
+            logger.critical(f"Error in {process_name}", exc_info=True)
+            manager_dict['algo_running'] = False
+            manager_dict['algo_error'] = f"{process_name} failed, Error : {sys.exc_info()}, {e.__str__()}"
+            return
     logger.info(f"Starting Strategy")
-    final_df = pd.DataFrame(columns=list(instruments_df.columns) + ['ltp', 'tradingsymbol'])
     logger.info(f"{main_broker.latest_ltp}")
 
+    store = engine.store
+    tick_driven = manager_dict.get('tick_driven', settings.STRATEGY_TICK_DRIVEN)
+    housekeeping_interval = settings.STRATEGY_HOUSEKEEPING_INTERVAL
+    next_housekeeping = 0.0  # monotonic time of the next housekeeping pass (0 -> run on the first pass)
+    profiler = LoopProfiler() if manager_dict.get('profiling', settings.STRATEGY_PROFILING) else NULL_PROFILER
+    session = MarketSession()
+    market_closed = False  # the algo stopped at the close of the market
+
     while manager_dict['force_stop'] is False:
-        time.sleep(1)  # wait for 1 second/iteration
+        profiler.end_cycle()
+        if profiler.report_due():
+            logger.info(profiler.report())
+            manager_dict['loop_profile'] = profiler.summary()
+        with profiler.phase(WAIT):
+            if not session.is_trading():
+                # sleep until the next session event, woken up only by the exits in progress and the commands
+                wake_at = time.monotonic() + min(session.seconds_until_next(), settings.SESSION_STOP_CHECK_INTERVAL)
+                wake_at = min(wake_at, engine.exits.next_due() or wake_at)
+                main_broker.wait_for_ticks(timeout=max(wake_at - time.monotonic(), 0))
+                ticked_tokens = set()
+            elif tick_driven:
+                # wake up as soon as any instrument ticks, but no later than the next housekeeping pass / exit step
+                wake_at = min(next_housekeeping, engine.exits.next_due() or next_housekeeping)
+                ticked_tokens = main_broker.wait_for_ticks(timeout=max(wake_at - time.monotonic(), 0))
+            else:
+                time.sleep(housekeeping_interval)
+                ticked_tokens = set()
+        profiler.start_cycle()
+
         if manager_dict['update_rows'] == 1:
             manager_dict['update_rows'] = 0
-            instruments_df_dict, instruments_df = add_rows(instruments_df_dict, main_broker,
-                                                           users_df_dict)
-            # reset final df, as new rows have been added
-            final_df = pd.DataFrame(columns=list(instruments_df.columns) + ['ltp', 'tradingsymbol'])
-
-        if datetime.now() < nine_sixteen:
-            continue
-
-        final_df = final_df[['tradingsymbol', 'exchange', 'quantity', 'multiplier', 'entry_price',
-                             'entry_time', 'exit_price', 'exit_time', 'target_price', 'sl_price', 'Row_Type',
-                             'profit', 'ltp']]
-        final_df['Trend'] = np.where(final_df['multiplier'] == 1, 'BUY', 'SELL')
-
-        final_all_user_df = pd.DataFrame()
-        for each_user in users_df_dict:
             try:
-                this_user = users_df_dict[each_user]
-                if this_user['broker'] is None:
-                    continue
-
-                no_of_lots = this_user['No of Lots']
-                final_df_temp = final_df.copy(deep=True)
-                final_df_temp['quantity'] = final_df_temp['quantity'] * no_of_lots
-                final_df_temp['profit'] = (final_df_temp['ltp'] - final_df_temp['entry_price']) * final_df_temp[
-                    'quantity'] * final_df_temp['multiplier']
-                final_df_temp['user_id'] = this_user['accountUserName']
-                final_all_user_df = final_all_user_df.append(final_df_temp, ignore_index=True)
+                with profiler.phase('row_reload'):
+                    add_rows(engine, row_loader)
             except Exception as e:
-                logger.critical(f"{sys.exc_info()}", exc_info=True)
-                manager_dict['algo_error'] = f"{process_name} failed, Error : {sys.exc_info()}"
-                manager_dict['algo_running'] = False
-                return
-
-        final_all_user_df.to_csv(
-            settings.DATA_FILES.get('POSITIONS_FILE_PATH'))  # PNL of all users by the lot executed by the user
+                # the rows loaded so far keep trading, the edit can be fixed and reloaded
+                logger.error(f"Error in reloading the strategy rows {sys.exc_info()}", exc_info=True)
+
+        if not run_session_events(engine, session, row_loader, shard):
+            logger.info("Market closed, stopping the strategy")
+            market_closed = True
+            break
+        if not session.is_trading():
+            engine.exits.step()  # exits started before the close
+            publish_square_off(engine, manager_dict, shard)
+            next_housekeeping = time.monotonic() + housekeeping_interval  # nothing to evaluate
+            continue
 
-        order_book_dict = dict()
-        for each_user in users_df_dict:
-            try:
-                this_user = users_df_dict[each_user]
-                if this_user['broker'] is None:
-                    continue
-
-                order_book: pd.DataFrame = this_user['broker'].get_order_book()
-                order_book['username'] = this_user['accountUserName']
-                if this_user['broker'].broker_name in order_book_dict:
-                    order_book_dict[this_user['broker'].broker_name].append(order_book, ignore_index=True)
-                else:
-                    order_book_dict[this_user['broker'].broker_name] = order_book
-            except Exception as e:
-                logger.critical(f"{sys.exc_info()}", exc_info=True)
-                manager_dict['algo_error'] = f"{process_name} failed, Error : {sys.exc_info()}"
-                manager_dict['algo_running'] = False
+        run_housekeeping = not tick_driven or time.monotonic() >= next_housekeeping
+        if run_housekeeping:
+            next_housekeeping = time.monotonic() + housekeeping_interval
+            if not housekeeping(engine, positions_writer, orderbook_publisher, manager_dict, profiler):
                 return
 
-        final_df = final_df[final_df['Row_Type'] != 'T']  # keep only F type rows (reason?)
-
-        for each_key in order_book_dict:
-            try:
-                order_book_dict[each_key] = list(order_book_dict[each_key].to_dict('index').values())
-            except Exception as e:
-                logger.critical(f"Error in Creating Order Book {e.__str__()}", exc_info=True)
-
-        # This contains Orderbook of all the clients
-        # ------- cannot export broker instance ----------
-        orderbook_export_data = {x: [] for x in app_data.OMS_TABLE_COLUMNS}
-        for each_key in instruments_df_dict:
-            row_data = instruments_df_dict[each_key]
-            orderbook_export_data["Instrument"].append(row_data['tradingsymbol'])
-            orderbook_export_data["Entry Price"].append(row_data['entry_price'])
-            entry_time = row_data['entry_time']
-            if isinstance(entry_time, datetime):
-                if entry_time.date() == datetime.now().date():
-                    orderbook_export_data["Entry Time"].append(entry_time.strftime("%H:%M:%S"))
-                else:
-                    continue
-            else:
-                orderbook_export_data["Entry Time"].append(entry_time)
-            orderbook_export_data["Exit Price"].append(row_data['exit_price'])
-
-            exit_time = row_data['exit_time']
-            if isinstance(exit_time, datetime):
-                orderbook_export_data["Exit Time"].append(exit_time.strftime("%H:%M:%S"))
-            else:
-                orderbook_export_data["Exit Time"].append(exit_time)
-            orderbook_export_data["Order Type"].append(row_data['order_type'])
-            orderbook_export_data["Quantity"].append(row_data['quantity'])
-            orderbook_export_data["Product Type"].append(row_data['product_type'])
-            orderbook_export_data["Stoploss"].append(row_data['stoploss'])
-            orderbook_export_data["Target"].append(row_data['target'])
-
-            # concatenate order status for all users
-            order_status = ""
-            row_order_details = row_data.get("entry_order_ids")
-            if row_order_details is not None:
-                for each_user, this_user_order_details in row_order_details.items():
-                    this_user = users_df_dict[each_user]
-                    _status = this_user_order_details["order_status"]
-                    order_status += f"{this_user['Name']} : {_status}\n"
-
-            orderbook_export_data["Order Status"].append(order_status)
-            orderbook_export_data["instrument_df_key"].append(each_key)  # will be used to reference in close positions
-
-        orderbook_export_data["Close Position?"] = [0] * len(orderbook_export_data["instrument_df_key"])
-        manager_dict['orderbook_data'] = orderbook_export_data  # pass the dictionary to the UI
-
         # --------------- look for to be closed positions ---------------
-        while True:
-            try:
-                row_key = cancel_orders_queue.get_nowait()
-                if row_key is not None:
-                    row_data = instruments_df_dict[row_key]
-                    row_data['close_positions'] = 1  # close the positions
-                    logger.debug("closing position for row_key : {}".format(row_key))
-                else:
+        close_requested = []
+        with profiler.phase('cancel_queue'):
+            while True:
+                try:
+                    row_key = commands.get_nowait()
+                    if row_key == SQUARE_OFF_ALL:
+                        logger.info("Squaring off all the positions")
+                        engine.square_off_all()
+                    elif row_key is not None:
+                        if row_key not in store:  # row of another shard
+                            continue
+                        idx = store.index_of(row_key)
+                        store.state['close_positions'][idx] = 1  # close the positions
+                        close_requested.append(idx)
+                        logger.debug("closing position for row_key : {}".format(row_key))
+                    else:
+                        break
+                except Exception as e:
                     break
-            except Exception as e:
-                break
+
+        # --------------- select the rows to evaluate in this pass ---------------
+        if run_housekeeping:
+            # all rows get evaluated once per housekeeping interval (wait_time expiry etc.)
+            row_indices = None
+        else:
+            # only the rows whose instrument just ticked, plus the rows asked to be closed right now
+            row_indices = list(dict.fromkeys(engine.rows_for_tokens(ticked_tokens) + close_requested))
+
         # --------------- run the main strategy ---------------
-        curr_date = datetime.now()
         process_name = 'Main Strategy'
-        for each_key in instruments_df_dict:
-            try:
-                this_instrument = instruments_df_dict[each_key]
-                this_instrument['transaction_type'] = this_instrument['transaction_type'].upper()
-                ltp = main_broker.latest_ltp[this_instrument['instrument_token']]['ltp']
-
-                if this_instrument['run_done'] == 1:
-                    this_instrument['run_done'] = 0
-
-                if this_instrument['run_done'] == 0 and this_instrument['status'] == 0:
-                    this_instrument['run_done'] = 1
-                    logger.info(f"Running the {process_name} for {this_instrument['tradingsymbol']}")
-                    if this_instrument['multiplier'] != 1 and this_instrument['transaction_type'].upper() == 'BUY':
-                        logger.info(f" In Buy Loop. for {this_instrument['tradingsymbol']}\n"
-                                    f"Buy Signal has been Activated for {this_instrument['tradingsymbol']}")
-                        this_instrument['status'] = 1
-                        this_instrument['multiplier'] = 1
-
-                        this_instrument['entry_price'] = calculations.get_entry_price(this_instrument['order_type'],
-                                                                                      this_instrument[
-                                                                                          'transaction_type'],
-                                                                                      ltp,
-                                                                                      this_instrument[
-                                                                                          'buy_ltp_percent'],
-                                                                                      this_instrument[
-                                                                                          'tick_size'])  # todo: ha price is replaced with ltp (verify)
-
-                        this_instrument['entry_time'] = datetime.now()
-                        if this_instrument['target_type'].lower() == 'percentage':
-                            this_instrument['target_price'] = calculations.fix_values(
-                                this_instrument['entry_price'] * (1 + this_instrument['target'] / 100),
-                                this_instrument['tick_size'])
-                        elif this_instrument['target_type'].lower() == 'value':
-                            this_instrument['target_price'] = calculations.fix_values(
-                                this_instrument['entry_price'] + this_instrument['target'],
-                                this_instrument['tick_size'])
-
-                        if this_instrument['stoploss_type'].lower() == 'percentage':
-                            this_instrument['sl_price'] = calculations.fix_values(
-                                this_instrument['entry_price'] * (1 - this_instrument['stoploss'] / 100),
-                                this_instrument['tick_size'])
-
-                        elif this_instrument['stoploss_type'].lower() == 'value':
-                            this_instrument['sl_price'] = calculations.fix_values(
-                                this_instrument['entry_price'] - this_instrument['multiplier'] * this_instrument[
-                                    'stoploss'], this_instrument['tick_size'])
-
-                        if paper_trade == 0:
-                            order = {'variety': 'regular',
-                                     'exchange': this_instrument['exchange'],
-                                     'tradingsymbol': this_instrument['tradingsymbol'],
-                                     'quantity': int(this_instrument['quantity']),
-                                     'product': this_instrument['product_type'],
-                                     'transaction_type': this_instrument['transaction_type'],
-                                     'order_type': this_instrument['order_type'],
-                                     'price': this_instrument['entry_price'],
-                                     'validity': 'DAY',
-                                     'disclosed_quantity': None,
-                                     'trigger_price': None,
-                                     'squareoff': None,
-                                     'stoploss': None,
-                                     'trailing_stoploss': None,
-                                     'tag': None}
-                            this_instrument['order'] = order
-                            for each_user in users_df_dict:
-                                this_user = users_df_dict[each_user]
-                                try:
-                                    new_order = dict(order)
-                                    new_order['quantity'] = int(new_order['quantity'] * this_user['No of Lots'])
-                                    order_id, message = this_user['broker'].place_order(
-                                        **new_order)  # placing fresh order
-                                    this_instrument['entry_order_ids'][each_user]['order_id'] = order_id
-                                    logger.info(f"Order Placed for {each_user} Order_id {order_id}")
-                                except:
-                                    logger.warning(f"Error in Sell Order Placement for {this_user['Name']}"
-                                                   f" Error {sys.exc_info()}", exc_info=True)
-
-                        logger.info(f" Instrument_Details : {this_instrument}")
-
-                    elif this_instrument['multiplier'] != -1 and this_instrument['transaction_type'].upper() == 'SELL':
-                        logger.info(f" In Sell Loop. for {this_instrument['tradingsymbol']}")
-                        logger.info(f" Sell Signal has been Activated for {this_instrument['tradingsymbol']}")
-                        this_instrument['status'] = 1
-                        this_instrument['multiplier'] = -1
-
-                        # todo: check for optimization
-
-                        this_instrument['entry_time'] = datetime.now()
-                        if this_instrument['order_type'] == 'MARKET':
-                            this_instrument['entry_price'] = ltp
-                        else:
-                            this_instrument['entry_price'] = calculations.get_entry_price(this_instrument['order_type'],
-                                                                                          this_instrument[
-                                                                                              'transaction_type'],
-                                                                                          ltp,
-                                                                                          this_instrument[
-                                                                                              'sell_ltp_percent'],
-                                                                                          this_instrument[
-                                                                                              'tick_size'])  # todo: ha price is replaced with ltp (verify)
-
-                        if this_instrument['target_type'].lower() == 'percentage':
-                            this_instrument['target_price'] = calculations.fix_values(
-                                this_instrument['entry_price'] * (1 - this_instrument['target'] / 100),
-                                this_instrument['tick_size'])
-                        elif this_instrument['target_type'].lower() == 'value':
-                            this_instrument['target_price'] = calculations.fix_values(
-                                this_instrument['entry_price'] - this_instrument['target'],
-                                this_instrument['tick_size'])
-
-                        if this_instrument['stoploss_type'].lower() == 'percentage':
-                            this_instrument['sl_price'] = calculations.fix_values(
-                                this_instrument['entry_price'] * (1 + this_instrument['stoploss'] / 100),
-                                this_instrument['tick_size'])
-
-                        elif this_instrument['stoploss_type'].lower() == 'value':
-                            this_instrument['sl_price'] = calculations.fix_values(
-                                this_instrument['entry_price'] - this_instrument['multiplier'] * this_instrument[
-                                    'stoploss'], this_instrument['tick_size'])
-
-                        if paper_trade == 0:
-                            order = {'variety': 'regular',
-                                     'exchange': this_instrument['exchange'],
-                                     'tradingsymbol': this_instrument['tradingsymbol'],
-                                     'quantity': int(this_instrument['quantity']),
-                                     'product': this_instrument['product_type'],
-                                     'transaction_type': this_instrument['transaction_type'],
-                                     'order_type': this_instrument['order_type'],
-                                     'price': ltp,
-                                     'validity': 'DAY',
-                                     'disclosed_quantity': None,
-                                     'trigger_price': None,
-                                     'squareoff': None,
-                                     'stoploss': None,
-                                     'trailing_stoploss': None,
-                                     'tag': None}
-
-                            this_instrument['order'] = order
-                            for each_user in users_df_dict:
-                                this_user = users_df_dict[each_user]
-                                try:
-
-                                    new_order = dict(order)
-                                    new_order['quantity'] = int(new_order['quantity'] * this_user['No of Lots'])
-                                    order_id, message = this_user['broker'].place_order(**new_order)
-                                    this_instrument['entry_order_ids'][each_user]['order_id'] = order_id
-                                    logger.info(f"Sell Order Placed for {each_user} Order_id {order_id}")
-                                except:
-                                    logger.info(f"Error in Sell Order Placement for {this_user['Name']}"
-                                                f" Error {sys.exc_info()}", exc_info=True)
-
-                        logger.info(f" Instrument_Details : {this_instrument}")
-
-                if this_instrument['status'] == 1:
-                    if paper_trade == 1:  #
-
-                        if ltp * this_instrument['multiplier'] <= (this_instrument['entry_price'] *
-                                                                   this_instrument['multiplier']):
-                            logger.info(f"Entry has been taken for {this_instrument['tradingsymbol']}")
-                            this_instrument['entry_time'] = datetime.now()
-                            this_instrument['status'] = 2
-                            continue
-
-                        if datetime.now() > this_instrument['entry_time'] + timedelta(
-                                minutes=int(this_instrument['wait_time'])):
-                            logger.info(f" Cancelling the Placed Order for {this_instrument['tradingsymbol']}")
-                            this_instrument['Row_Type'] = 'T'
-                            this_instrument['multiplier'] = None
-                            this_instrument['entry_price'] = None
-                            this_instrument['entry_time'] = None
-                            this_instrument['exit_price'] = None
-                            this_instrument['exit_time'] = None
-                            this_instrument['status'] = 0
-                            this_instrument['entry_order_id'] = None
-                            this_instrument['target_price'] = None
-                            this_instrument['sl_price'] = None
-                            this_instrument['sl_order_id'] = None
-                            this_instrument['target_order_id'] = None
-                            continue
+        try:
+            with profiler.phase('exits'):
+                engine.exits.step()  # exits in progress, never waits for the broker
+            with profiler.phase('evaluate'):
+                engine.evaluate(row_indices)
+            publish_square_off(engine, manager_dict, shard)
+        except Exception as e:
+            logger.critical(f'Error in {process_name} Strategy Function. {e.__str__()}', exc_info=True)
+            manager_dict['algo_error'] = f"Error in Strategy Function, Error: {sys.exc_info()}"
+            manager_dict['algo_running'] = False
+            return
 
-                    if paper_trade == 0:
-                        if (ltp * this_instrument['multiplier']
-                                <= this_instrument['entry_price'] * this_instrument['multiplier']):
-                            for each_user in this_instrument['entry_order_ids']:
-                                this_user = users_df_dict[each_user]
-                                this_user_order_details = this_instrument['entry_order_ids'][each_user]
-                                broker = this_user_order_details['broker']
-                                order_id = this_user_order_details['order_id']
-                                order_status, status_message = broker.get_order_status(order_id=order_id)
-                                this_user_order_details['order_status'] = order_status
-                                if order_status == 'COMPLETE':
-                                    continue
-                                elif order_status == 'REJECTED':
-                                    logger.info(f"Order Rejected for {each_user} having Order ID : {order_id}")
-                                    continue
-                                else:
-                                    # order = this_instrument['order']
-                                    # order['order_type'] = 'MARKET'
-                                    # order['price'] = None
-                                    # broker.cancel_order(order_id=order_id)
-                                    # new_order = dict(order)
-                                    # new_order['quantity'] = int(new_order['quantity'] *
-                                    #                             this_user['No of Lots'])
-                                    # order_id, message = broker.place_order(**new_order)
-                                    # this_instrument['entry_order_ids'][each_user]['order_id'] = order_id
-                                    # logger.info(f"Order Placed for {each_user} Order_id {order_id}")
-                                    # todo: need to pending initial order on user's choice (button press from UI)
-                                    pass
-
-                            logger.info(f" Entry has been taken for {this_instrument['tradingsymbol']} ")
-                            this_instrument['entry_time'] = datetime.now()
-                            this_instrument['status'] = 2
-
-                            if this_instrument['stoploss_type'] != 'No SL Order':
-                                # Place SL Order
-                                order = {'variety': 'regular',
-                                         'exchange': this_instrument['exchange'],
-                                         'tradingsymbol': this_instrument['tradingsymbol'],
-                                         'quantity': int(this_instrument['quantity']),
-                                         'product': this_instrument['product_type'],
-                                         'transaction_type': calculations.reverse_txn_type(
-                                             this_instrument['transaction_type']),
-                                         'order_type': 'SL',
-                                         'price': calculations.get_adjusted_trigger_price(
-                                             this_instrument['transaction_type'],
-                                             this_instrument['sl_price'],
-                                             this_instrument['tick_size']),
-                                         'validity': 'DAY',
-                                         'disclosed_quantity': None,
-                                         'trigger_price': this_instrument['sl_price'],
-                                         'squareoff': None,
-                                         'stoploss': None,
-                                         'trailing_stoploss': None,
-                                         'tag': None}
-
-                                for each_user in users_df_dict:
-                                    this_user = users_df_dict[each_user]
-                                    try:
-                                        new_order = dict(order)
-                                        new_order['quantity'] = int(new_order['quantity'] * this_user['No of Lots'])
-                                        order_id, message = this_user['broker'].place_order(**new_order)
-                                        this_instrument['sl_order_ids'][each_user]['order_id'] = order_id
-                                        logger.info(f"Order Placed for {each_user} Order_id {order_id}")
-                                    except:
-                                        logger.critical(f"Error in SL Order Placement for {this_user['Name']} "
-                                                        f"Error {sys.exc_info()}", exc_info=True)
-
-                                continue
-
-                if this_instrument['status'] == 2:  # Order Placed was executed
-                    this_instrument['ltp'] = ltp
-                    this_instrument['profit'] = (ltp - this_instrument['entry_price']) * this_instrument['multiplier'] * \
-                                                this_instrument['quantity'] * this_instrument['lot_size']
-                    final_df = final_df[final_df['Row_Type'] != 'T']
-                    this_instrument['Row_Type'] = 'T'
-                    final_df = final_df.append(this_instrument, ignore_index=True)
-
-                    # logger.info(f"{ltp} {this_instrument['multiplier']} {this_instrument['target_price']} {this_instrument['sl_price']}")
-                    if (this_instrument['target_type'] != 'No Target Order' and
-                            (ltp * this_instrument['multiplier']) >= (this_instrument['target_price'] *
-                                                                      this_instrument['multiplier'])):
-                        logger.info(f"Target has been Hit for {this_instrument['tradingsymbol']}")
-                        this_instrument['exit_time'] = datetime.now()
-                        this_instrument['exit_price'] = ltp
-                        this_instrument['status'] = 0
-                        this_instrument['vwap_signal'] = 'new'
-                        this_instrument['atrts_signal'] = 'new'
-                        this_instrument['moving_average_signal'] = 'new'
-                        # Cancel Pending SL Order and Placing a Market Order
-                        if paper_trade == 0:
-                            for each_user in users_df_dict:
-                                this_user = users_df_dict[each_user]
-                                try:
-                                    order_id = this_instrument['sl_order_ids'][each_user]['order_id']
-                                    order_status, message = this_user['broker'].get_order_status(order_id)
-                                    this_instrument['sl_order_ids'][each_user]['order_status'] = order_status
-                                    if order_status == 'PENDING':
-                                        this_user['broker'].cancel_order(order_id)
-                                        if this_instrument["transaction_type"] == "BUY":
-                                            txn_type = "SELL"
-                                        else:
-                                            txn_type = "BUY"
-                                        order = {'variety': 'regular',
-                                                 'exchange': this_instrument['exchange'],
-                                                 'tradingsymbol': this_instrument['tradingsymbol'],
-                                                 'quantity': int(this_instrument['quantity']),
-                                                 'product': this_instrument['product_type'],
-                                                 'transaction_type': txn_type,
-                                                 'order_type': 'MARKET',
-                                                 'price': None,
-                                                 'validity': 'DAY',
-                                                 'disclosed_quantity': None,
-                                                 'trigger_price': None,
-                                                 'squareoff': None,
-                                                 'stoploss': None,
-                                                 'trailing_stoploss': None,
-                                                 'tag': None}
-                                        new_order = dict(order)
-                                        new_order['quantity'] = int(new_order['quantity'] * this_user['No of Lots'])
-                                        order_id, message = this_user['broker'].place_order(**new_order)
-                                        this_instrument['sl_order_ids'][each_user]['order_id'] = order_id
-                                        logger.info(f"Order Placed for {each_user} Order_id {order_id}")
-                                    elif order_status == 'COMPLETE':
-                                        this_user['broker'].cancel_order(order_id)
-                                except:
-                                    logger.critical(f"Error in Closing Order Placement for {this_user['Name']} "
-                                                    f"Error {sys.exc_info()}", exc_info=True)
-
-                        # final_df = final_df[final_df['Row_Type']!='T']
-                        this_instrument['Row_Type'] = 'F'
-                        final_df = final_df.append(this_instrument, ignore_index=True)
-
-                        this_instrument['Row_Type'] = 'T'
-                        this_instrument['multiplier'] = None
-                        this_instrument['entry_price'] = None
-                        this_instrument['entry_time'] = None
-                        this_instrument['exit_price'] = None
-                        this_instrument['exit_time'] = None
-                        this_instrument['status'] = 0
-                        this_instrument['entry_order_id'] = None
-                        this_instrument['target_price'] = None
-                        this_instrument['sl_price'] = None
-                        this_instrument['sl_order_id'] = None
-                        this_instrument['target_order_id'] = None
-
-                    elif (ltp * this_instrument['multiplier'] <=
-                          this_instrument['sl_price'] * this_instrument['multiplier']):
-
-                        logger.info(f"Stoploss has been Hit for {this_instrument['tradingsymbol']}")
-                        this_instrument['exit_time'] = datetime.now()
-                        this_instrument['exit_price'] = ltp
-                        this_instrument['status'] = 0
-                        this_instrument['vwap_signal'] = 'new'
-                        this_instrument['atrts_signal'] = 'new'
-                        this_instrument['moving_average_signal'] = 'new'
-
-                        # Cancel Pending SL Order and Placing a Market Order
-                        if paper_trade == 0:
-                            for each_user in users_df_dict:
-                                this_user = users_df_dict[each_user]
-                                try:
-                                    order_id = this_instrument['sl_order_ids'][each_user]['order_id']
-                                    order_status, message = this_user['broker'].get_order_status(order_id)
-                                    this_instrument['sl_order_ids'][each_user]['order_status'] = order_status
-                                    time.sleep(1)
-                                    if order_status == 'PENDING':
-                                        this_user['broker'].cancel_order(order_id)
-                                        time.sleep(1)
-                                        if this_instrument["transaction_type"] == "BUY":
-                                            txn_type = "SELL"
-                                        else:
-                                            txn_type = "BUY"
-                                        order = {'variety': 'regular',
-                                                 'exchange': this_instrument['exchange'],
-                                                 'tradingsymbol': this_instrument['tradingsymbol'],
-                                                 'quantity': int(this_instrument['quantity']),
-                                                 'product': this_instrument['product_type'],
-                                                 'transaction_type': txn_type,
-                                                 'order_type': 'MARKET',
-                                                 'price': None,
-                                                 'validity': 'DAY',
-                                                 'disclosed_quantity': None,
-                                                 'trigger_price': None,
-                                                 'squareoff': None,
-                                                 'stoploss': None,
-                                                 'trailing_stoploss': None,
-                                                 'tag': None}
-                                        new_order = dict(order)
-                                        new_order['quantity'] = int(new_order['quantity'] * this_user['No of Lots'])
-                                        order_id, message = this_user['broker'].place_order(**new_order)
-                                        this_instrument['sl_order_ids'][each_user]['order_id'] = order_id
-                                        logger.info(f"Order Placed for {each_user} Order_id {order_id}")
-                                    elif order_status == 'COMPLETE':
-                                        this_user['broker'].cancel_order(order_id)
-                                except Exception as e:
-                                    logger.critical(f"Error in Closing Order Placement for {this_user['Name']}"
-                                                    f" Error {sys.exc_info()}", exc_info=True)
-
-                        # final_df = final_df[final_df['Row_Type'] != 'T']
-                        this_instrument['Row_Type'] = 'F'
-                        final_df = final_df.append(this_instrument, ignore_index=True)
-
-                        this_instrument['Row_Type'] = 'T'
-                        this_instrument['multiplier'] = None
-                        this_instrument['entry_price'] = None
-                        this_instrument['entry_time'] = None
-                        this_instrument['exit_price'] = None
-                        this_instrument['exit_time'] = None
-                        this_instrument['status'] = 0
-                        this_instrument['entry_order_id'] = None
-                        this_instrument['target_price'] = None
-                        this_instrument['sl_price'] = None
-                        this_instrument['sl_order_id'] = None
-                        this_instrument['target_order_id'] = None
-
-                    if this_instrument['close_positions'] == 1:
-
-                        this_instrument['exit_time'] = datetime.now()
-                        this_instrument['exit_price'] = ltp
-                        this_instrument['status'] = 0
-                        this_instrument['vwap_signal'] = 'new'
-                        this_instrument['atrts_signal'] = 'new'
-                        this_instrument['moving_average_signal'] = 'new'
-                        # Cancel Pending SL Order and Placing a Market Order
-                        if paper_trade == 0:
-                            for each_user in users_df_dict:
-                                this_user = users_df_dict[each_user]
-                                try:
-                                    order_id = this_instrument['sl_order_ids'][each_user]['order_id']
-                                    order_status, message = this_user['broker'].get_order_status(order_id)
-                                    this_instrument['sl_order_ids'][each_user]['order_status'] = order_status
-                                    if order_status == 'PENDING':
-                                        this_user['broker'].cancel_order(order_id)
-                                        txn_type = calculations.reverse_txn_type(this_instrument['transaction_type'])
-                                        order = {'variety': 'regular',
-                                                 'exchange': this_instrument['exchange'],
-                                                 'tradingsymbol': this_instrument['tradingsymbol'],
-                                                 'quantity': int(this_instrument['quantity']),
-                                                 'product': this_instrument['product_type'],
-                                                 'transaction_type': txn_type,
-                                                 'order_type': 'MARKET',
-                                                 'price': None,
-                                                 'validity': 'DAY',
-                                                 'disclosed_quantity': None,
-                                                 'trigger_price': None,
-                                                 'squareoff': None,
-                                                 'stoploss': None,
-                                                 'trailing_stoploss': None,
-                                                 'tag': None}
-                                        new_order = dict(order)
-                                        new_order['quantity'] = int(new_order['quantity'] * this_user['No of Lots'])
-                                        order_id, message = this_user['broker'].place_order(**new_order)
-                                        this_instrument['sl_order_ids'][each_user]['order_id'] = order_id
-                                        logger.info(f"Order Placed for {each_user} Order_id {order_id}")
-                                    elif order_status == 'COMPLETE':
-                                        this_user['broker'].cancel_order(order_id)
-                                except Exception:
-                                    logger.critical(f"Error in Closing Order Placement for {this_user['Name']}"
-                                                    f" Error {sys.exc_info()}", exc_info=True)
-
-                        # final_df = final_df[final_df['Row_Type'] != 'T']
-                        this_instrument['Row_Type'] = 'F'
-                        final_df = final_df.append(this_instrument, ignore_index=True)
-
-                        this_instrument['Row_Type'] = 'T'
-                        this_instrument['multiplier'] = None
-                        this_instrument['entry_price'] = None
-                        this_instrument['entry_time'] = None
-                        this_instrument['exit_price'] = None
-                        this_instrument['exit_time'] = None
-                        this_instrument['status'] = 0
-                        this_instrument['entry_order_id'] = None
-                        this_instrument['target_price'] = None
-                        this_instrument['sl_price'] = None
-                        this_instrument['sl_order_id'] = None
-                        this_instrument['target_order_id'] = None
-
-                        # Cancel the SL Order placed and Place an opposite Limit Order which with Buffer and Close open position
-                        this_instrument['close_positions'] = 0
-                        continue
-            except Exception as e:
-                logger.critical(f'Error in {process_name} Strategy Function. {e.__str__()}', exc_info=True)
-                manager_dict['algo_error'] = f"Error in Strategy Function, Error: {sys.exc_info()}"
-                manager_dict['algo_running'] = False
-                return
+    export_positions(engine, shard)
+    positions_writer.close()
+    if journal is not None:
+        journal.close()
+    try:
+        engine.latency.dump(shard_path(settings.DATA_FILES.get('LATENCY_REPORT_PATH'), shard.index),
+                            others=[rate_limiter.get_rate_limiter().latency])
+    except Exception:
+        logger.error(f"Error in exporting the latency report {sys.exc_info()}", exc_info=True)
+    if paper_exchange is not None:
+        try:
+            paper_exchange.dump(shard_path(settings.DATA_FILES.get('PAPER_FILLS_PATH'), shard.index))
+            logger.info(f"Paper fills:\n{paper_exchange.stats()}")
+        except Exception:
+            logger.error(f"Error in exporting the paper fills {sys.exc_info()}", exc_info=True)
+    if market_closed:
+        manager_dict['algo_error'] = "Market closed, the algorithm stopped after the session"
+        manager_dict['algo_running'] = False
 
 
 if __name__ == '__main__':
     # instruments_df_dict = dict()
     main(manager_dict={'paper_trade': 0, 'algo_running': True, 'fore_stop': True, 'algo_error': None},
-         cancel_orders_queue=multiprocessing.Queue())
+         cancel_orders_queue=multiprocessing.Queue(), orderbook_queue=multiprocessing.Queue())
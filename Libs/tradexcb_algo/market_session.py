@@ -0,0 +1,129 @@
+"""
+Sessions of the exchange, as timed events for the strategy loop.
+
+Every trading day (weekdays, not an exchange holiday, see `MarketCalendar`) has the events (times of `settings`):
+
+    PRE_OPEN    SESSION_PRE_OPEN      pre-market tasks (rows reloaded, order books refreshed, entries allowed again)
+    START       SESSION_START         the strategy starts evaluating the rows
+    SQUARE_OFF  SESSION_SQUARE_OFF    all the positions squared off (if set)
+    CLOSE       SESSION_CLOSE         end of the day: positions exported, the algo stops (SESSION_STOP_AFTER_CLOSE)
+                                      or sleeps until the next PRE_OPEN
+
+`MarketSession.due` hands out the events passed since its last call, so the loop runs each of them once even
+across days, and `seconds_until_next` lets the loop sleep until the next one instead of polling. The dates
+are computed from the clock on every call, a process living past midnight moves on to the next day.
+"""
+import csv
+import os
+import typing
+from datetime import datetime, date, time as day_time, timedelta
+
+import holidays
+
+from Libs.Utils import exception_handler, settings
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+PRE_OPEN = 'pre_open'
+START = 'start'
+SQUARE_OFF = 'square_off'
+CLOSE = 'close'
+
+Event = typing.Tuple[datetime, str]
+
+
+def _time_of(text: typing.Optional[str]) -> typing.Optional[day_time]:
+    """'HH:MM' -> time (None if not set)"""
+    return None if not text else datetime.strptime(text, '%H:%M').time()
+
+
+class MarketCalendar:
+    """
+    trading days of the exchange: weekdays which are not exchange holidays. The exchange holidays are listed in
+    `settings.DATA_FILES['MARKET_HOLIDAYS_PATH']` (csv, `date` column "YYYY-MM-DD") and `settings.MARKET_HOLIDAYS`.
+    For a year without any listed, the national holidays of `country` (`holidays` package) stand in for them,
+    with a warning: they are not the exchange calendar.
+    """
+
+    def __init__(self, country: typing.Optional[str] = settings.MARKET_HOLIDAYS_COUNTRY,
+                 extra_holidays: typing.Iterable[str] = settings.MARKET_HOLIDAYS,
+                 holidays_path: typing.Optional[str] = settings.DATA_FILES.get('MARKET_HOLIDAYS_PATH')):
+        self.country = country
+        self.exchange_holidays = {datetime.strptime(day, '%Y-%m-%d').date() for day in extra_holidays}
+        if holidays_path and os.path.exists(holidays_path):
+            with open(holidays_path, newline='') as file:
+                self.exchange_holidays.update(datetime.strptime(row['date'].strip(), '%Y-%m-%d').date()
+                                              for row in csv.DictReader(file) if row.get('date'))
+        self.listed_years = {day.year for day in self.exchange_holidays}
+        self.holidays = holidays.CountryHoliday(country) if country else {}
+        self._fallback_years = set()  # years warned about, without exchange holidays listed
+
+    def _is_holiday(self, day: date) -> bool:
+        if day.year in self.listed_years:
+            return day in self.exchange_holidays
+        if day.year not in self._fallback_years:
+            self._fallback_years.add(day.year)
+            logger.warning(f"No exchange holidays listed for {day.year}, the national holidays of {self.country} "
+                           f"are used instead (see settings.MARKET_HOLIDAYS)")
+        return day in self.holidays
+
+    def is_trading_day(self, day: date) -> bool:
+        return day.weekday() < 5 and not self._is_holiday(day)
+
+    def next_trading_day(self, day: date) -> date:
+        """first trading day on or after `day`"""
+        while not self.is_trading_day(day):
+            day += timedelta(days=1)
+        return day
+
+
+class MarketSession:
+    """timed events of the exchange sessions"""
+
+    def __init__(self, calendar: typing.Optional[MarketCalendar] = None,
+                 clock: typing.Callable[[], datetime] = datetime.now):
+        self.calendar = calendar or MarketCalendar()
+        self.clock = clock
+        self.times = {event: _time_of(text) for event, text in ((PRE_OPEN, settings.SESSION_PRE_OPEN),
+                                                                 (START, settings.SESSION_START),
+                                                                 (SQUARE_OFF, settings.SESSION_SQUARE_OFF),
+                                                                 (CLOSE, settings.SESSION_CLOSE))}
+        self._last = clock()  # events up to this time are handed out already (none before the process started)
+
+    def events_of(self, day: date) -> typing.List[Event]:
+        """events of a day, in time order (none on a holiday)"""
+        if not self.calendar.is_trading_day(day):
+            return []
+        return sorted((datetime.combine(day, at), event) for event, at in self.times.items() if at is not None)
+
+    def next_event(self, after: typing.Optional[datetime] = None) -> Event:
+        """first event after `after` (default now)"""
+        after = after or self.clock()
+        day = after.date()
+        while True:
+            for event in self.events_of(day):
+                if event[0] > after:
+                    return event
+            day = self.calendar.next_trading_day(day + timedelta(days=1))
+
+    def seconds_until_next(self, now: typing.Optional[datetime] = None) -> float:
+        now = now or self.clock()
+        return max((self.next_event(now)[0] - now).total_seconds(), 0.0)
+
+    def is_trading(self, now: typing.Optional[datetime] = None) -> bool:
+        """True between START and CLOSE of a trading day"""
+        now = now or self.clock()
+        if not self.calendar.is_trading_day(now.date()):
+            return False
+        return self.times[START] <= now.time() < self.times[CLOSE]
+
+    def due(self, now: typing.Optional[datetime] = None) -> typing.List[str]:
+        """events passed since the last call, in time order"""
+        now = now or self.clock()
+        events = []
+        at, event = self.next_event(self._last)
+        while at <= now:
+            events.append(event)
+            at, event = self.next_event(at)
+        self._last = now
+        return events
@@ -0,0 +1,84 @@
+"""
+Parallel submission of the per-user broker calls of one signal.
+
+Every user's call runs on a shared thread pool, so that all the accounts are sent their orders
+at (nearly) the same time instead of one after another. The number of calls in flight for an
+account is capped by `settings.ORDER_FANOUT_BROKER_CONCURRENCY` (per broker), the request rates
+are limited by `main_broker_api.rate_limiter`.
+"""
+import sys
+import threading
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from Libs.Utils import exception_handler, settings
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+
+class FanoutResult(typing.NamedTuple):
+    value: typing.Any = None
+    error: typing.Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class OrderFanout:
+    """runs a function for many users in parallel, with a concurrency cap per account"""
+
+    def __init__(self, max_workers: int = settings.ORDER_FANOUT_MAX_WORKERS,
+                 broker_concurrency: typing.Optional[typing.Dict[str, int]] = None,
+                 default_concurrency: int = settings.ORDER_FANOUT_DEFAULT_CONCURRENCY):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="order-fanout")
+        self.broker_concurrency = {name.lower(): limit for name, limit in
+                                   (broker_concurrency or settings.ORDER_FANOUT_BROKER_CONCURRENCY).items()}
+        self.default_concurrency = default_concurrency
+        self._semaphores: typing.Dict[typing.Tuple[str, str], threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, broker_name: str, user: str) -> threading.BoundedSemaphore:
+        broker_name = (broker_name or "").lower()
+        with self._lock:
+            if (broker_name, user) not in self._semaphores:
+                limit = self.broker_concurrency.get(broker_name, self.default_concurrency)
+                self._semaphores[(broker_name, user)] = threading.BoundedSemaphore(max(int(limit), 1))
+            return self._semaphores[(broker_name, user)]
+
+    def _run(self, semaphore: threading.BoundedSemaphore, func: typing.Callable, user: str) -> FanoutResult:
+        with semaphore:
+            try:
+                return FanoutResult(value=func(user))
+            except Exception as e:
+                logger.debug(f"Order fan-out call failed for {user} Error {sys.exc_info()}")
+                return FanoutResult(error=e)
+
+    def map(self, func: typing.Callable[[str], typing.Any], users: typing.Iterable[str],
+            broker_names: typing.Dict[str, str]) -> typing.Dict[str, FanoutResult]:
+        """
+        call `func(user)` for every user in parallel and wait for all of them
+
+        :param func: the broker call(s) of a single user, its return value is collected
+        :param users: users to run `func` for
+        :param broker_names: broker name of each user (for the concurrency cap)
+        :return: {user: FanoutResult}, in the order of `users`. Errors raised by `func` are returned, not raised
+        """
+        users = list(users)
+        if len(users) == 1:  # no need to hop threads for a single account
+            user = users[0]
+            return {user: self._run(self._semaphore(broker_names.get(user), user), func, user)}
+        futures = {user: self._executor.submit(self._run, self._semaphore(broker_names.get(user), user), func, user)
+                   for user in users}
+        return {user: future.result() for user, future in futures.items()}
+
+    def submit(self, func: typing.Callable[[str], typing.Any], user: str, broker_name: str) -> Future:
+        """
+        call `func(user)` on the pool without waiting for it
+
+        :return: future of the FanoutResult
+        """
+        return self._executor.submit(self._run, self._semaphore(broker_name, user), func, user)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
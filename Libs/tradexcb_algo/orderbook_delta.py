@@ -0,0 +1,68 @@
+"""
+Delta transport of the orderbook (OMS table) from the algo process to the UI.
+
+Instead of the whole orderbook, the algo process sends only the rows changed since the last message,
+keyed by `instrument_df_key`, over a multiprocessing queue. A message is a dict:
+
+    {'shard': <index of the algo process sending it, see `sharding`>,
+     'seq': <int, +1 per message (of the shard)>,
+     'reset': <bool, True if `rows` is the full orderbook>,
+     'rows': {instrument_df_key: {column: value}},  # new / changed rows
+     'removed': [instrument_df_key, ...]}
+
+The UI merges the messages of all shards (`sharding.OrderbookMerger`) and applies them in order
+(`OMSModel.apply_delta`); when it sees a gap in `seq` it asks the shard for a full orderbook
+(`manager_dict['orderbook_resync']`).
+"""
+import multiprocessing
+import queue
+import typing
+
+from Libs.Utils import exception_handler
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+Row = typing.Dict[str, typing.Any]
+
+
+class OrderbookDeltaPublisher:
+    """algo process side: remembers the rows sent last, and sends the difference"""
+
+    def __init__(self, orderbook_queue: multiprocessing.Queue, shard_index: int = 0):
+        self.orderbook_queue = orderbook_queue
+        self.shard_index = shard_index
+        self.seq = 0
+        self._sent: typing.Dict[typing.Any, Row] = {}
+        self._resync = True  # the first message carries the full orderbook
+
+    def request_resync(self):
+        """send the full orderbook with the next message"""
+        self._resync = True
+
+    def publish(self, rows: typing.Dict[typing.Any, Row]) -> bool:
+        """
+        send the changes of `rows` (full orderbook: instrument_df_key -> row) since the last call
+
+        :return: True if a message was sent
+        """
+        reset = self._resync
+        if reset:
+            changed = dict(rows)
+            removed = []
+        else:
+            changed = {key: row for key, row in rows.items() if self._sent.get(key) != row}
+            removed = [key for key in self._sent if key not in rows]
+        if not (reset or changed or removed):
+            return False
+        message = {'shard': self.shard_index, 'seq': self.seq + 1, 'reset': reset, 'rows': changed,
+                   'removed': removed}
+        try:
+            self.orderbook_queue.put_nowait(message)
+        except queue.Full:
+            logger.warning("Orderbook queue full, the next orderbook update will be sent in full")
+            self._resync = True
+            return False
+        self.seq += 1
+        self._sent = dict(rows)
+        self._resync = False
+        return True
@@ -0,0 +1,388 @@
+"""
+Simulated exchange for paper trading, behind the broker interface of the strategy (`PaperBroker`).
+
+With `settings.PAPER_EXCHANGE`, paper trading sends its orders (entries, SL orders, square offs) to
+`PaperExchange` instead of a broker, through the same code as live trading. The exchange keeps an order book
+per instrument, matched against the live ticks of the data feed:
+
+    arrival      orders/cancellations reach the exchange after a latency (`LatencyModel`), an order is
+                 acknowledged with its id right away and stays PENDING until then
+    MARKET       filled at the ltp on arrival (or the next tick), `SlippageModel` ticks worse
+    LIMIT        filled at the ltp on arrival if marketable, else rests in the book: filled at its price once
+                 the ltp trades through it, or once its share (`participation`) of the quantity traded while the
+                 ltp only touches it adds up to its quantity
+    SL / SL-M    rest until the ltp reaches the trigger price, then become a LIMIT / MARKET order
+
+Resting orders are kept in heaps (price/trigger priority), so an order costs O(log n) and a tick only looks at
+the orders it crosses. Cancelled orders are dropped from the heaps lazily. Every fill is recorded for the fill
+statistics (`stats`, `dump`). Orders are filled whole: the strategy does not handle partially filled orders (an
+entry cancelled after a partial fill would leave its filled quantity open).
+"""
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+import typing
+from datetime import datetime
+
+import pandas as pd
+
+from Libs.Utils import exception_handler, settings
+from .main_broker_api.order_cache import OrderState
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+PENDING = 'PENDING'
+COMPLETE = 'COMPLETE'
+CANCELLED = 'CANCELLED'
+REJECTED = 'REJECTED'
+FILL_COLUMNS = ['order_id', 'account', 'tradingsymbol', 'transaction_type', 'order_type', 'quantity', 'price',
+                'reference_price', 'slippage', 'placed_at', 'filled_at']
+
+
+class LatencyModel:
+    """
+    time for an order/cancellation to reach the exchange: normal distribution, at least `minimum`
+
+    :param mean: seconds
+    :param jitter: standard deviation, seconds
+    """
+
+    def __init__(self, mean: float = 0.05, jitter: float = 0.0, minimum: float = 0.0,
+                 seed: typing.Optional[int] = None):
+        self.mean = mean
+        self.jitter = jitter
+        self.minimum = minimum
+        self._random = random.Random(seed)
+
+    def sample(self) -> float:
+        if not self.jitter:
+            return max(self.mean, self.minimum)
+        return max(self._random.gauss(self.mean, self.jitter), self.minimum)
+
+
+class SlippageModel:
+    """price of the market (and triggered SL-M) fills: `ticks` ticks worse than the ltp, plus `percent` of it"""
+
+    def __init__(self, ticks: int = 0, percent: float = 0.0):
+        self.ticks = ticks
+        self.percent = percent
+
+    def fill_price(self, ltp: float, side: int, tick_size: float) -> float:
+        price = ltp + side * (self.ticks * tick_size + ltp * self.percent / 100)
+        return round(round(price / tick_size) * tick_size, 2) if tick_size else price
+
+
+class _Order:
+    __slots__ = ('order_id', 'account', 'token', 'tradingsymbol', 'side', 'order_type', 'quantity', 'filled',
+                 'price', 'trigger_price', 'tick_size', 'status', 'placed_at', 'triggered', 'average_price',
+                 'reference_price', 'touched')
+
+    def __init__(self, order_id: str, account: str, token: int, tradingsymbol: str, side: int, order_type: str,
+                 quantity: int, price: typing.Optional[float], trigger_price: typing.Optional[float],
+                 tick_size: float, placed_at: float):
+        self.order_id = order_id
+        self.account = account
+        self.token = token
+        self.tradingsymbol = tradingsymbol
+        self.side = side  # 1 buy, -1 sell
+        self.order_type = order_type
+        self.quantity = quantity
+        self.filled = 0
+        self.price = price
+        self.trigger_price = trigger_price
+        self.tick_size = tick_size
+        self.status = PENDING
+        self.placed_at = placed_at
+        self.triggered = False  # SL order whose trigger price was reached
+        self.average_price = None
+        self.reference_price = None  # ltp the order was marketable at / its limit price (slippage statistics)
+        self.touched = 0  # share of the quantity traded at its price while resting, fills it once it covers it
+
+    @property
+    def remaining(self) -> int:
+        return self.quantity - self.filled
+
+    @property
+    def is_market(self) -> bool:
+        return self.order_type == 'MARKET' or (self.order_type == 'SL-M' and self.triggered)
+
+
+class _Book:
+    """resting orders of an instrument, heaps of (priority, sequence, order)"""
+    __slots__ = ('bids', 'asks', 'buy_stops', 'sell_stops')
+
+    def __init__(self):
+        self.bids = []  # buy limits, highest price first
+        self.asks = []  # sell limits, lowest price first
+        self.buy_stops = []  # buy SL orders, lowest trigger first
+        self.sell_stops = []  # sell SL orders, highest trigger first
+
+
+class PaperExchange:
+    """
+    simulated exchange shared by the paper accounts of an algo process, safe to use from any thread
+
+    :param latest_ltp: ltp dict of the data feed ({instrument_token: {'ltp': .., 'ltq': ..}})
+    :param instrument_df: instruments (tradingsymbol, exchange, instrument_token, tick_size), to resolve orders
+    :param participation: share of the quantity traded at a resting order's price that fills it
+    """
+
+    def __init__(self, latest_ltp: typing.Dict[int, typing.Dict[str, float]], instrument_df: pd.DataFrame,
+                 latency: typing.Optional[LatencyModel] = None, slippage: typing.Optional[SlippageModel] = None,
+                 participation: float = settings.PAPER_PARTICIPATION,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.latest_ltp = latest_ltp
+        self.instrument_df = instrument_df
+        self.latency = latency or LatencyModel(*settings.PAPER_LATENCY, seed=settings.PAPER_SEED)
+        self.slippage = slippage or SlippageModel(settings.PAPER_SLIPPAGE_TICKS)
+        self.participation = participation
+        self.clock = clock
+        self.fills: typing.List[typing.Dict[str, typing.Any]] = []
+        self._orders: typing.Dict[str, _Order] = {}
+        self._books: typing.Dict[int, _Book] = {}
+        self._events = []  # (due, sequence, order, is_cancel): arrivals of the orders/cancellations
+        self._instruments: typing.Dict[typing.Tuple[str, str], typing.Optional[typing.Tuple[int, float]]] = {}
+        self._listeners: typing.Dict[str, typing.List[typing.Callable[[OrderState, int], None]]] = {}
+        self._sequence = itertools.count()
+        self._order_ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    # ------------ broker side ------------
+    def add_listener(self, account: str, callback: typing.Callable[[OrderState, int], None]):
+        """call `callback(order_state, instrument_token)` when an order of the account changes"""
+        self._listeners.setdefault(account, []).append(callback)
+
+    def _instrument(self, tradingsymbol: str, exchange: str) -> typing.Optional[typing.Tuple[int, float]]:
+        key = (tradingsymbol, exchange)
+        if key not in self._instruments:
+            rows = self.instrument_df[(self.instrument_df['tradingsymbol'] == tradingsymbol) &
+                                      (self.instrument_df['exchange'] == exchange)]
+            self._instruments[key] = None if rows.empty else (int(rows['instrument_token'].iloc[-1]),
+                                                              float(rows['tick_size'].iloc[-1]))
+        return self._instruments[key]
+
+    def place_order(self, account: str, **kwargs) -> typing.Tuple[typing.Optional[str], str]:
+        """:return: order_id, message (kwargs of `All_Broker.place_order`)"""
+        instrument = self._instrument(kwargs['tradingsymbol'], kwargs['exchange'])
+        if instrument is None:
+            return None, f"Unknown instrument {kwargs['exchange']}:{kwargs['tradingsymbol']}"
+        if int(kwargs['quantity']) <= 0:
+            return None, f"Invalid quantity {kwargs['quantity']}"
+        token, tick_size = instrument
+        now = self.clock()
+        with self._lock:
+            order = _Order(f"PAPER{next(self._order_ids)}", account, token, kwargs['tradingsymbol'],
+                           1 if kwargs['transaction_type'] == 'BUY' else -1, kwargs['order_type'],
+                           int(kwargs['quantity']), kwargs.get('price'), kwargs.get('trigger_price'), tick_size, now)
+            self._orders[order.order_id] = order
+            heapq.heappush(self._events, (now + self.latency.sample(), next(self._sequence), order, False))
+            changed = self._process(now)
+        self._notify(changed)
+        return order.order_id, 'success'
+
+    def cancel_order(self, order_id) -> str:
+        """:return: message ('success' if the cancellation was sent, it takes effect when it reaches the exchange)"""
+        order = self._orders.get(str(order_id))
+        if order is None or order.status != PENDING:
+            return f"Order {order_id} can not be cancelled"
+        now = self.clock()
+        with self._lock:
+            heapq.heappush(self._events, (now + self.latency.sample(), next(self._sequence), order, True))
+            changed = self._process(now)
+        self._notify(changed)
+        return 'success'
+
+    def order(self, order_id) -> typing.Optional[OrderState]:
+        """current state of an order (orders/cancellations due by now are processed first)"""
+        self.advance()
+        order = self._orders.get(str(order_id))
+        return None if order is None else OrderState(order.order_id, order.status)
+
+    def order_book(self, account: str) -> pd.DataFrame:
+        self.advance()
+        return pd.DataFrame([{'order_id': order.order_id, 'status': order.status, 'tradingsymbol': order.tradingsymbol,
+                              'transaction_type': 'BUY' if order.side == 1 else 'SELL', 'order_type': order.order_type,
+                              'quantity': order.quantity, 'filled_quantity': order.filled, 'price': order.price,
+                              'trigger_price': order.trigger_price, 'average_price': order.average_price}
+                             for order in list(self._orders.values()) if order.account == account])
+
+    # ------------ market side ------------
+    def advance(self):
+        """process the arrivals/cancellations due by now"""
+        if self._events and self._events[0][0] <= self.clock():
+            with self._lock:
+                changed = self._process(self.clock())
+            self._notify(changed)
+
+    def on_ticks(self, instrument_tokens: typing.Iterable[int]):
+        """match the resting orders of the instruments against their latest tick (called by the data feed)"""
+        with self._lock:
+            changed = self._process(self.clock())
+            for token in instrument_tokens:
+                book = self._books.get(token)
+                tick = self.latest_ltp.get(token)
+                if book is not None and tick and tick.get('ltp') is not None:
+                    self._match(book, tick['ltp'], tick.get('ltq'), changed)
+        self._notify(changed)
+
+    def _ltp(self, token: int) -> typing.Optional[float]:
+        return self.latest_ltp.get(token, {}).get('ltp')
+
+    def _process(self, now: float) -> typing.List[_Order]:
+        changed = []
+        while self._events and self._events[0][0] <= now:
+            _, _, order, is_cancel = heapq.heappop(self._events)
+            if order.status != PENDING:
+                continue
+            if is_cancel:
+                order.status = CANCELLED
+                changed.append(order)
+            else:
+                self._arrive(order, changed)
+        return changed
+
+    def _arrive(self, order: _Order, changed: typing.List[_Order]):
+        book = self._books.setdefault(order.token, _Book())
+        ltp = self._ltp(order.token)
+        if order.order_type in ('SL', 'SL-M'):
+            if ltp is not None and (ltp - order.trigger_price) * order.side >= 0:
+                order.triggered = True
+            else:
+                stops = book.buy_stops if order.side == 1 else book.sell_stops
+                heapq.heappush(stops, (order.trigger_price * order.side, next(self._sequence), order))
+                return
+        self._route(book, order, ltp, changed)
+
+    def _route(self, book: _Book, order: _Order, ltp: typing.Optional[float], changed: typing.List[_Order]):
+        """a market/limit order (or a triggered SL order) at the exchange: fill if marketable, else rest"""
+        if ltp is not None and order.is_market:
+            order.reference_price = ltp
+            self._fill(order, order.remaining, self.slippage.fill_price(ltp, order.side, order.tick_size), changed)
+        elif ltp is not None and (order.price - ltp) * order.side >= 0:  # marketable limit, filled at the ltp
+            order.reference_price = ltp
+            self._fill(order, order.remaining, ltp, changed)
+        else:  # market orders wait for the first tick
+            limits = book.bids if order.side == 1 else book.asks
+            priority = -math.inf if order.is_market else -order.price * order.side
+            heapq.heappush(limits, (priority, next(self._sequence), order))
+
+    def _match(self, book: _Book, ltp: float, traded_quantity: typing.Optional[float], changed: typing.List[_Order]):
+        # SL orders triggered by the tick become market/limit orders
+        for stops, side in ((book.buy_stops, 1), (book.sell_stops, -1)):
+            while stops and (stops[0][2].status != PENDING or (ltp - stops[0][2].trigger_price) * side >= 0):
+                order = heapq.heappop(stops)[2]
+                if order.status == PENDING:
+                    order.triggered = True
+                    self._route(book, order, ltp, changed)
+        # resting limit orders crossed by the tick
+        for limits, side in ((book.bids, 1), (book.asks, -1)):
+            available = None if traded_quantity is None else max(int(traded_quantity * self.participation), 1)
+            while limits:
+                order = limits[0][2]
+                if order.status != PENDING:
+                    heapq.heappop(limits)
+                    continue
+                if order.is_market:
+                    order.reference_price = ltp
+                    heapq.heappop(limits)
+                    self._fill(order, order.remaining, self.slippage.fill_price(ltp, side, order.tick_size), changed)
+                    continue
+                through = (order.price - ltp) * side
+                if through < 0:
+                    break
+                if through == 0 and available is not None:  # only touched: the orders ahead in the queue first
+                    order.touched += available
+                    if order.touched < order.remaining:
+                        break
+                    available = order.touched - order.remaining
+                order.reference_price = order.price
+                heapq.heappop(limits)
+                self._fill(order, order.remaining, order.price, changed)
+
+    def _fill(self, order: _Order, quantity: int, price: float, changed: typing.List[_Order]):
+        if quantity <= 0:
+            return
+        filled = order.filled + quantity
+        order.average_price = ((order.average_price or 0.0) * order.filled + price * quantity) / filled
+        order.filled = filled
+        if not order.remaining:
+            order.status = COMPLETE
+            changed.append(order)
+        self.fills.append({'order_id': order.order_id, 'account': order.account,
+                           'tradingsymbol': order.tradingsymbol,
+                           'transaction_type': 'BUY' if order.side == 1 else 'SELL', 'order_type': order.order_type,
+                           'quantity': quantity, 'price': price, 'reference_price': order.reference_price,
+                           'slippage': round((price - order.reference_price) * order.side, 4),
+                           'placed_at': order.placed_at, 'filled_at': self.clock()})
+
+    def _notify(self, changed: typing.List[_Order]):
+        for order in changed:
+            for callback in self._listeners.get(order.account, ()):
+                try:
+                    callback(OrderState(order.order_id, order.status), order.token)
+                except Exception:
+                    logger.error(f"Error in paper order update listener {order.order_id}", exc_info=True)
+
+    # ------------ statistics ------------
+    def stats(self) -> pd.DataFrame:
+        """per order type: orders, filled/cancelled, fill ratio, mean slippage and time to fill"""
+        orders = pd.DataFrame([{'order_type': order.order_type, 'status': order.status}
+                               for order in list(self._orders.values())], columns=['order_type', 'status'])
+        fills = pd.DataFrame(list(self.fills), columns=FILL_COLUMNS)
+        fills['time_to_fill_ms'] = (fills['filled_at'] - fills['placed_at']) * 1000
+        report = orders.groupby('order_type').agg(orders=('status', 'size'),
+                                                  filled=('status', lambda status: (status == COMPLETE).sum()),
+                                                  cancelled=('status', lambda status: (status == CANCELLED).sum()))
+        report['fill_ratio'] = (report['filled'] / report['orders']).round(3)
+        fill_stats = fills.groupby('order_type').agg(mean_slippage=('slippage', 'mean'),
+                                                     mean_time_to_fill_ms=('time_to_fill_ms', 'mean'))
+        return report.join(fill_stats).round(3).reset_index()
+
+    def dump(self, file_path: str):
+        """write the fills of the day"""
+        fills = pd.DataFrame(list(self.fills), columns=FILL_COLUMNS)
+        fills['date'] = datetime.now().strftime('%Y-%m-%d')
+        fills.to_csv(file_path, index=False)
+
+
+class PaperBroker:
+    """stands in for `All_Broker` of an account in paper trading, its orders go to the `PaperExchange`"""
+    broker_name = 'paper'
+
+    def __init__(self, exchange: PaperExchange, account: str):
+        self.exchange = exchange
+        self.account = account
+
+    def place_order(self, **kwargs):
+        """:return: order_id, message"""
+        return self.exchange.place_order(self.account, **kwargs)
+
+    def cancel_order(self, order_id):
+        """:return: message"""
+        return self.exchange.cancel_order(order_id)
+
+    def get_cached_order(self, order_id) -> typing.Optional[OrderState]:
+        return self.exchange.order(order_id)
+
+    def get_order_status(self, order_id):
+        """:return: order status, message"""
+        order = self.exchange.order(order_id)
+        if order is None:
+            return None, f"Order {order_id} not found in the order book"
+        return order.status, None
+
+    def get_order_book(self) -> pd.DataFrame:
+        return self.exchange.order_book(self.account)
+
+    def refresh_orders(self, force=False) -> bool:
+        self.exchange.advance()
+        return False
+
+    def add_order_listener(self, callback: typing.Callable[[OrderState, typing.Optional[int]], None]):
+        self.exchange.add_listener(self.account, callback)
+
+    def start_order_updates(self):
+        pass
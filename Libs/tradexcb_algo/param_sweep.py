@@ -0,0 +1,187 @@
+"""
+Parameter sweep of the strategy table over the backtest (`backtest.Backtest`).
+
+Every combination of the parameter grid (`settings.SWEEP_GRID`: buy_ltp_percent, sell_ltp_percent, stoploss,
+target, wait_time) is applied to all the rows of the strategy table and backtested, the combinations are
+ranked by profit.
+
+The combinations are split into contiguous chunks run on a process pool. The price arrays of all the
+instruments are copied once into a shared memory block; the workers map it (`_init_worker`) instead of
+receiving a copy, so starting a worker costs the same whatever the days/instruments swept. Each worker keeps
+the results of the rows it ran keyed by the parameters the row actually uses (e.g. a BUY row does not use
+sell_ltp_percent, a row without target order does not use target), so a row is backtested once per distinct
+set of its parameters, not once per combination. Candles of the past days are kept on disk by
+`backtest.load_candles` for the next sweeps.
+
+Run from the app directory: python -m Libs.tradexcb_algo.param_sweep
+"""
+import itertools
+import math
+import os
+import sys
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from Libs.Files import handle_user_details
+from Libs.Utils import exception_handler, settings
+from . import strategies
+from .backtest import Backtest, PriceSeries, load_candles
+from .instrument_state import LEVEL_NONE
+from .main_broker_api.All_Broker import All_Broker
+from .row_loader import StrategyRowLoader
+from .sharding import ShardSpec
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+# parameters in the order the combinations are enumerated: the last ones change the fastest, the ltp percents
+# come last as each of them is used only by the rows of one side (more cached rows within a chunk)
+SWEEP_PARAMETERS = ('stoploss', 'target', 'wait_time', 'buy_ltp_percent', 'sell_ltp_percent')
+RESULT_COLUMNS = ['rank', *SWEEP_PARAMETERS, 'trades', 'winning', 'win_rate', 'profit', 'worst_trade']
+
+Combination = typing.Dict[str, float]
+
+
+class _SweepWorker:
+    """backtest of the combinations in a worker process"""
+
+    def __init__(self, backtest: Backtest, prices: typing.Dict[int, PriceSeries]):
+        self.backtest = backtest
+        self.prices = prices
+        store = backtest.store
+        default_code = strategies.strategy_code(strategies.DefaultStrategy.name)
+        self.indices = [idx for idx in range(len(store))
+                        if store.state['active'][idx] and store.state['strategy'][idx] == default_code
+                        and store.state['instrument_token'][idx].item() in prices]
+        self.defaults = {idx: {field: store.state[field][idx].item() for field in SWEEP_PARAMETERS}
+                         for idx in self.indices}
+        # (row, parameters used by the row) -> trades, winning trades, profit, worst trade
+        self.results: typing.Dict[tuple, typing.Tuple[int, int, float, float]] = {}
+
+    def row_key(self, idx: int, parameters: Combination) -> tuple:
+        """the parameters of `parameters` (defaults of the row for the others) which change the trades of the row"""
+        state = self.backtest.store.state
+        used = dict(self.defaults[idx], **parameters)
+        side = state['side'][idx].item()
+        ltp_percent = used['buy_ltp_percent' if side == 1 else 'sell_ltp_percent']
+        return (idx,
+                ltp_percent if self.backtest.store.info[idx].order_type == 'LIMIT' else None,
+                used['stoploss'] if state['stoploss_type'][idx] != LEVEL_NONE else None,
+                used['target'] if state['target_type'][idx] != LEVEL_NONE else None,
+                used['wait_time'])
+
+    def run(self, parameters: Combination) -> typing.Dict[str, typing.Any]:
+        state = self.backtest.store.state
+        trade_count, winning, profit, worst_trade = 0, 0, 0.0, math.nan
+        for idx in self.indices:
+            key = self.row_key(idx, parameters)
+            result = self.results.get(key)
+            if result is None:
+                for field, value in dict(self.defaults[idx], **parameters).items():
+                    state[field][idx] = value
+                trades = self.backtest.run_row(idx, self.prices[state['instrument_token'][idx].item()])
+                profits = [trade['profit'] for trade in trades]
+                result = self.results[key] = (len(trades),
+                                              sum(trade['profit'] > 0 for trade in trades if trade['Row_Type'] == 'F'),
+                                              float(sum(profits)), min(profits, default=math.nan))
+            trade_count += result[0]
+            winning += result[1]
+            profit += result[2]
+            worst_trade = np.fmin(worst_trade, result[3])
+        return dict(parameters, trades=trade_count, winning=winning, profit=profit, worst_trade=worst_trade)
+
+
+_worker: typing.Optional[_SweepWorker] = None
+_worker_memory: typing.Optional[shared_memory.SharedMemory] = None
+
+
+def _init_worker(backtest: Backtest, memory_name: str, size: int,
+                 layout: typing.Dict[int, typing.Tuple[int, int]]):
+    """map the shared price arrays (times, ltp) of the sweep in a worker process"""
+    global _worker, _worker_memory
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    arrays = np.ndarray((2, size), dtype=np.float64, buffer=_worker_memory.buf)
+    prices = {token: PriceSeries(arrays[0, start:stop], arrays[1, start:stop])
+              for token, (start, stop) in layout.items()}
+    _worker = _SweepWorker(backtest, prices)
+
+
+def _run_combinations(combinations: typing.List[Combination]) -> typing.List[typing.Dict[str, typing.Any]]:
+    return [_worker.run(parameters) for parameters in combinations]
+
+
+def combinations_of(grid: typing.Dict[str, typing.Sequence[float]]) -> typing.List[Combination]:
+    """all the combinations of the values of the grid (parameters not in the grid keep the values of the rows)"""
+    fields = [field for field in SWEEP_PARAMETERS if grid.get(field)]
+    return [dict(zip(fields, values)) for values in itertools.product(*(grid[field] for field in fields))]
+
+
+def rank(results: typing.List[typing.Dict[str, typing.Any]]) -> pd.DataFrame:
+    """results of the combinations, best profit first"""
+    ranked = pd.DataFrame(results)
+    ranked['win_rate'] = (ranked['winning'] / ranked['trades'].where(ranked['trades'] > 0)).round(3)
+    ranked = ranked.sort_values(['profit', 'win_rate'], ascending=False, ignore_index=True)
+    ranked['rank'] = np.arange(1, len(ranked) + 1)
+    return ranked[[column for column in RESULT_COLUMNS if column in ranked.columns]]
+
+
+def sweep(backtest: Backtest, prices: typing.Dict[int, PriceSeries],
+          grid: typing.Optional[typing.Dict[str, typing.Sequence[float]]] = None,
+          workers: typing.Optional[int] = settings.SWEEP_WORKERS) -> pd.DataFrame:
+    """
+    backtest every combination of the grid over the prices, in parallel
+
+    :param backtest: the rows of the strategy table
+    :param prices: price series of each instrument token
+    :param grid: values of each parameter (default `settings.SWEEP_GRID`)
+    :param workers: processes (default one per CPU)
+    :return: results of the combinations (see `rank`)
+    """
+    combinations = combinations_of(settings.SWEEP_GRID if grid is None else grid)
+    workers = min(workers or os.cpu_count() or 1, len(combinations)) or 1
+    layout, size = {}, 0
+    for token, series in prices.items():
+        layout[token] = (size, size + len(series.ltp))
+        size += len(series.ltp)
+
+    memory = shared_memory.SharedMemory(create=True, size=max(2 * size * 8, 1))
+    try:
+        arrays = np.ndarray((2, size), dtype=np.float64, buffer=memory.buf)
+        for token, (start, stop) in layout.items():
+            arrays[0, start:stop] = prices[token].times
+            arrays[1, start:stop] = prices[token].ltp
+        del arrays  # the block can not be closed while mapped by an array
+
+        chunk_size = max(math.ceil(len(combinations) / (workers * 4)), 1)  # a few chunks per worker, to balance
+        chunks = [combinations[start:start + chunk_size] for start in range(0, len(combinations), chunk_size)]
+        logger.info(f"Sweeping {len(combinations)} combinations of {len(backtest.store)} rows over "
+                    f"{len(prices)} instruments with {workers} processes")
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(backtest, memory.name, size, layout)) as pool:
+            results = [result for chunk_results in pool.map(_run_combinations, chunks) for result in chunk_results]
+    finally:
+        memory.close()
+        memory.unlink()
+    return rank(results)
+
+
+def main(days: int = settings.BACKTEST_DAYS):
+    """sweep `settings.SWEEP_GRID` over the strategy table and the candles of the last `days` days"""
+    users = pd.DataFrame(handle_user_details.read_user_api_details())
+    main_broker = All_Broker(**users.iloc[0].to_dict())
+    backtest = Backtest()
+    StrategyRowLoader(backtest, ShardSpec(), All_Broker.instrument_df).reload()
+    to_dt = datetime.now()
+    prices = load_candles(main_broker, backtest.store.token_index, to_dt - timedelta(days=days), to_dt)
+    results = sweep(backtest, prices)
+    results.to_csv(settings.DATA_FILES['SWEEP_RESULTS_PATH'], index=False)
+    logger.info(f"Parameter sweep done, best combinations:\n{results.head(10)}")
+    print(results.head(10).to_string())
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else settings.BACKTEST_DAYS)
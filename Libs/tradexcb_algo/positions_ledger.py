@@ -0,0 +1,123 @@
+"""
+Positions of all the users, kept incrementally as the strategy opens, marks and closes trades.
+
+Open positions are keyed by (row key, user); closed trades are only appended. The DataFrame of the
+positions file is built on demand (`to_frame`), and the closed trades are converted to a DataFrame
+only once, so a full day of trades does not slow down the strategy loop.
+"""
+import typing
+
+import pandas as pd
+
+from Libs.Files import positions_snapshot
+
+POSITIONS_LEDGER_COLUMNS = ['tradingsymbol', 'exchange', 'quantity', 'multiplier', 'entry_price', 'entry_time',
+                            'exit_price', 'exit_time', 'target_price', 'sl_price', 'Row_Type', 'profit', 'ltp',
+                            'Trend', 'user_id']
+
+_TRADE_FIELDS = ('tradingsymbol', 'exchange', 'multiplier', 'entry_price', 'entry_time', 'exit_price', 'exit_time',
+                 'target_price', 'sl_price', 'ltp')
+
+
+def _profit(position: typing.Dict[str, typing.Any]) -> typing.Optional[float]:
+    try:
+        return (position['ltp'] - position['entry_price']) * position['quantity'] * position['multiplier']
+    except TypeError:  # ltp/entry price not known
+        return None
+
+
+class PositionsLedger:
+    """
+    Open positions and closed trades of every user, for the positions file / table.
+    Quantity and profit of an entry are of the user, i.e. scaled by the user's number of lots.
+    """
+
+    def __init__(self, users_df_dict: typing.Dict[str, typing.Dict[str, typing.Any]]):
+        # user -> (user_id shown in the positions table, number of lots)
+        self.users = {user: (details['accountUserName'], details['No of Lots'])
+                      for user, details in users_df_dict.items()}
+        self._open: typing.Dict[typing.Tuple[typing.Any, str], typing.Dict[str, typing.Any]] = {}
+        self._closed: typing.List[typing.Dict[str, typing.Any]] = []
+        self._realized = dict.fromkeys(self.users, 0.0)  # user -> profit of the closed trades
+        self._closed_frame = pd.DataFrame(columns=POSITIONS_LEDGER_COLUMNS)
+        self._snapshot_closed = 0  # closed trades already in the positions snapshot
+
+    def __len__(self):
+        return len(self._open) + len(self._closed)
+
+    @property
+    def open_count(self) -> int:
+        return len(self._open)
+
+    @property
+    def closed_count(self) -> int:
+        return len(self._closed)
+
+    def _entry(self, row: typing.Dict[str, typing.Any], user: str, row_type: str) -> typing.Dict[str, typing.Any]:
+        user_id, no_of_lots = self.users[user]
+        position = {field: row.get(field) for field in _TRADE_FIELDS}
+        position['quantity'] = row['quantity'] * no_of_lots
+        position['Row_Type'] = row_type
+        position['Trend'] = 'BUY' if row.get('multiplier') == 1 else 'SELL'
+        position['user_id'] = user_id
+        position['profit'] = _profit(position)
+        return position
+
+    def open(self, key, row: typing.Dict[str, typing.Any]):
+        """
+        add the open position of a row for every user
+
+        :param key: key of the strategy row
+        :param row: row of the strategy (`InstrumentStateStore.as_dict`)
+        """
+        for user in self.users:
+            self._open[(key, user)] = self._entry(row, user, row_type='T')
+
+    def update(self, key, ltp: float):
+        """mark the open positions of a row to `ltp`"""
+        for user in self.users:
+            position = self._open.get((key, user))
+            if position is not None:
+                position['ltp'] = ltp
+                position['profit'] = _profit(position)
+
+    def close(self, key, row: typing.Dict[str, typing.Any]):
+        """move the positions of a row to the closed trades, with the exit details of `row`"""
+        for user in self.users:
+            self._open.pop((key, user), None)
+            trade = self._entry(row, user, row_type='F')
+            self._closed.append(trade)
+            if not pd.isna(trade['profit']):
+                self._realized[user] += trade['profit']
+
+    def profit_by_user(self) -> typing.Dict[str, float]:
+        """mark-to-market profit of each user: closed trades and open positions at their ltp"""
+        profits = dict(self._realized)
+        for (key, user), position in self._open.items():
+            if not pd.isna(position['profit']):
+                profits[user] += position['profit']
+        return profits
+
+    def is_open(self, key) -> bool:
+        return any((key, user) in self._open for user in self.users)
+
+    def to_frame(self) -> pd.DataFrame:
+        """positions of all users (closed trades first, then the open positions) as a new DataFrame"""
+        converted = len(self._closed_frame)
+        if converted < len(self._closed):
+            new_trades = pd.DataFrame(self._closed[converted:], columns=POSITIONS_LEDGER_COLUMNS)
+            self._closed_frame = pd.concat([self._closed_frame, new_trades], ignore_index=True)
+        if not self._open:
+            return self._closed_frame.copy()
+        open_positions = pd.DataFrame(list(self._open.values()), columns=POSITIONS_LEDGER_COLUMNS)
+        return pd.concat([self._closed_frame, open_positions], ignore_index=True)
+
+    def write_snapshot(self, writer: positions_snapshot.PositionsSnapshotWriter):
+        """
+        publish the positions to the snapshot file, only the closed trades since the last write are encoded
+        (and the ones left out of the previous writes, the file being full)
+        """
+        keep = self._snapshot_closed
+        closed = self._closed[keep:]
+        written = writer.write(positions_snapshot.to_records(closed + list(self._open.values())), keep=keep)
+        self._snapshot_closed = keep + min(written, len(closed))
@@ -0,0 +1,424 @@
+"""
+Deterministic market replay of the strategy.
+
+Recorded (`load_ticks`) or synthetic (`synthetic_ticks`) ticks are fed to a `StrategyEngine` as fast as it
+can process them, the way `main_strategy.main` does (rows of the ticked instrument on every tick, all the
+rows once per housekeeping interval), against `ReplayBroker` accounts which fill the orders by rule:
+
+    MARKET           -> filled at the ltp when placed
+    LIMIT BUY/SELL   -> filled once the ltp is at/below (BUY) or at/above (SELL) the price
+    SL BUY/SELL      -> filled once the ltp is at/above (BUY) or at/below (SELL) the trigger price
+
+The clock of the engine (`now`) and of the exits is the replay time, so the same ticks always give the
+same orders. `run_replay` reports the throughput, the CPU time per cycle, the orders and the positions.
+
+`crash_restore_check` replays the ticks with the state journaled (`state_journal`), kills the engine while it
+sends an order (the tag of the order is journaled, its acknowledgement never reaches the engine), restarts it
+from the journal and replays the rest, checking that no logical order (tag) was sent twice and that the rows
+come back under their keys.
+"""
+import concurrent.futures
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import typing
+
+import numpy as np
+import pandas as pd
+
+from Libs.Utils import exception_handler, settings
+from .main_broker_api.order_cache import OrderState
+from .main_broker_api.order_tags import OrderTagIndex, broker_tag
+from .state_journal import StateJournal
+from .strategy_engine import StrategyEngine
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+ORDER_COLUMNS = ['account', 'order_id', 'time', 'tradingsymbol', 'transaction_type', 'order_type', 'quantity',
+                 'price', 'trigger_price', 'status', 'fill_price', 'fill_time', 'tag']
+
+
+class ProcessKilled(BaseException):
+    """the algo process is killed (raised through the engine, which only handles `Exception`)"""
+
+
+class Tick(typing.NamedTuple):
+    time: float  # epoch seconds
+    instrument_token: int
+    ltp: float
+
+
+def load_ticks(file_path: str) -> typing.List[Tick]:
+    """ticks of a csv file with the columns timestamp (parsable date/time), instrument_token and last_price"""
+    ticks_df = pd.read_csv(file_path)
+    timestamps = pd.to_datetime(ticks_df['timestamp']).map(pd.Timestamp.timestamp)
+    ticks_df = ticks_df.assign(timestamp=timestamps).sort_values('timestamp', kind='mergesort')
+    return [Tick(float(ts), int(token), float(ltp)) for ts, token, ltp in
+            zip(ticks_df['timestamp'], ticks_df['instrument_token'], ticks_df['last_price'])]
+
+
+def synthetic_ticks(start_prices: typing.Dict[int, float], count: int, start_time: float, interval: float = 0.25,
+                    volatility: float = 0.002, tick_size: float = 0.05, seed: int = 0) -> typing.List[Tick]:
+    """
+    random walk of the ltp of each instrument, a tick of a random instrument every `interval` seconds
+
+    :param start_prices: {instrument_token: first ltp}
+    :param seed: same seed gives the same ticks
+    """
+    rng = np.random.default_rng(seed)
+    tokens = list(start_prices)
+    prices = dict(start_prices)
+    ticks = []
+    for i, token_pos in enumerate(rng.integers(0, len(tokens), size=count)):
+        token = tokens[token_pos]
+        price = prices[token] * (1 + rng.normal(0, volatility))
+        prices[token] = max(round(round(price / tick_size) * tick_size, 2), tick_size)
+        ticks.append(Tick(start_time + i * interval, token, prices[token]))
+    return ticks
+
+
+class ReplayClock:
+    """replay time, used as both the wall clock (epoch) and the monotonic clock of the engine"""
+
+    def __init__(self, start: float = 0.0):
+        self.time = start
+
+    def now(self) -> float:
+        return self.time
+
+    def advance_to(self, timestamp: float):
+        self.time = max(self.time, timestamp)  # exits waiting for the broker may have moved the clock ahead
+
+
+class ReplayEngine(StrategyEngine):
+    """strategy engine running on the replay time"""
+
+    def __init__(self, users_df_dict, main_broker, paper_trade: int, clock: ReplayClock):
+        super(ReplayEngine, self).__init__(users_df_dict, main_broker, paper_trade)
+        self.clock = clock
+        self.exits.clock = clock.now
+
+    def now(self) -> float:
+        return self.clock.now()
+
+
+class ReplayBroker:
+    """
+    stands in for `All_Broker` of an account, fills the orders by rule at the replayed ltps. Orders are tagged
+    and a tag sent before is looked up in the order book instead of being sent again, as `All_Broker.place_order`.
+    """
+
+    def __init__(self, account: str, clock: ReplayClock, latest_ltp: typing.Dict[int, typing.Dict[str, float]],
+                 broker_name: str = 'zerodha'):
+        self.account = account
+        self.broker_name = broker_name
+        self.clock = clock
+        self.latest_ltp = latest_ltp  # shared by the accounts, filled by the replay
+        self.tick_received_at = dict()
+        self.tokens: typing.Dict[str, int] = {}  # tradingsymbol -> instrument token
+        self.orders: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        self.order_tags = OrderTagIndex(account)
+        self.kill_on_send: typing.Optional[bool] = None  # kill the process on the next send, after the order
+        # reached the exchange (True) or before (False)
+        self._open: typing.Dict[int, typing.List[str]] = {}  # instrument token -> ids of the open orders
+        self.unacknowledged: typing.List[typing.Tuple[str, typing.Optional[str]]] = []  # (tag, order id) of the
+        # sends the process was killed on
+        self._tagged: typing.Dict[str, str] = {}  # broker tag -> order id
+        self._order_ids = itertools.count(1)
+
+    def restarted(self) -> 'ReplayBroker':
+        """the account in a new algo process: same orders at the exchange, nothing known of the ones sent"""
+        broker = ReplayBroker(self.account, self.clock, self.latest_ltp, self.broker_name)
+        broker.tokens = self.tokens
+        broker.orders, broker._open, broker._tagged, broker._order_ids = \
+            self.orders, self._open, self._tagged, self._order_ids
+        return broker
+
+    def place_order(self, **kwargs):
+        """:return: order_id, message"""
+        tag = kwargs.get('tag') or self.order_tags.new_tag(kwargs['tradingsymbol'])
+        if self.order_tags.sent(tag):
+            order = self.find_tagged_order(tag)
+            if order is not None:
+                return order.order_id, 'success'
+        if self.kill_on_send is False:
+            self.unacknowledged.append((tag, None))
+            raise ProcessKilled(f"killed before sending {tag}")
+        self.order_tags.mark_sent(tag)
+        token = self.tokens[kwargs['tradingsymbol']]
+        order_id = f"{self.account}-{next(self._order_ids)}"
+        self.orders[order_id] = {'account': self.account, 'order_id': order_id, 'time': self.clock.now(),
+                                 'tradingsymbol': kwargs['tradingsymbol'],
+                                 'transaction_type': kwargs['transaction_type'], 'order_type': kwargs['order_type'],
+                                 'quantity': kwargs['quantity'], 'price': kwargs.get('price'),
+                                 'trigger_price': kwargs.get('trigger_price'), 'status': 'PENDING',
+                                 'fill_price': None, 'fill_time': None, 'tag': broker_tag(tag),
+                                 'instrument_token': token}
+        self._tagged[broker_tag(tag)] = order_id
+        self._open.setdefault(token, []).append(order_id)
+        self.on_tick(token)
+        if self.kill_on_send:
+            self.unacknowledged.append((tag, order_id))
+            raise ProcessKilled(f"killed before the acknowledgement of {tag} ({order_id})")
+        self.order_tags.acknowledged(tag, order_id)
+        return order_id, 'success'
+
+    def find_tagged_order(self, tag: str) -> typing.Optional[OrderState]:
+        """the order tagged `tag` at the exchange, known as placed from then on"""
+        order_id = self._tagged.get(broker_tag(tag))
+        if order_id is None:
+            return None
+        self.order_tags.acknowledged(tag, order_id)
+        return self.get_cached_order(order_id)
+
+    def get_cached_order(self, order_id) -> typing.Optional[OrderState]:
+        order = self.orders.get(order_id)
+        return None if order is None else OrderState(order_id, order['status'], tag=order['tag'])
+
+    def get_order_status(self, order_id):
+        """:return: order status, message"""
+        order = self.orders.get(order_id)
+        if order is None:
+            return None, f"Order {order_id} not found in the order book"
+        return order['status'], None
+
+    def cancel_order(self, order_id):
+        """:return: message ('success' if cancelled)"""
+        order = self.orders.get(order_id)
+        if order is None or order['status'] != 'PENDING':
+            return f"Order {order_id} can not be cancelled"
+        order['status'] = 'CANCELLED'
+        self._open[order['instrument_token']].remove(order_id)
+        return 'success'
+
+    def refresh_orders(self, force=False) -> bool:
+        return False
+
+    def on_tick(self, instrument_token: int):
+        """fill the open orders of the instrument which the current ltp reaches"""
+        ltp = self.latest_ltp.get(instrument_token, {}).get('ltp')
+        open_orders = self._open.get(instrument_token)
+        if ltp is None or not open_orders:
+            return
+        for order_id in list(open_orders):
+            order = self.orders[order_id]
+            side = 1 if order['transaction_type'] == 'BUY' else -1
+            if order['order_type'] == 'MARKET':
+                filled = True
+            elif order['order_type'] in ('SL', 'SL-M'):
+                filled = ltp * side >= order['trigger_price'] * side
+            else:
+                filled = order['price'] is None or ltp * side <= order['price'] * side
+            if filled:
+                order['status'] = 'COMPLETE'
+                order['fill_price'] = ltp
+                order['fill_time'] = self.clock.now()
+                open_orders.remove(order_id)
+
+
+class ReplayReport(typing.NamedTuple):
+    ticks: int
+    wall_time: float  # seconds taken by the replay
+    ticks_per_sec: float
+    cycle_cpu_ms: typing.Dict[str, float]  # mean/p50/p99/max CPU time of a strategy cycle
+    orders: pd.DataFrame  # orders of all the accounts, in the order they were placed
+    positions: pd.DataFrame  # positions of all the accounts (`PositionsLedger.to_frame`)
+    profit: float  # profit of the closed trades and of the open positions at the last ltp
+
+
+class CrashRestoreReport(typing.NamedTuple):
+    killed_at: typing.Optional[float]  # replay time the process was killed, None if no order was sent after
+    unacknowledged: typing.List[typing.Tuple[str, str, typing.Optional[str]]]  # (account, tag, order id) of the
+    # orders sent when the process was killed, order id None for the ones which did not reach the exchange
+    restored_keys: typing.List[typing.Any]  # keys of the rows restored from the journal
+    orders: pd.DataFrame  # orders of all the accounts, both runs
+    problems: typing.List[str]
+
+    @property
+    def ok(self) -> bool:
+        return not self.problems
+
+
+def make_users(accounts: typing.Dict[str, int], clock: ReplayClock,
+               latest_ltp: typing.Dict[int, typing.Dict[str, float]]) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """users_df_dict of replay accounts: {account: number of lots}"""
+    return {account: {'Name': account, 'accountUserName': account, 'No of Lots': lots,
+                      'broker': ReplayBroker(account, clock, latest_ltp)}
+            for account, lots in accounts.items()}
+
+
+class _Replayer:
+    """a run of the algo process over the replayed ticks"""
+
+    def __init__(self, rows: typing.Dict[typing.Any, typing.Dict[str, typing.Any]],
+                 users_df_dict: typing.Dict[str, typing.Dict[str, typing.Any]], paper_trade: int, clock: ReplayClock,
+                 latest_ltp: typing.Dict[int, typing.Dict[str, float]], housekeeping_interval: float):
+        self.clock = clock
+        self.latest_ltp = latest_ltp
+        self.housekeeping_interval = housekeeping_interval
+        self.brokers: typing.List[ReplayBroker] = [user['broker'] for user in users_df_dict.values()]
+        self.engine = ReplayEngine(users_df_dict, self.brokers[0], paper_trade, clock)
+        for key, row in rows.items():
+            self.engine.add_row(key, row)
+            for broker in self.brokers:
+                broker.tokens[row['tradingsymbol']] = int(row['instrument_token'])
+        self.next_housekeeping = clock.now()
+
+    def drain_exits(self):
+        # run the exits to completion, waiting for the broker calls / moving the clock to the next due step
+        exits = self.engine.exits
+        exits.step()
+        while len(exits):
+            in_flight = exits.in_flight()
+            if in_flight:
+                concurrent.futures.wait(in_flight)
+            else:
+                self.clock.advance_to(exits.next_due())
+            exits.step()
+
+    def on_tick(self, tick: Tick):
+        self.clock.advance_to(tick.time)
+        self.latest_ltp.setdefault(tick.instrument_token, {})['ltp'] = tick.ltp
+        for broker in self.brokers:
+            broker.on_tick(tick.instrument_token)
+        if self.clock.now() >= self.next_housekeeping:
+            self.next_housekeeping = self.clock.now() + self.housekeeping_interval
+            row_indices = None
+        else:
+            row_indices = self.engine.rows_for_tokens([tick.instrument_token])
+        self.engine.evaluate(row_indices)
+        self.drain_exits()
+
+    def orders(self) -> pd.DataFrame:
+        orders = pd.DataFrame([order for broker in self.brokers for order in broker.orders.values()],
+                              columns=ORDER_COLUMNS)
+        return orders.sort_values(['time', 'account', 'order_id'], kind='mergesort').reset_index(drop=True)
+
+
+def run_replay(rows: typing.Dict[typing.Any, typing.Dict[str, typing.Any]], ticks: typing.Iterable[Tick],
+               accounts: typing.Optional[typing.Dict[str, int]] = None, paper_trade: int = 0,
+               housekeeping_interval: float = settings.STRATEGY_HOUSEKEEPING_INTERVAL) -> ReplayReport:
+    """
+    replay `ticks` through the strategy
+
+    :param rows: strategy rows {key: row}, with their instrument details (as given to `StrategyEngine.add_row`)
+    :param ticks: ticks in time order
+    :param accounts: {account: number of lots}, one account with a single lot by default
+    :param housekeeping_interval: replay seconds between the passes over all the rows
+    """
+    ticks = list(ticks)
+    clock = ReplayClock(ticks[0].time if ticks else 0.0)
+    latest_ltp: typing.Dict[int, typing.Dict[str, float]] = {}
+    replayer = _Replayer(rows, make_users(accounts or {'replay': 1}, clock, latest_ltp), paper_trade, clock,
+                         latest_ltp, housekeeping_interval)
+
+    cycle_cpu = np.zeros(len(ticks))
+    started = time.perf_counter()
+    for i, tick in enumerate(ticks):
+        cycle_started = time.process_time()
+        replayer.on_tick(tick)
+        cycle_cpu[i] = time.process_time() - cycle_started
+    wall_time = time.perf_counter() - started
+    replayer.engine.fanout.shutdown()
+
+    orders = replayer.orders()
+    positions = replayer.engine.ledger.to_frame()
+    cycle_cpu_ms = {'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+    if len(ticks):
+        cycle_cpu_ms = {'mean': float(cycle_cpu.mean() * 1000),
+                        'p50': float(np.percentile(cycle_cpu, 50) * 1000),
+                        'p99': float(np.percentile(cycle_cpu, 99) * 1000),
+                        'max': float(cycle_cpu.max() * 1000)}
+    return ReplayReport(ticks=len(ticks), wall_time=wall_time,
+                        ticks_per_sec=len(ticks) / wall_time if wall_time > 0 else float('inf'),
+                        cycle_cpu_ms=cycle_cpu_ms, orders=orders, positions=positions,
+                        profit=float(pd.to_numeric(positions['profit'], errors='coerce').sum()))
+
+
+def crash_restore_check(rows: typing.Dict[typing.Any, typing.Dict[str, typing.Any]], ticks: typing.Iterable[Tick],
+                        accounts: typing.Optional[typing.Dict[str, int]] = None, kill_after: float = 0.5,
+                        order_reached_exchange: bool = True,
+                        housekeeping_interval: float = settings.STRATEGY_HOUSEKEEPING_INTERVAL) -> CrashRestoreReport:
+    """
+    replay `ticks` with the state journaled, kill the algo process on the first order sent after `kill_after` of
+    the ticks (its tag journaled, its acknowledgement lost), restart it from the journal (as `main_strategy`) and
+    replay the rest. Problems reported: a tag sent more than once, a row restored under another key, an order
+    which reached the exchange not found back by its tag.
+
+    :param order_reached_exchange: the process is killed after the order reached the exchange, else before
+    """
+    ticks = list(ticks)
+    clock = ReplayClock(ticks[0].time if ticks else 0.0)
+    latest_ltp: typing.Dict[int, typing.Dict[str, float]] = {}
+    users_df_dict = make_users(accounts or {'replay': 1}, clock, latest_ltp)
+    journal_dir = tempfile.mkdtemp(prefix='replay_journal_')
+    journal_path = os.path.join(journal_dir, 'state_journal.db')
+    problems = []
+    try:
+        replayer = _Replayer(rows, users_df_dict, 0, clock, latest_ltp, housekeeping_interval)
+        replayer.engine.journal = journal = StateJournal(journal_path)
+        killed_at, resume_from = None, len(ticks)
+        for i, tick in enumerate(ticks):
+            if i == int(len(ticks) * kill_after):
+                for broker in replayer.brokers:
+                    broker.kill_on_send = order_reached_exchange
+            try:
+                replayer.on_tick(tick)
+            except ProcessKilled as e:
+                logger.info(f"Replay: {e} at tick {i}")
+                killed_at, resume_from = clock.now(), i + 1
+                break
+        replayer.engine.fanout.shutdown()  # the sends on the wire when the process died reach the exchange
+        journal.close()
+        old_brokers = replayer.brokers
+        unacknowledged = [(broker.account, tag, order_id) for broker in old_brokers
+                          for tag, order_id in broker.unacknowledged]
+
+        restarted_users = {account: dict(user, broker=user['broker'].restarted())
+                           for account, user in users_df_dict.items()}
+        replayer = _Replayer(rows, restarted_users, 0, clock, latest_ltp, housekeeping_interval)
+        replayer.engine.journal = journal = StateJournal(journal_path)
+        checkpoint = journal.load()
+        restored = replayer.engine.restore(checkpoint)
+        restored_keys = [replayer.engine.store.info[idx].key for idx in restored]
+        if sorted(map(str, restored_keys)) != sorted(map(str, checkpoint.rows)):
+            problems.append(f"rows {sorted(checkpoint.rows, key=str)} of the journal restored as "
+                            f"{sorted(restored_keys, key=str)}")
+        brokers = {broker.account: broker for broker in replayer.brokers}
+        for account, tag, order_id in unacknowledged:
+            if order_id is not None and brokers[account].order_tags.order_id(tag) != order_id:
+                problems.append(f"order {order_id} ({tag}) of {account} not found by its tag after the restart")
+        for tick in ticks[resume_from:]:
+            replayer.on_tick(tick)
+        replayer.engine.fanout.shutdown()
+        journal.close()
+    finally:
+        shutil.rmtree(journal_dir, ignore_errors=True)
+
+    orders = replayer.orders()
+    for tag, count in orders['tag'].value_counts().items():
+        if count > 1:
+            problems.append(f"{count} orders tagged {tag}")
+    for problem in problems:
+        logger.error(f"Replay crash/restore: {problem}")
+    return CrashRestoreReport(killed_at=killed_at, unacknowledged=unacknowledged, restored_keys=restored_keys,
+                              orders=orders, problems=problems)
+
+
+if __name__ == '__main__':
+    _rows = {1: {'transaction_type': 'BUY', 'instrument_token': 1, 'tradingsymbol': 'REPLAY1', 'exchange': 'NFO',
+                 'tick_size': 0.05, 'lot_size': 50, 'quantity': 50, 'order_type': 'LIMIT', 'product_type': 'MIS',
+                 'buy_ltp_percent': 0.1, 'sell_ltp_percent': 0.1, 'wait_time': 1, 'target_type': 'Percentage',
+                 'target': 0.5, 'stoploss_type': 'Percentage', 'stoploss': 0.5}}
+    _report = run_replay(_rows, synthetic_ticks({1: 100.0}, count=20000, start_time=time.time()),
+                         accounts={'replay-1': 1, 'replay-2': 2})
+    print(f"{_report.ticks} ticks, {_report.ticks_per_sec:.0f} ticks/s, cycle CPU {_report.cycle_cpu_ms} ms, "
+          f"{len(_report.orders)} orders, profit {_report.profit:.2f}")
+    for _reached in (True, False):
+        _check = crash_restore_check(_rows, synthetic_ticks({1: 100.0}, count=2000, start_time=time.time()),
+                                     accounts={'replay-1': 1, 'replay-2': 2}, order_reached_exchange=_reached)
+        print(f"crash/restore (order {'reached' if _reached else 'not sent'}): "
+              f"{'ok' if _check.ok else _check.problems}, unacknowledged {_check.unacknowledged}, "
+              f"restored rows {_check.restored_keys}, {len(_check.orders)} orders")
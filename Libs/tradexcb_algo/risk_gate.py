@@ -0,0 +1,202 @@
+"""
+Pre-trade risk checks of the entry orders, before they are sent to the broker.
+
+Running counters are kept per account (notional of the open entries, orders sent in the current second,
+mark-to-market profit) and per (account, instrument) (open quantity), so an order is checked with a few
+dict lookups. An entry breaching a limit is clipped (to whole lots) or rejected, with the reason logged.
+Exit/SL orders are never blocked, they only reduce the risk.
+
+Limits (`settings.RISK_LIMITS`, overridden per account by `settings.RISK_ACCOUNT_LIMITS`), None for no limit:
+    max_order_quantity      quantity of a single entry order
+    max_instrument_quantity open quantity of an instrument
+    max_orders_per_second   entry orders sent per second
+    max_notional            quantity * price of the open entries
+    max_loss                no new entries once the mark-to-market loss of the account reaches this
+
+The counters are kept per algo process. With the rows sharded across processes (`sharding`), each shard gets
+its share of the limits of an account (`split_limits`), so that all the shards together stay within them.
+"""
+import threading
+import time
+import typing
+
+from Libs.Utils import exception_handler, settings
+from .sharding import ShardSpec, SHARD_BY_INSTRUMENT
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+LIMIT_NAMES = ('max_order_quantity', 'max_instrument_quantity', 'max_orders_per_second', 'max_notional', 'max_loss')
+# limits shared by the shards of an account (the quantity of a single order is not)
+SHARED_LIMIT_NAMES = ('max_instrument_quantity', 'max_orders_per_second', 'max_notional', 'max_loss')
+
+
+def split_limits(limits: typing.Dict[str, typing.Optional[float]], shard: ShardSpec) -> typing.Dict[str, typing.Any]:
+    """
+    share of the limits of an account for one shard: the limits shared by the shards divided by the shard count,
+    rounded down for the counts. The instruments are not shared when the rows are sharded by instrument.
+    """
+    if shard.count <= 1:
+        return dict(limits)
+    split = dict(limits)
+    for name in SHARED_LIMIT_NAMES:
+        if split.get(name) is None or (name == 'max_instrument_quantity' and shard.by == SHARD_BY_INSTRUMENT):
+            continue
+        if name in ('max_notional', 'max_loss'):
+            split[name] = split[name] / shard.count
+        else:
+            split[name] = int(split[name] // shard.count)
+    return split
+
+
+class RiskDecision(typing.NamedTuple):
+    quantity: int  # quantity allowed to be sent, 0 if rejected
+    reason: typing.Optional[str] = None  # why the order was clipped/rejected
+
+
+class _AccountRisk:
+    __slots__ = ('limits', 'notional', 'mtm', 'second', 'orders_in_second')
+
+    def __init__(self, limits: typing.Dict[str, typing.Optional[float]]):
+        self.limits = limits
+        self.notional = 0.0
+        self.mtm = 0.0
+        self.second = 0  # current second (epoch) of the order rate counter
+        self.orders_in_second = 0
+
+
+class RiskGate:
+    """
+    risk counters of all accounts of the algo process, checks are safe to run from the order threads
+
+    :param shard: shard of the strategy rows the process runs, the limits are split between the shards
+    """
+
+    def __init__(self, limits: typing.Optional[typing.Dict[str, typing.Optional[float]]] = None,
+                 account_limits: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Optional[float]]]] = None,
+                 shard: ShardSpec = ShardSpec()):
+        self.limits = dict.fromkeys(LIMIT_NAMES)
+        self.limits.update(settings.RISK_LIMITS if limits is None else limits)
+        self.account_limits = settings.RISK_ACCOUNT_LIMITS if account_limits is None else account_limits
+        self.shard = shard
+        self._accounts: typing.Dict[str, _AccountRisk] = {}
+        self._instrument_quantity: typing.Dict[typing.Tuple[str, str], int] = {}  # (account, symbol) -> open qty
+        self._entries: typing.Dict[typing.Tuple[str, typing.Any], typing.Tuple[str, int, float]] = {}
+        self._lock = threading.Lock()
+
+    def _account(self, account: str) -> _AccountRisk:
+        risk = self._accounts.get(account)
+        if risk is None:
+            limits = dict(self.limits)
+            limits.update(self.account_limits.get(account, {}))
+            split = split_limits(limits, self.shard)
+            if split != limits:
+                logger.warning(f"Risk limits of {account} split between {self.shard.count} shards, shard "
+                               f"{self.shard.index} checks against {split}")
+                if any(split[name] == 0 for name in SHARED_LIMIT_NAMES if limits[name]):
+                    logger.warning(f"Risk limits of {account} are too low to be split between {self.shard.count} "
+                                   f"shards, entries of shard {self.shard.index} are rejected")
+            risk = self._accounts[account] = _AccountRisk(split)
+        return risk
+
+    def check_entry(self, account: str, key, order: typing.Dict[str, typing.Any], ltp: float,
+                    lot_size: int = 1) -> RiskDecision:
+        """
+        check an entry order of a row for an account, and count it as open if allowed
+
+        :param key: key of the strategy row the entry is for
+        :param order: the order (kwargs of `All_Broker.place_order`)
+        :param ltp: ltp of the instrument, the price of market orders
+        :return: the quantity allowed (whole lots of `lot_size`), 0 if the order must not be sent
+        """
+        quantity = int(order['quantity'])
+        price = order.get('price') or ltp
+        symbol = order['tradingsymbol']
+        reasons = []
+        with self._lock:
+            risk = self._account(account)
+            limits = risk.limits
+
+            if limits['max_loss'] is not None and risk.mtm <= -limits['max_loss']:
+                return self._rejected(account, symbol, f"loss {-risk.mtm:.2f} reached max_loss {limits['max_loss']}")
+
+            second = int(time.time())
+            if second != risk.second:
+                risk.second, risk.orders_in_second = second, 0
+            if limits['max_orders_per_second'] is not None and risk.orders_in_second >= limits['max_orders_per_second']:
+                return self._rejected(account, symbol, f"max_orders_per_second {limits['max_orders_per_second']}")
+
+            allowed = quantity
+            if limits['max_order_quantity'] is not None and allowed > limits['max_order_quantity']:
+                allowed = limits['max_order_quantity']
+                reasons.append(f"max_order_quantity {limits['max_order_quantity']}")
+            open_quantity = self._instrument_quantity.get((account, symbol), 0)
+            if limits['max_instrument_quantity'] is not None and \
+                    open_quantity + allowed > limits['max_instrument_quantity']:
+                allowed = limits['max_instrument_quantity'] - open_quantity
+                reasons.append(f"max_instrument_quantity {limits['max_instrument_quantity']} (open {open_quantity})")
+            if limits['max_notional'] is not None and price and \
+                    risk.notional + allowed * price > limits['max_notional']:
+                allowed = int((limits['max_notional'] - risk.notional) // price)
+                reasons.append(f"max_notional {limits['max_notional']} (open {risk.notional:.2f})")
+
+            allowed = max(allowed, 0) // lot_size * lot_size
+            if not allowed:
+                return self._rejected(account, symbol, ", ".join(reasons))
+
+            risk.orders_in_second += 1
+            risk.notional += allowed * (price or 0.0)
+            self._instrument_quantity[(account, symbol)] = open_quantity + allowed
+            self._entries[(account, key)] = (symbol, allowed, price or 0.0)
+
+        reason = None
+        if allowed < quantity:
+            reason = ", ".join(reasons)
+            logger.warning(f"Risk check clipped the {symbol} entry of {account} from {quantity} to {allowed}: {reason}")
+        return RiskDecision(allowed, reason)
+
+    @staticmethod
+    def _rejected(account: str, symbol: str, reason: str) -> RiskDecision:
+        logger.warning(f"Risk check rejected the {symbol} entry of {account}: {reason}")
+        return RiskDecision(0, reason)
+
+    def quantity(self, account: str, key) -> typing.Optional[int]:
+        """open quantity of the entry of a row for an account (None if it has none)"""
+        entry = self._entries.get((account, key))
+        return None if entry is None else entry[1]
+
+    def entry(self, account: str, key) -> typing.Optional[typing.Tuple[str, int, float]]:
+        """tradingsymbol, quantity and price of the open entry of a row for an account (None if it has none)"""
+        return self._entries.get((account, key))
+
+    def restore_entry(self, account: str, key, symbol: str, quantity: int, price: float):
+        """count an entry opened before a restart of the algo (see `state_journal`), without checking it"""
+        with self._lock:
+            risk = self._account(account)
+            risk.notional += quantity * price
+            open_quantity = self._instrument_quantity.get((account, symbol), 0)
+            self._instrument_quantity[(account, symbol)] = open_quantity + quantity
+            self._entries[(account, key)] = (symbol, quantity, price)
+
+    def close(self, account: str, key) -> typing.Optional[int]:
+        """
+        the entry of a row is closed (exited) or was not placed, for an account
+
+        :return: its quantity (None if it had no open entry)
+        """
+        with self._lock:
+            entry = self._entries.pop((account, key), None)
+            if entry is None:
+                return None
+            symbol, quantity, price = entry
+            risk = self._account(account)
+            risk.notional = max(risk.notional - quantity * price, 0.0)
+            remaining = self._instrument_quantity.get((account, symbol), 0) - quantity
+            if remaining > 0:
+                self._instrument_quantity[(account, symbol)] = remaining
+            else:
+                self._instrument_quantity.pop((account, symbol), None)
+        return quantity
+
+    def update_mtm(self, account: str, mtm: float):
+        """mark-to-market profit of the account (closed trades and open positions at their ltp)"""
+        self._account(account).mtm = mtm
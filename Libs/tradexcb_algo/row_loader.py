@@ -0,0 +1,148 @@
+"""
+Incremental (re)load of the strategy rows from the strategy workbook.
+
+The workbook is streamed in read-only mode and every row is fingerprinted (`calculations.dict_hash`);
+only the rows whose fingerprint changed since the last load are touched:
+
+    new row                          -> instrument lookup, added to the store
+    edited row, same instrument/side -> parameters updated in place (`InstrumentStateStore.update_row`)
+    edited row, other instrument     -> old row retired, new row added (once the old row has no open trade)
+    deleted row                      -> retired (takes no new entries, an open trade is still managed)
+"""
+import typing
+
+import openpyxl
+
+from Libs.Files.TradingSymbolMapping import StrategiesColumn
+from Libs.Utils import settings, exception_handler, calculations
+from . import strategies
+from .instrument_state import STATUS_IDLE
+from .sharding import ShardSpec
+from .strategy_engine import StrategyEngine
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+Row = typing.Dict[str, typing.Any]
+
+
+class ReloadResult(typing.NamedTuple):
+    added: typing.List[typing.Any]
+    updated: typing.List[typing.Any]
+    retired: typing.List[typing.Any]
+    new_tokens: typing.List[int]  # instrument tokens not traded by any row before this reload
+
+
+def read_strategy_rows(file_path: str, sheet_name: str = 'Sheet1') -> typing.Dict[int, Row]:
+    """
+    :return: rows of the strategy sheet keyed by their position under the header (1 for the first row),
+        the same keys as the instruments_df_dict of the strategy
+    """
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows_iter = wb[sheet_name].iter_rows(values_only=True)
+        columns = next(rows_iter, None)
+        if columns is None:
+            return {}
+        rows = {}
+        for key, values in enumerate(rows_iter, start=1):
+            if all(value is None for value in values):
+                continue  # trailing empty rows of the sheet
+            rows[key] = dict(zip(columns, values))
+        return rows
+    finally:
+        wb.close()
+
+
+def row_fingerprint(row: Row) -> str:
+    """hash of the values of a workbook row (values which are not JSON types are hashed as text)"""
+    return calculations.dict_hash({str(column): value if value is None or isinstance(value, (int, float, str))
+                                   else str(value) for column, value in row.items()})
+
+
+class StrategyRowLoader:
+    """keeps the store of `engine` in sync with the strategy workbook, for the rows owned by `shard`"""
+
+    def __init__(self, engine: StrategyEngine, shard: ShardSpec, instrument_df):
+        self.engine = engine
+        self.shard = shard
+        self.instrument_df = instrument_df
+        self.fingerprints: typing.Dict[typing.Any, str] = {}  # key -> fingerprint of the row loaded for it
+        self._instruments: typing.Dict[str, Row] = {}  # tradingsymbol -> instrument details
+
+    def instrument_details(self, tradingsymbol: str) -> Row:
+        details = self._instruments.get(tradingsymbol)
+        if details is None:
+            row = self.instrument_df[self.instrument_df['tradingsymbol'] == tradingsymbol]
+            if row.empty:
+                raise ValueError(f"Instrument {tradingsymbol} not found in the instruments list")
+            row = row.iloc[-1]
+            details = {'instrument_token': int(row['instrument_token']),
+                       'tradingsymbol': row['tradingsymbol'],
+                       'lot_size': int(row['lot_size']),
+                       'tick_size': row['tick_size'],
+                       'exchange_token': row['exchange_token']}
+            self._instruments[tradingsymbol] = details
+        return details
+
+    def _strategy_row(self, row: Row) -> Row:
+        """workbook row along with its instrument details, in the shape taken by the store"""
+        row = dict(row)
+        strategies.strategy_code(row.get('strategy_name'))  # rows of strategies not registered are not loaded
+        for column, column_type in StrategiesColumn.tradexcb_numeric_columns.items():
+            if row.get(column) is not None:
+                row[column] = column_type(row[column])
+        row.update(self.instrument_details(row['instrument']))
+        row['quantity'] = row['lot_size']  # a single lot, multiplied by the lots of each user
+        return row
+
+    def reload(self, file_path: typing.Optional[str] = None) -> ReloadResult:
+        """apply the rows of the workbook changed since the last reload"""
+        store = self.engine.store
+        known_tokens = set(store.token_index)
+        workbook_rows = read_strategy_rows(file_path or settings.DATA_FILES['tradexcb_excel_file'])
+        result = ReloadResult([], [], [], [])
+
+        owned_keys = set()
+        for key, workbook_row in workbook_rows.items():
+            if not self.shard.owns(workbook_row):
+                continue
+            owned_keys.add(key)
+            fingerprint = row_fingerprint(workbook_row)
+            if self.fingerprints.get(key) == fingerprint:
+                continue
+            try:
+                row = self._strategy_row(workbook_row)
+            except Exception as e:
+                logger.error(f"Row {key} of the strategy table not loaded, Error : {e}")
+                continue
+            if key in store:
+                idx = store.index_of(key)
+                record = store.state[idx]
+                side = 1 if str(row['transaction_type']).upper() == 'BUY' else -1
+                if record['instrument_token'] == row['instrument_token'] and record['side'] == side:
+                    self.engine.update_row(idx, row)
+                    result.updated.append(key)
+                    self.fingerprints[key] = fingerprint
+                    continue
+                if record['status'] != STATUS_IDLE:
+                    logger.warning(f"Row {key} changed its instrument while a trade of "
+                                   f"{store.info[idx].tradingsymbol} is open, it will be replaced on a reload "
+                                   f"after the trade is closed")
+                    continue
+                store.retire_row(idx)
+                result.retired.append(key)
+            self.engine.add_row(key, row)
+            result.added.append(key)
+            self.fingerprints[key] = fingerprint
+
+        for key in [key for key in self.fingerprints if key not in owned_keys]:
+            del self.fingerprints[key]
+            if key in store:
+                store.retire_row(store.index_of(key))
+                result.retired.append(key)
+
+        result.new_tokens.extend(token for token in store.token_index if token not in known_tokens)
+        if result.added or result.updated or result.retired:
+            logger.info(f"Strategy rows reloaded, added : {result.added}, updated : {result.updated}, "
+                        f"retired : {result.retired}")
+        return result
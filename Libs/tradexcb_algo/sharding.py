@@ -0,0 +1,150 @@
+"""
+Sharded execution of the strategy: the strategy rows are partitioned across `settings.STRATEGY_SHARDS`
+algo processes (by instrument or by strategy name), each with its own broker sessions, data feed and
+order channels. The UI talks to the shards through `ShardedCancelQueue` (close position requests)
+and `OrderbookMerger` (one orderbook out of the orderbook messages of all shards).
+
+Kite allows only a few websockets per api key (`settings.KITE_WEBSOCKETS_PER_API_KEY`) and every shard opens
+its own, so the shards refuse to start when they would need more (`check_kite_websockets`).
+"""
+import multiprocessing
+import os
+import typing
+import zlib
+
+from Libs.Utils import exception_handler, settings
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+SHARD_BY_INSTRUMENT = 'instrument'
+SHARD_BY_STRATEGY = 'strategy_name'
+
+
+class ShardSpec(typing.NamedTuple):
+    index: int = 0
+    count: int = 1
+    by: str = SHARD_BY_INSTRUMENT
+
+    def owns(self, row: typing.Dict[str, typing.Any]) -> bool:
+        """True if the strategy row (of the workbook) belongs to this shard"""
+        return self.count <= 1 or shard_of(row.get(self.by), self.count) == self.index
+
+
+def shard_of(value, shard_count: int) -> int:
+    """shard of a row key, stable across processes (unlike `hash` of str)"""
+    return zlib.crc32(str(value).encode("utf-8")) % shard_count
+
+
+def shard_path(path: str, shard_index: int) -> str:
+    """per shard file path, the first shard uses `path` itself (same file as without sharding)"""
+    if shard_index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_{shard_index}{ext}"
+
+
+def kite_websockets(users: typing.Sequence[typing.Dict[str, typing.Any]], order_streams: bool = True) \
+        -> typing.Dict[str, int]:
+    """
+    websockets opened per kite api key by one algo process: the data feed of the main broker (first user), which
+    carries its order updates too, and the order updates stream of every other zerodha user
+
+    :param users: the user details, in the order of the users of the algo
+    :param order_streams: the zerodha users stream their order updates (not on the simulated exchange)
+    """
+    websockets = {}
+    for position, user in enumerate(users):
+        if str(user.get('Stock Broker Name', '')).lower() != 'zerodha' or (position and not order_streams):
+            continue
+        api_key = str(user.get('apiKey'))
+        websockets[api_key] = websockets.get(api_key, 0) + 1
+    return websockets
+
+
+def check_kite_websockets(users: typing.Sequence[typing.Dict[str, typing.Any]], shard_count: int,
+                          order_streams: bool = True) -> typing.Optional[str]:
+    """
+    every shard opens its own kite websockets, which kite limits per api key
+    (`settings.KITE_WEBSOCKETS_PER_API_KEY`)
+
+    :return: why the shards can not run with these users, None if they can
+    """
+    for api_key, count in kite_websockets(users, order_streams).items():
+        if count * shard_count > settings.KITE_WEBSOCKETS_PER_API_KEY:
+            return (f"{shard_count} shards need {count * shard_count} websockets of the kite api key "
+                    f"{api_key[:4]}..., more than the {settings.KITE_WEBSOCKETS_PER_API_KEY} allowed per api key "
+                    f"(lower STRATEGY_SHARDS)")
+    return None
+
+
+class ShardedCancelQueue:
+    """
+    stands in for the cancel orders queue of the UI: a row key is put on the queue of the shard owning the row
+    (known from the orderbook messages of the shard), or on the queues of all shards if not known yet
+    """
+
+    def __init__(self, queues: typing.List[multiprocessing.Queue]):
+        self.queues = queues
+        self.row_shards: typing.Dict[typing.Any, int] = {}
+
+    def put(self, row_key):
+        shard_index = self.row_shards.get(row_key)
+        if shard_index is None:
+            for each_queue in self.queues:
+                each_queue.put(row_key)
+        else:
+            self.queues[shard_index].put(row_key)
+
+    def put_all(self, command):
+        """put a command for all the rows (e.g. `square_off.SQUARE_OFF_ALL`) on the queues of all shards"""
+        for each_queue in self.queues:
+            each_queue.put(command)
+
+
+class OrderbookMerger:
+    """
+    merges the orderbook messages (see `orderbook_delta`) of all shards into the messages of a single orderbook
+
+    :param on_resync: called with the shard index when a message of the shard was missed
+    """
+
+    def __init__(self, shard_count: int, on_resync: typing.Callable[[int], None],
+                 cancel_queue: typing.Optional[ShardedCancelQueue] = None):
+        self.on_resync = on_resync
+        self.cancel_queue = cancel_queue
+        self.seq = 0
+        self._shard_seq: typing.List[typing.Optional[int]] = [None] * shard_count
+        self._shard_keys: typing.List[typing.Set[typing.Any]] = [set() for _ in range(shard_count)]
+
+    def merge(self, message: typing.Dict[str, typing.Any]) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """
+        :return: message of the merged orderbook, None if the message of the shard has to be dropped
+        """
+        shard_index = message.get('shard', 0)
+        last_seq = self._shard_seq[shard_index]
+        if not message['reset']:
+            if last_seq is None:
+                return None  # waiting for the full orderbook of the shard
+            if message['seq'] != last_seq + 1:
+                logger.warning(f"Orderbook update {last_seq + 1} of shard {shard_index} missed, "
+                               f"requesting its full orderbook")
+                self._shard_seq[shard_index] = None
+                self.on_resync(shard_index)
+                return None
+        self._shard_seq[shard_index] = message['seq']
+
+        keys = self._shard_keys[shard_index]
+        removed = list(message['removed'])
+        if message['reset']:  # a full orderbook of a shard replaces only the rows of that shard
+            removed += [key for key in keys if key not in message['rows']]
+            keys.clear()
+        keys.difference_update(removed)
+        keys.update(message['rows'])
+        if self.cancel_queue is not None:
+            for key in removed:
+                self.cancel_queue.row_shards.pop(key, None)
+            self.cancel_queue.row_shards.update(dict.fromkeys(message['rows'], shard_index))
+
+        self.seq += 1
+        # the first message clears the rows left in the UI by an earlier run
+        return {'seq': self.seq, 'reset': self.seq == 1, 'rows': message['rows'], 'removed': removed}
@@ -0,0 +1,95 @@
+"""
+Kill switch of the strategy: square off every open position and cancel every pending entry, of all the accounts.
+
+The UI puts `SQUARE_OFF_ALL` on the cancel orders queue of every shard. `StrategyEngine.square_off_all` stops
+the new entries and starts the exits of all the rows at once. The exits run through `ExitWorkflow`, so the
+broker calls of all the accounts and instruments go out in parallel on the order fan-out pool:
+
+    open position  -> SL order checked and cancelled, position squared off with a market order
+    entry placed   -> entry order cancelled, squared off instead if it got filled meanwhile
+
+`SquareOffReport` collects the outcome of every (row, account) as its exit finishes.
+"""
+import time
+import typing
+
+import pandas as pd
+
+SQUARE_OFF_ALL = 'square_off_all'  # command on the cancel orders queue (instead of a row key)
+
+ACTION_SQUARE_OFF = 'square_off'
+ACTION_CANCEL_ENTRY = 'cancel_entry'
+# cancelled_order_status: status of the SL/entry order when last checked (an SL order is not checked again once
+# cancelled)
+REPORT_COLUMNS = ['row_key', 'tradingsymbol', 'account', 'action', 'cancelled_order_id', 'cancelled_order_status',
+                  'exit_order_id', 'error', 'elapsed_ms']
+
+
+class SquareOffReport:
+    """outcome of a square off of all the rows of an algo process"""
+
+    def __init__(self, clock: typing.Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.started_at = clock()
+        self.finished_at: typing.Optional[float] = None
+        self.records: typing.List[typing.Dict[str, typing.Any]] = []
+        self.published = False  # sent to the UI
+        self._pending_rows: typing.Set[int] = set()
+        self._adding_rows = True  # rows still being added, not complete even if none is pending
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def elapsed(self) -> float:
+        """seconds taken (so far)"""
+        return (self.finished_at or self.clock()) - self.started_at
+
+    def add_row(self, idx: int):
+        self._pending_rows.add(idx)
+
+    def is_pending(self, idx: int) -> bool:
+        return idx in self._pending_rows
+
+    def add_record(self, row_key, tradingsymbol: str, account: str, action: str, cancelled_order_id=None,
+                   cancelled_order_status: typing.Optional[str] = None, exit_order_id=None,
+                   error: typing.Optional[str] = None):
+        self.records.append({'row_key': row_key, 'tradingsymbol': tradingsymbol, 'account': account,
+                             'action': action, 'cancelled_order_id': cancelled_order_id,
+                             'cancelled_order_status': cancelled_order_status, 'exit_order_id': exit_order_id,
+                             'error': error, 'elapsed_ms': round(self.elapsed * 1000, 1)})
+
+    def row_done(self, idx: int):
+        """the exits of all the accounts of the row are over"""
+        self._pending_rows.discard(idx)
+        self._check_done()
+
+    def all_rows_added(self):
+        self._adding_rows = False
+        self._check_done()
+
+    def _check_done(self):
+        if not self._adding_rows and not self._pending_rows and self.finished_at is None:
+            self.finished_at = self.clock()
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records, columns=REPORT_COLUMNS)
+
+    def export(self) -> typing.Dict[str, typing.Any]:
+        """picklable copy, for the UI (see `summary`)"""
+        return {'elapsed': self.elapsed, 'records': list(self.records)}
+
+
+def summary(exports: typing.Iterable[typing.Dict[str, typing.Any]]) -> str:
+    """one line summary of the square off reports of one or more algo processes"""
+    exports = list(exports)
+    records = [record for exported in exports for record in exported['records']]
+    elapsed = max((exported['elapsed'] for exported in exports), default=0.0)
+    squared_off = [record for record in records if record['action'] == ACTION_SQUARE_OFF]
+    cancelled = [record for record in records if record['action'] == ACTION_CANCEL_ENTRY]
+    errors = [record for record in records if record['error']]
+    exit_orders = sum(record['exit_order_id'] is not None for record in records)
+    accounts = len({record['account'] for record in records})
+    return (f"Square off done in {elapsed * 1000:.0f} ms over {accounts} accounts: {len(squared_off)} positions, "
+            f"{len(cancelled)} pending entries, {exit_orders} exit orders placed, {len(errors)} errors")
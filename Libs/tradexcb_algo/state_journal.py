@@ -0,0 +1,184 @@
+"""
+Crash-safe checkpoint of the strategy state, restored when the algo restarts during the same trading day.
+
+The algo process is terminated on every restart (`AlgoManager.kill_child_proc`), so the state is written as
+it changes instead of at exit: every transition of a row (entry placed, filled, exiting, reset) rewrites the
+row and its orders in one SQLite transaction. The database runs in WAL mode with `synchronous=NORMAL`, a
+commit appends to the write-ahead log without an fsync (a few tens of microseconds) and survives the process
+being killed at any point; only an OS crash / power loss can drop the last commits.
+
+    rows    key -> the fields and details of the rows not idle (`row_data`)
+    orders  (key, kind, user) -> order id, order status, order tag, quantity and price of the entry
+    trades  closed trades, in order (replayed into the positions ledger)
+    meta    trading day and mode (paper trade) of the checkpoint
+
+Orders are tagged (see `main_broker_api.order_tags`) and the tags are written before the orders are sent, so
+an order sent but not acknowledged before the process died is found back in the broker's order book by its
+tag on restore (`StrategyEngine.restore`), and never sent twice.
+"""
+import json
+import sqlite3
+import threading
+import typing
+from datetime import date
+
+import numpy as np
+
+from Libs.Utils import exception_handler
+from .instrument_state import InstrumentStateStore, RowInfo, ROW_STATE_DTYPE, ORDER_KINDS, STATUS_IDLE
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, data TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS orders (key TEXT NOT NULL, kind TEXT NOT NULL, user TEXT NOT NULL, order_id TEXT, "
+    "order_status TEXT, tag TEXT, quantity INTEGER, price REAL, PRIMARY KEY (key, kind, user))",
+    "CREATE TABLE IF NOT EXISTS trades (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, "
+    "data TEXT NOT NULL)",
+)
+
+# the quantity/price of an entry are kept once the entry is closed in the risk counters (exit in progress)
+_UPSERT_ORDER = ("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key, kind, user) DO UPDATE SET "
+                 "order_id = excluded.order_id, order_status = excluded.order_status, tag = excluded.tag, "
+                 "quantity = COALESCE(excluded.quantity, quantity), price = COALESCE(excluded.price, price)")
+
+
+class JournalOrder(typing.NamedTuple):
+    order_id: typing.Optional[str]
+    order_status: typing.Optional[str]
+    tag: typing.Optional[str]
+    quantity: typing.Optional[int]  # quantity of the entry of the user (entry orders)
+    price: typing.Optional[float]  # price of the entry of the user, for the risk counters (entry orders)
+
+
+class Checkpoint(typing.NamedTuple):
+    rows: typing.Dict[typing.Any, typing.Dict[str, typing.Any]]  # key -> row
+    orders: typing.Dict[typing.Any, typing.Dict[typing.Tuple[str, str], JournalOrder]]  # key -> {(kind, user): }
+    trades: typing.List[typing.Tuple[typing.Any, typing.Dict[str, typing.Any]]]  # (key, row) of the closed trades
+
+    def __bool__(self):
+        return bool(self.rows or self.trades)
+
+
+def _json_default(value):
+    """values of the rows which are not JSON types (NumPy scalars of the instrument details etc.)"""
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+def row_data(store: InstrumentStateStore, idx: int) -> typing.Dict[str, typing.Any]:
+    """the row at `idx` as written to the journal: the fields of the store (NaN if not set) and its details"""
+    info = store.info[idx]
+    row = dict(zip(ROW_STATE_DTYPE.names, store.state[idx].tolist()))
+    row.update({name: getattr(info, name) for name in RowInfo.__slots__})
+    return row
+
+
+class StateJournal:
+    """
+    checkpoint of the strategy state, in the SQLite database at `path`
+
+    :param paper_trade: trading mode of the state, a checkpoint of the other mode is discarded
+    :param day: trading day of the state, a checkpoint of another day is discarded (default today)
+    """
+
+    def __init__(self, path: str, paper_trade: int = 0, day: typing.Optional[date] = None):
+        self.path = path
+        self.session = {'day': (day or date.today()).isoformat(), 'paper_trade': str(paper_trade)}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+            saved_session = dict(self._db.execute("SELECT name, value FROM meta"))
+            if saved_session != self.session:
+                if saved_session:
+                    logger.info(f"Discarding the strategy checkpoint of {saved_session}")
+                for table in ('meta', 'rows', 'orders', 'trades'):
+                    self._db.execute(f"DELETE FROM {table}")
+                self._db.executemany("INSERT INTO meta (name, value) VALUES (?, ?)", self.session.items())
+
+    def save_row(self, store: InstrumentStateStore, idx: int, risk=None):
+        """
+        write the row at `idx` and its orders (an idle row is removed, with its orders)
+
+        :param risk: `RiskGate` holding the quantity/price of the entries of the users
+        """
+        key = json.dumps(store.info[idx].key, default=_json_default)
+        record = store.state[idx]
+        orders = []
+        if record['status'] != STATUS_IDLE:
+            data = json.dumps(row_data(store, idx), default=_json_default)
+            for kind in ORDER_KINDS:
+                for user in store.users:
+                    order_id, order_status = store.get_order(kind, idx, user)
+                    tag = store.get_tag(kind, idx, user)
+                    if order_id is None and tag is None:
+                        continue
+                    entry = risk.entry(user, store.info[idx].key) if risk is not None and kind == 'entry' else None
+                    orders.append((key, kind, user, None if order_id is None else str(order_id), order_status, tag,
+                                   None if entry is None else entry[1], None if entry is None else entry[2]))
+        with self._lock, self._db:
+            if record['status'] == STATUS_IDLE:
+                self._db.execute("DELETE FROM rows WHERE key = ?", (key,))
+                self._db.execute("DELETE FROM orders WHERE key = ?", (key,))
+            else:
+                self._db.execute("INSERT OR REPLACE INTO rows (key, data) VALUES (?, ?)", (key, data))
+                self._db.executemany(_UPSERT_ORDER, orders)
+
+    def rename_row(self, key, new_key):
+        """move the row `key` and its orders to `new_key` (row restored under another key)"""
+        key, new_key = json.dumps(key, default=_json_default), json.dumps(new_key, default=_json_default)
+        with self._lock, self._db:
+            self._db.execute("UPDATE rows SET key = ? WHERE key = ?", (new_key, key))
+            self._db.execute("UPDATE orders SET key = ? WHERE key = ?", (new_key, key))
+
+    def add_trade(self, key, row: typing.Dict[str, typing.Any]):
+        """append a closed trade (the row with its exit details, see `PositionsLedger.close`)"""
+        row = dict(row)
+        for field in ('entry_time', 'exit_time'):
+            if row.get(field) is not None:
+                row[field] = row[field].timestamp()
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO trades (key, data) VALUES (?, ?)",
+                             (json.dumps(key, default=_json_default), json.dumps(row, default=_json_default)))
+
+    def load(self) -> Checkpoint:
+        """the state written so far (rows not idle, their orders, closed trades)"""
+        with self._lock:
+            rows = {json.loads(key): json.loads(data) for key, data in
+                    self._db.execute("SELECT key, data FROM rows ORDER BY rowid")}
+            orders = {}
+            for key, kind, user, *order in self._db.execute("SELECT * FROM orders"):
+                orders.setdefault(json.loads(key), {})[(kind, user)] = JournalOrder(*order)
+            trades = [(json.loads(key), json.loads(data)) for key, data in
+                      self._db.execute("SELECT key, data FROM trades ORDER BY seq")]
+        for key, row in trades:
+            for field in ('entry_time', 'exit_time'):
+                row[field] = InstrumentStateStore.to_datetime(np.nan if row.get(field) is None else row[field])
+        return Checkpoint(rows, orders, trades)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class _NullJournal:
+    """stands in for `StateJournal` when the state is not checkpointed"""
+
+    def save_row(self, store: InstrumentStateStore, idx: int, risk=None):
+        pass
+
+    def rename_row(self, key, new_key):
+        pass
+
+    def add_trade(self, key, row: typing.Dict[str, typing.Any]):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_JOURNAL = _NullJournal()
@@ -0,0 +1,111 @@
+"""
+Strategy plug-ins.
+
+A strategy decides, for a batch of rows (of `instrument_state.ROW_STATE_DTYPE`), which idle rows take an
+entry and which open positions exit; placing/tracking the orders is left to `StrategyEngine`, the same
+for all strategies. The engine groups the rows of a pass by their strategy and calls `evaluate` once per
+strategy with only its rows, so each strategy works on NumPy columns instead of walking the rows.
+
+A strategy is added by registering it (`register_strategy`), from any module listed in
+`settings.STRATEGY_PLUGIN_MODULES`; registering also makes it selectable in the strategy tables of the UI.
+"""
+import importlib
+import sys
+import typing
+
+import numpy as np
+
+from Libs.Files.TradingSymbolMapping import StrategiesColumn
+from Libs.Storage import app_data
+from Libs.Utils import exception_handler, settings
+from . import trigger_eval
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+
+class StrategySignals(typing.NamedTuple):
+    entry: np.ndarray  # idle rows which have to take an entry
+    exits: trigger_eval.ExitSignals  # open positions which have to exit
+
+
+class Strategy:
+    """
+    base of the strategy plug-ins
+
+    :cvar name: name of the strategy, as in the strategy_name column of the strategy table
+    :cvar columns: columns of the strategy table shown for the strategy
+        (of `StrategiesColumn.tradexcb_display_columns`)
+    :cvar customizations: customizations of the strategy table (as in `StrategiesColumn.strategy__customization_dict`)
+    """
+    name: str = None
+    columns: typing.List[str] = StrategiesColumn.tradexcb_display_columns
+    customizations = None
+
+    def evaluate(self, rows: np.ndarray, ltp: np.ndarray, now: float) -> StrategySignals:
+        """
+        :param rows: rows of this strategy evaluated in the pass
+        :param ltp: latest traded price of each of `rows` (NaN if not received yet)
+        :param now: current time as epoch seconds
+        :return: boolean masks over `rows`
+        """
+        raise NotImplementedError
+
+
+class DefaultStrategy(Strategy):
+    """entry at buy_ltp_percent/sell_ltp_percent away from the ltp, exit at target/stoploss or on request"""
+    name = 'Default'
+
+    def evaluate(self, rows: np.ndarray, ltp: np.ndarray, now: float) -> StrategySignals:
+        return StrategySignals(trigger_eval.entry_signals(rows), trigger_eval.exit_signals(rows))
+
+
+_strategies: typing.List[Strategy] = []  # position in the list is the strategy code of the rows in the store
+_strategy_codes: typing.Dict[str, int] = {}
+
+
+def register_strategy(strategy: Strategy) -> int:
+    """
+    add a strategy (replacing the one registered with the same name)
+
+    :return: code of the strategy, stored in the rows of the strategy
+    """
+    unknown_columns = set(strategy.columns) - set(StrategiesColumn.tradexcb_display_columns)
+    if unknown_columns:
+        raise ValueError(f"Columns {sorted(unknown_columns)} of strategy {strategy.name} "
+                         f"are not strategy table columns")
+    code = _strategy_codes.get(strategy.name)
+    if code is None:
+        code = _strategy_codes[strategy.name] = len(_strategies)
+        _strategies.append(strategy)
+    else:
+        _strategies[code] = strategy
+    StrategiesColumn.strategy_dict[strategy.name] = list(strategy.columns)
+    StrategiesColumn.strategy__customization_dict[strategy.name] = strategy.customizations
+    if strategy.name not in app_data.STRATEGIES:
+        app_data.STRATEGIES.append(strategy.name)
+    return code
+
+
+def strategy_code(name: typing.Optional[str]) -> int:
+    """code of a registered strategy, rows without a strategy name run the Default strategy"""
+    try:
+        return _strategy_codes[name or DefaultStrategy.name]
+    except KeyError:
+        raise ValueError(f"Strategy {name} is not registered") from None
+
+
+def get_strategy(code: int) -> Strategy:
+    return _strategies[code]
+
+
+def load_plugin_modules(module_names: typing.Iterable[str] = ()):
+    """import the modules registering the strategy plug-ins"""
+    for module_name in module_names:
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            logger.error(f"Error in loading the strategy plug-in {module_name} {sys.exc_info()}", exc_info=True)
+
+
+register_strategy(DefaultStrategy())
+load_plugin_modules(settings.STRATEGY_PLUGIN_MODULES)
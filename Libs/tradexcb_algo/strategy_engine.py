@@ -0,0 +1,629 @@
+import time
+import typing
+
+import numpy as np
+
+from Libs.Utils import exception_handler, calculations
+from . import trigger_eval, strategies
+from .exit_workflow import ExitWorkflow, ExitTask
+from .latency import LatencyRecorder, STAGE_TICK_TO_SIGNAL, STAGE_EVALUATE
+from .order_fanout import OrderFanout
+from .positions_ledger import PositionsLedger
+from .risk_gate import RiskGate
+from .sharding import ShardSpec
+from .square_off import SquareOffReport, ACTION_SQUARE_OFF, ACTION_CANCEL_ENTRY
+from .state_journal import Checkpoint, NULL_JOURNAL
+from .instrument_state import InstrumentStateStore, STATUS_IDLE, STATUS_ENTRY_PLACED, STATUS_IN_POSITION, \
+    STATUS_EXITING, LEVEL_NONE, ORDER_KINDS
+
+logger = exception_handler.getAlgoLogger(__name__)
+
+RESTORED_KEY_STRIDE = 1_000_000  # step between the negative keys of the rows restored under a new key
+
+
+class StrategyEngine:
+    """
+    Per-row state machine (entry -> SL order -> target/stoploss/close exit), working on the rows of an
+    `InstrumentStateStore`. When to enter and exit is decided by the strategy of each row (see `strategies`).
+    """
+
+    def __init__(self, users_df_dict: typing.Dict[str, typing.Dict[str, typing.Any]], main_broker,
+                 paper_trade: int, shard: ShardSpec = ShardSpec()):
+        self.users_df_dict = users_df_dict
+        self.main_broker = main_broker
+        self.paper_trade = paper_trade
+        self.store = InstrumentStateStore(users_df_dict.keys())
+        self.token_ltp = np.full(0, np.nan)  # ltp of each of `store.tokens`
+        self.ledger = PositionsLedger({user: details for user, details in users_df_dict.items()
+                                       if details['broker'] is not None})
+        self.fanout = OrderFanout()
+        self.broker_names = {user: getattr(details['broker'], 'broker_name', None)
+                             for user, details in users_df_dict.items()}
+        self.latency = LatencyRecorder()
+        self.risk = RiskGate(shard=shard)
+        self._signal_at = None  # monotonic time the current strategy pass started
+        self.entries_halted = False  # no new entries (after a square off of all the positions)
+        self.square_off: typing.Optional[SquareOffReport] = None  # last square off of all the positions
+        self.journal = NULL_JOURNAL  # checkpoint of the state, written on every transition (see `state_journal`)
+        self.exits = ExitWorkflow(users_df_dict, self.fanout, self.broker_names,
+                                  on_task_done=self._exit_order_done, on_row_done=self._exit_row_done,
+                                  latency=self.latency)
+
+    @staticmethod
+    def now() -> float:
+        """current time as epoch seconds (the unit of the time fields in the store)"""
+        return time.time()
+
+    def add_row(self, key, row: typing.Dict[str, typing.Any]) -> int:
+        return self.store.add_row(key, dict(row, strategy=strategies.strategy_code(row.get('strategy_name'))))
+
+    def update_row(self, idx: int, row: typing.Dict[str, typing.Any]):
+        self.store.update_row(idx, dict(row, strategy=strategies.strategy_code(row.get('strategy_name'))))
+
+    def rows_for_tokens(self, instrument_tokens: typing.Iterable[int]) -> typing.List[int]:
+        """indices of the rows trading any of `instrument_tokens`"""
+        token_index = self.store.token_index
+        return [idx for token in instrument_tokens for idx in token_index.get(token, ())]
+
+    def update_ltp(self, indices: np.ndarray) -> np.ndarray:
+        """
+        copy the latest traded price of the rows at `indices` from the data feed into the store
+
+        :return: ltp of the rows at `indices` (NaN if not received yet)
+        """
+        state = self.store.state
+        latest_ltp = self.main_broker.latest_ltp
+        tokens = self.store.tokens
+        if len(self.token_ltp) != len(tokens):
+            self.token_ltp = np.resize(self.token_ltp, len(tokens))
+        slots = state['token_slot'][indices]
+        for slot in np.unique(slots):
+            ltp = latest_ltp.get(tokens[slot], {}).get('ltp')
+            self.token_ltp[slot] = np.nan if ltp is None else ltp
+        ltp = self.token_ltp[slots]
+        state['ltp'][indices] = ltp
+        return ltp
+
+    def evaluate(self, indices: typing.Union[None, np.ndarray, typing.Sequence[int]] = None):
+        """
+        run the state machine for the rows at `indices` (all rows if None).
+        The triggers are evaluated as masks over all the rows at once; actions only run for the rows which fired.
+        """
+        if indices is not None and not len(indices):
+            return
+        self._signal_at = time.monotonic()
+        try:
+            self._evaluate(indices)
+        finally:
+            self.latency.record(STAGE_EVALUATE, time.monotonic() - self._signal_at)
+            self._signal_at = None
+
+    def _tick_at(self, idx: int) -> typing.Optional[float]:
+        """monotonic time the last tick of the row's instrument was received"""
+        return self.main_broker.tick_received_at.get(self.store.state['instrument_token'][idx].item())
+
+    def _evaluate(self, indices: typing.Union[None, np.ndarray, typing.Sequence[int]]):
+        state = self.store.state
+        all_rows = indices is None
+        indices = np.arange(len(state)) if all_rows else np.asarray(indices, dtype=np.intp)
+        if not len(indices):
+            return
+
+        def selected_rows():
+            # a view of the store when evaluating every row, a copy of the selected rows otherwise
+            return state if all_rows else state[indices]
+
+        ltp = self.update_ltp(indices)
+        now = self.now()
+        signals = self.strategy_signals(selected_rows(), ltp, now)
+        if self.entries_halted:
+            signals = signals._replace(entry=np.zeros_like(signals.entry))
+        for idx in indices[signals.entry | signals.exits.target_hit | signals.exits.sl_hit]:
+            tick_at = self._tick_at(idx)
+            if tick_at is not None and tick_at <= self._signal_at:
+                self.latency.record(STAGE_TICK_TO_SIGNAL, self._signal_at - tick_at)
+
+        # ------------ idle rows: take an entry ------------
+        for idx in indices[signals.entry]:
+            logger.info(f"Running the Main Strategy for {self.store.info[idx].tradingsymbol}")
+            self._take_entry(idx, state['ltp'][idx].item())
+
+        # ------------ entry placed: filled or expired ------------
+        rows = selected_rows()
+        filled = trigger_eval.entry_fills(rows)
+        just_filled = np.zeros(len(indices), dtype=bool)  # rows which are done for this pass
+        if self.paper_trade == 1:
+            for idx in indices[filled]:
+                logger.info(f"Entry has been taken for {self.store.info[idx].tradingsymbol}")
+                state['entry_time'][idx] = now
+                state['status'][idx] = STATUS_IN_POSITION
+                self.ledger.open(self.store.info[idx].key, self.store.as_dict(idx))
+                self._checkpoint(idx)
+            just_filled = filled
+            for idx in indices[trigger_eval.entry_expiries(rows, now) & ~filled]:
+                logger.info(f" Cancelling the Placed Order for {self.store.info[idx].tradingsymbol}")
+                self.store.reset_position(idx)
+                self._checkpoint(idx)
+        elif self.paper_trade == 0:
+            for idx in indices[filled]:
+                self._entry_executed(idx)
+            just_filled = filled & (rows['stoploss_type'] != LEVEL_NONE)
+            for idx in indices[just_filled]:
+                self._place_sl_orders(idx)
+
+        # ------------ open positions: target / stoploss / close ------------
+        rows = selected_rows()
+        in_position = (rows['status'] == STATUS_IN_POSITION) & ~just_filled
+        if not in_position.any():
+            return
+        profit = trigger_eval.open_profit(rows)
+        state['profit'][indices[in_position]] = profit[in_position]
+        for idx in indices[in_position]:
+            self.ledger.update(self.store.info[idx].key, state['ltp'][idx].item())
+
+        exits = signals.exits
+        for idx in indices[exits.target_hit & in_position]:
+            logger.info(f"Target has been Hit for {self.store.info[idx].tradingsymbol}")
+            self._exit_position(idx, state['ltp'][idx].item(), tick_at=self._tick_at(idx))
+        for idx in indices[exits.sl_hit & in_position]:
+            logger.info(f"Stoploss has been Hit for {self.store.info[idx].tradingsymbol}")
+            self._exit_position(idx, state['ltp'][idx].item(), wait_for_broker=True, tick_at=self._tick_at(idx))
+        for idx in indices[exits.close_requested & in_position]:
+            self._exit_position(idx, state['ltp'][idx].item())
+
+    @staticmethod
+    def strategy_signals(rows: np.ndarray, ltp: np.ndarray, now: float) -> strategies.StrategySignals:
+        """
+        entry/exit signals of `rows`, each strategy evaluates its own rows in one call.
+        Entries are taken only by idle rows still in the strategy table, exits only by open positions.
+        """
+        codes = rows['strategy']
+        if not len(rows) or (codes == codes[0]).all():
+            signals = strategies.get_strategy(codes[0] if len(rows) else 0).evaluate(rows, ltp, now)
+        else:
+            entry = np.zeros(len(rows), dtype=bool)
+            exits = trigger_eval.ExitSignals(*(np.zeros(len(rows), dtype=bool)
+                                               for _ in trigger_eval.ExitSignals._fields))
+            for code in np.unique(codes):
+                selected = codes == code
+                strategy_signals = strategies.get_strategy(code).evaluate(rows[selected], ltp[selected], now)
+                entry[selected] = strategy_signals.entry
+                for mask, strategy_mask in zip(exits, strategy_signals.exits):
+                    mask[selected] = strategy_mask
+            signals = strategies.StrategySignals(entry, exits)
+
+        idle = (rows['status'] == STATUS_IDLE) & rows['active']
+        in_position = rows['status'] == STATUS_IN_POSITION
+        return strategies.StrategySignals(signals.entry & idle,
+                                          trigger_eval.ExitSignals(*(mask & in_position for mask in signals.exits)))
+
+    # ------------ actions ------------
+    def _take_entry(self, idx: int, ltp: float):
+        state = self.store.state
+        info = self.store.info[idx]
+        side = state['side'][idx].item()
+        logger.info(f" In {info.transaction_type.title()} Loop. for {info.tradingsymbol}\n"
+                    f"{info.transaction_type.title()} Signal has been Activated for {info.tradingsymbol}")
+        state['status'][idx] = STATUS_ENTRY_PLACED
+        state['multiplier'][idx] = side
+        state['entry_time'][idx] = self.now()
+
+        self.store.set_entry_levels(idx, ltp)
+        entry_price = state['entry_price'][idx].item()
+
+        if self.paper_trade == 0:
+            # sell entries are sent at the ltp, buy entries at the calculated entry price
+            order = self.build_order(idx, transaction_type=info.transaction_type, order_type=info.order_type,
+                                     price=entry_price if side == 1 else ltp)
+            self._place_for_all_users(idx, 'entry', order, action=f"{info.transaction_type.title()} Order")
+        else:
+            self._checkpoint(idx)
+        logger.info(f" Instrument_Details : {self.store.as_dict(idx)}")
+
+    def _entry_executed(self, idx: int):
+        info = self.store.info[idx]
+
+        def check_status(each_user):
+            order_id, _ = self.store.get_order('entry', idx, each_user)
+            if order_id is None:  # entry not placed for the user
+                return order_id, (None, None)
+            return order_id, self.users_df_dict[each_user]['broker'].get_order_status(order_id=order_id)
+
+        for each_user, result in self.fanout.map(check_status, self.store.users, self.broker_names).items():
+            if not result.ok:
+                logger.critical(f"Error in getting Entry Order Status for {self.users_df_dict[each_user]['Name']} "
+                                f"Error {result.error!r}", exc_info=result.error)
+                continue
+            order_id, (order_status, status_message) = result.value
+            self.latency.order_status(each_user, order_id, order_status)
+            self.store.set_order('entry', idx, each_user, order_status=order_status)
+            if order_status == 'REJECTED':
+                logger.info(f"Order Rejected for {each_user} having Order ID : {order_id}")
+            # todo: need to pending initial order on user's choice (button press from UI)
+
+        logger.info(f" Entry has been taken for {info.tradingsymbol} ")
+        self.store.state['entry_time'][idx] = self.now()
+        self.store.state['status'][idx] = STATUS_IN_POSITION
+        self.ledger.open(info.key, self.store.as_dict(idx))
+        self._checkpoint(idx)
+
+    def _place_sl_orders(self, idx: int):
+        state = self.store.state
+        info = self.store.info[idx]
+        order = self.build_order(idx, transaction_type=calculations.reverse_txn_type(info.transaction_type),
+                                 order_type='SL',
+                                 price=calculations.get_adjusted_trigger_price(info.transaction_type,
+                                                                               state['sl_price'][idx].item(),
+                                                                               state['tick_size'][idx].item()),
+                                 trigger_price=state['sl_price'][idx].item())
+        self._place_for_all_users(idx, 'sl', order, action="SL Order")
+
+    def _exit_position(self, idx: int, ltp: float, wait_for_broker=False, tick_at: typing.Optional[float] = None):
+        """
+        Close the position of the row: the SL order of every user is cancelled and the position squared off
+        with a market order by `exits`, without waiting for the broker here. The row takes no new entry until
+        the exits of all users are over.
+
+        :param wait_for_broker: wait for the SL order cancellation to be confirmed before squaring off
+        :param tick_at: monotonic time of the tick which triggered the exit (None if not triggered by a tick)
+        """
+        state = self.store.state
+        info = self.store.info[idx]
+        state['exit_time'][idx] = self.now()
+        state['exit_price'][idx] = ltp
+        row = self.store.as_dict(idx)
+        self.ledger.close(info.key, row)
+        self.journal.add_trade(info.key, row)
+        if self.paper_trade != 0:
+            self.store.reset_position(idx)
+            self._checkpoint(idx)
+            return
+
+        state['status'][idx] = STATUS_EXITING
+        self._order_tags(idx, 'exit', self.store.users)
+        self._checkpoint(idx)  # before the entries are closed in the risk counters, their quantity is journaled
+        orders = self._square_off_orders(idx, cancel_kind='sl')
+        self.exits.start(idx, orders, wait_for_broker=wait_for_broker, tick_at=tick_at, signal_at=self._signal_at)
+
+    def _cancel_entry(self, idx: int):
+        """cancel the pending entry orders of the row (squaring off the users whose entry got filled meanwhile)"""
+        self.store.state['status'][idx] = STATUS_EXITING
+        self._order_tags(idx, 'exit', self.store.users)
+        self._checkpoint(idx)
+        orders = self._square_off_orders(idx, cancel_kind='entry')
+        self.exits.start(idx, orders, signal_at=self._signal_at, cancel_entry=True)
+
+    def _square_off_orders(self, idx: int, cancel_kind: str):
+        """
+        {user: (id of the order to cancel first, market order squaring off the entry)} of the users whose entry
+        was placed
+        """
+        info = self.store.info[idx]
+        orders = dict()
+        for each_user in self.store.users:
+            quantity = self.risk.close(each_user, info.key)
+            entry_order_id, _ = self.store.get_order('entry', idx, each_user)
+            if entry_order_id is None:  # entry not placed for the user, nothing to square off
+                continue
+            order = self.build_order(idx, transaction_type=calculations.reverse_txn_type(info.transaction_type),
+                                     order_type='MARKET', price=None)
+            order['quantity'] = quantity or int(order['quantity'] * self.users_df_dict[each_user]['No of Lots'])
+            order['tag'] = self.store.get_tag('exit', idx, each_user)
+            cancel_order_id, _ = self.store.get_order(cancel_kind, idx, each_user)
+            orders[each_user] = (cancel_order_id, order)
+        return orders
+
+    def square_off_all(self) -> SquareOffReport:
+        """
+        kill switch: stop taking entries, square off every open position and cancel every pending entry of all
+        the users at once (see `square_off`). The broker calls run in parallel on the exits, without waiting here.
+        """
+        self.entries_halted = True
+        state = self.store.state
+        report = self.square_off = SquareOffReport(self.exits.clock)
+        for idx in range(len(self.store)):
+            info = self.store.info[idx]
+            if state['status'][idx] == STATUS_IN_POSITION:
+                logger.info(f"Squaring off {info.tradingsymbol}")
+                report.add_row(idx)
+                self._exit_position(idx, state['ltp'][idx].item())
+                if self.paper_trade != 0:
+                    for each_user in self.store.users:
+                        report.add_record(info.key, info.tradingsymbol, each_user, ACTION_SQUARE_OFF)
+                    report.row_done(idx)
+            elif state['status'][idx] == STATUS_ENTRY_PLACED:
+                logger.info(f"Cancelling the Placed Order for {info.tradingsymbol}")
+                report.add_row(idx)
+                if self.paper_trade != 0:
+                    self.store.reset_position(idx)
+                    self._checkpoint(idx)
+                    for each_user in self.store.users:
+                        report.add_record(info.key, info.tradingsymbol, each_user, ACTION_CANCEL_ENTRY)
+                    report.row_done(idx)
+                else:
+                    self._cancel_entry(idx)
+        report.all_rows_added()
+        return report
+
+    def _exit_order_done(self, task: ExitTask):
+        """record the SL order status and the square off order of a user, once its exit is over"""
+        if task.cancel_entry:
+            self.store.set_order('entry', task.idx, task.user, order_status=task.sl_order_status)
+            self.store.set_order('sl', task.idx, task.user, order_id=task.exit_order_id)
+        else:
+            self.store.set_order('sl', task.idx, task.user, order_id=task.exit_order_id,
+                                 order_status=task.sl_order_status)
+        self.store.set_order('exit', task.idx, task.user, order_id=task.exit_order_id)
+        self._checkpoint(task.idx)
+        if self.square_off is not None and self.square_off.is_pending(task.idx):
+            info = self.store.info[task.idx]
+            self.square_off.add_record(info.key, info.tradingsymbol, task.user,
+                                       ACTION_CANCEL_ENTRY if task.cancel_entry else ACTION_SQUARE_OFF,
+                                       cancelled_order_id=task.sl_order_id,
+                                       cancelled_order_status=task.sl_order_status,
+                                       exit_order_id=task.exit_order_id, error=task.error)
+
+    def _exit_row_done(self, idx: int):
+        """the exits of all the users of the row are over"""
+        self.store.reset_position(idx)
+        self._checkpoint(idx)
+        if self.square_off is not None and self.square_off.is_pending(idx):
+            self.square_off.row_done(idx)
+
+    # ------------ restart ------------
+    def restore(self, checkpoint: Checkpoint) -> typing.List[int]:
+        """
+        rebuild the state of the rows from the checkpoint written before a restart of the algo (see
+        `state_journal`) and reconcile it with the order books of the users; the rows of the strategy table have
+        to be loaded first. A row with an open trade which is not in the strategy table any more (or trades another
+        instrument now) is added back retired: its trade is managed until closed, it takes no new entry.
+
+        :return: indices of the rows restored
+        """
+        started_at = time.monotonic()
+        for key, row in checkpoint.trades:
+            self.ledger.close(key, row)
+        restored = []
+        for key, row in checkpoint.rows.items():
+            idx = self._restore_row(key, row, checkpoint)
+            for (kind, each_user), order in checkpoint.orders.get(key, {}).items():
+                if each_user not in self.store.user_index:
+                    continue
+                self.store.set_order(kind, idx, each_user, order_id=order.order_id, order_status=order.order_status,
+                                     tag=order.tag)
+                if kind == 'entry' and order.quantity:
+                    self.risk.restore_entry(each_user, self.store.info[idx].key, row['tradingsymbol'], order.quantity,
+                                            order.price or 0.0)
+            restored.append(idx)
+        if self.paper_trade == 0 and restored:
+            self._reconcile_orders(restored)
+        for idx in restored:
+            self._resume(idx)
+            self._checkpoint(idx)
+        logger.info(f"Restored {len(restored)} rows and {len(checkpoint.trades)} closed trades in "
+                    f"{(time.monotonic() - started_at) * 1000:.0f} ms")
+        return restored
+
+    def _restore_row(self, key, row: typing.Dict[str, typing.Any], checkpoint: Checkpoint) -> int:
+        """
+        index of the row `key` of the checkpoint, with the trade details of the checkpoint. A row whose key is
+        taken by another row of the strategy table is added back under a negative key (see `_restored_key`).
+        """
+        store = self.store
+        side = 1 if str(row['transaction_type']).upper() == 'BUY' else -1
+        idx = store.index_of(key) if key in store else None
+        if idx is not None and (store.state['instrument_token'][idx] != row['instrument_token'] or
+                                store.state['side'][idx] != side or store.state['status'][idx] != STATUS_IDLE):
+            restored_key = self._restored_key(key, checkpoint)
+            logger.warning(f"Row {key} of the strategy table trades another instrument now, the open "
+                           f"{row['tradingsymbol']} trade of the row is restored as row {restored_key}")
+            self.journal.rename_row(key, restored_key)
+            key, idx = restored_key, None
+        elif idx is None:
+            logger.warning(f"Row {key} of the open {row['tradingsymbol']} trade is not in the strategy table, "
+                           f"its trade is managed until closed")
+        retired = idx is None
+        if retired:
+            idx = self.add_row(key, row)
+        record = store.state[idx]
+        record['status'] = row['status']
+        for field in ('entry_price', 'entry_time', 'exit_price', 'exit_time', 'target_price', 'sl_price'):
+            record[field] = np.nan if row.get(field) is None else row[field]
+        record['multiplier'] = row.get('multiplier') or 0
+        record['close_positions'] = row.get('close_positions') or 0
+        if retired:
+            store.retire_row(idx)
+        return idx
+
+    def _restored_key(self, key: int, checkpoint: Checkpoint) -> int:
+        """
+        key of a restored row whose key is taken: negative, so it is not a key of the strategy table (the UI closes
+        rows by their int key) and derived from `key`, so it is not the key of a row of another shard either
+        """
+        restored_key = -(int(key) + 1)
+        while restored_key in self.store or restored_key in checkpoint.rows:
+            restored_key -= RESTORED_KEY_STRIDE
+        return restored_key
+
+    def _reconcile_orders(self, indices: typing.List[int]):
+        """
+        state of the orders of the rows at `indices` from the order books of the users, downloaded once per user
+        and in parallel. An order sent but not acknowledged before the restart is found by its tag.
+        """
+        store = self.store
+
+        def reconcile(each_user):
+            broker = self.users_df_dict[each_user]['broker']
+            broker.refresh_orders(force=True)
+            orders = dict()
+            for idx in indices:
+                for kind in ORDER_KINDS:
+                    order_id, _ = store.get_order(kind, idx, each_user)
+                    tag = store.get_tag(kind, idx, each_user)
+                    order = None
+                    if tag is not None and hasattr(broker, 'find_tagged_order'):
+                        order = broker.find_tagged_order(tag)
+                    if order is None and order_id is not None:
+                        order = broker.get_cached_order(order_id)
+                        if order is None:
+                            logger.warning(f"{kind} order {order_id} of {each_user} for "
+                                           f"{store.info[idx].tradingsymbol} not found in the order book")
+                    if order is not None:
+                        orders[(idx, kind)] = order
+            return orders
+
+        users = [each_user for each_user in store.users if self.users_df_dict[each_user]['broker'] is not None]
+        for each_user, result in self.fanout.map(reconcile, users, self.broker_names).items():
+            if not result.ok:
+                logger.critical(f"Error in reconciling the orders of {self.users_df_dict[each_user]['Name']} "
+                                f"Error {result.error!r}", exc_info=result.error)
+                continue
+            for (idx, kind), order in result.value.items():
+                store.set_order(kind, idx, each_user, order_id=order.order_id, order_status=order.status)
+
+    def _resume(self, idx: int):
+        """carry on with the restored row at `idx` from its reconciled orders"""
+        store = self.store
+        state = store.state
+        info = store.info[idx]
+        status = state['status'][idx]
+        if self.paper_trade != 0:
+            if status == STATUS_IN_POSITION:
+                self.ledger.open(info.key, store.as_dict(idx))
+            elif status == STATUS_EXITING:
+                store.reset_position(idx)
+            return
+
+        entries = {each_user: store.get_order('entry', idx, each_user)[1] for each_user in store.users
+                   if store.get_order('entry', idx, each_user)[0] is not None}
+        if status == STATUS_ENTRY_PLACED:
+            if all(order_status in ('CANCELLED', 'REJECTED') for order_status in entries.values()):
+                logger.info(f"Entry of {info.tradingsymbol} not placed before the restart, taking a new entry")
+                for each_user in store.users:
+                    self.risk.close(each_user, info.key)
+                store.reset_position(idx)
+            elif 'COMPLETE' in entries.values():  # filled while the algo was down
+                self._entry_executed(idx)
+                if state['stoploss_type'][idx] != LEVEL_NONE:
+                    self._place_sl_orders(idx)
+        elif status == STATUS_IN_POSITION:
+            sl_status = [store.get_order('sl', idx, each_user) for each_user in entries]
+            if state['stoploss_type'][idx] != LEVEL_NONE and entries and \
+                    all(order_status == 'COMPLETE' for order_id, order_status in sl_status):
+                logger.info(f"Stoploss of {info.tradingsymbol} executed while the algo was down")
+                state['exit_time'][idx] = self.now()
+                state['exit_price'][idx] = state['sl_price'][idx]
+                row = store.as_dict(idx)
+                self.ledger.close(info.key, row)
+                self.journal.add_trade(info.key, row)
+                for each_user in store.users:
+                    self.risk.close(each_user, info.key)
+                store.reset_position(idx)
+                return
+            self.ledger.open(info.key, store.as_dict(idx))
+            if state['stoploss_type'][idx] != LEVEL_NONE and any(order_id is None for order_id, _ in sl_status):
+                self._place_sl_orders(idx)  # only for the users whose SL order was not placed
+        elif status == STATUS_EXITING:
+            # an exit is resumed where it stopped: users squared off already are left out, users whose SL
+            # order (position) / entry order (cancelled entry) is closed are squared off right away
+            position_exit = not np.isnan(state['exit_time'][idx])
+            cancel_kind = 'sl' if position_exit else 'entry'
+            exit_now = []
+            for each_user in entries:
+                order_id, order_status = store.get_order(cancel_kind, idx, each_user)
+                if (position_exit and order_status not in ('PENDING', 'COMPLETE')) or \
+                        (not position_exit and order_status == 'COMPLETE'):
+                    exit_now.append(each_user)
+            squared_off = [each_user for each_user in entries if store.get_order('exit', idx, each_user)[0] is not None]
+            orders = self._square_off_orders(idx, cancel_kind=cancel_kind)
+            for each_user in squared_off:
+                orders.pop(each_user, None)
+            logger.info(f"Resuming the exit of {info.tradingsymbol}")
+            self.exits.start(idx, orders, wait_for_broker=position_exit, cancel_entry=not position_exit,
+                             exit_now=exit_now)
+
+    def build_order(self, idx: int, transaction_type: str, order_type: str, price=None, trigger_price=None):
+        """order (kwargs of `All_Broker.place_order`) for a single lot of the row"""
+        info = self.store.info[idx]
+        return {'variety': 'regular',
+                'exchange': info.exchange,
+                'tradingsymbol': info.tradingsymbol,
+                'quantity': int(self.store.state['quantity'][idx]),
+                'product': info.product_type,
+                'transaction_type': transaction_type,
+                'order_type': order_type,
+                'price': price,
+                'validity': 'DAY',
+                'disclosed_quantity': None,
+                'trigger_price': trigger_price,
+                'squareoff': None,
+                'stoploss': None,
+                'trailing_stoploss': None,
+                'tag': None}
+
+    def _place_for_all_users(self, idx: int, kind: str, order: typing.Dict[str, typing.Any], action: str):
+        """
+        place `order` for every user (in parallel), scaled to the user's number of lots.
+        Entries go through the pre-trade risk checks (`risk`), the other orders follow the quantity of the entry.
+        Users who have an order of `kind` for the row already are skipped; the tags of the orders are journaled
+        before they are sent.
+        """
+
+        tick_at, signal_at = self._tick_at(idx), self._signal_at
+        key = self.store.info[idx].key
+        ltp = self.store.state['ltp'][idx].item()
+        lot_size = int(self.store.state['lot_size'][idx])
+        users = [each_user for each_user in self.store.users if self.store.get_order(kind, idx, each_user)[0] is None]
+        tags = self._order_tags(idx, kind, users)
+        self._checkpoint(idx)
+
+        def place(each_user):
+            new_order = dict(order)
+            new_order['tag'] = tags[each_user]
+            new_order['quantity'] = int(new_order['quantity'] * self.users_df_dict[each_user]['No of Lots'])
+            if kind == 'entry':
+                decision = self.risk.check_entry(each_user, key, new_order, ltp, lot_size)
+                if not decision.quantity:
+                    return None, f"Rejected by the risk checks: {decision.reason}"
+                new_order['quantity'] = decision.quantity
+            else:
+                if self.store.get_order('entry', idx, each_user)[0] is None:
+                    return None, "Entry not placed"
+                new_order['quantity'] = self.risk.quantity(each_user, key) or new_order['quantity']
+            order_id, message = self.latency.place_order(self.users_df_dict[each_user]['broker'], each_user,
+                                                         new_order, tick_at=tick_at, signal_at=signal_at)
+            if kind == 'entry' and order_id is None:
+                self.risk.close(each_user, key)
+            return order_id, message
+
+        for each_user, result in self.fanout.map(place, users, self.broker_names).items():
+            if not result.ok:
+                logger.critical(f"Error in {action} Placement for {self.users_df_dict[each_user]['Name']} "
+                                f"Error {result.error!r}", exc_info=result.error)
+                continue
+            order_id, message = result.value
+            if order_id is None:
+                logger.warning(f"{action} not placed for {self.users_df_dict[each_user]['Name']}: {message}")
+                continue
+            self.store.set_order(kind, idx, each_user, order_id=order_id)
+            logger.info(f"Order Placed for {each_user} Order_id {order_id}")
+        self._checkpoint(idx)
+
+    def _order_tags(self, idx: int, kind: str, users: typing.Iterable[str]) -> typing.Dict[str, typing.Optional[str]]:
+        """
+        tags of the orders of `kind` of the row for `users` (see `order_tags`): the tag given before if any (an
+        order journaled before a restart, which was not placed), else a new one. None for brokers without tags.
+        """
+        tags = dict()
+        for each_user in users:
+            tag = self.store.get_tag(kind, idx, each_user)
+            order_tags = getattr(self.users_df_dict[each_user]['broker'], 'order_tags', None)
+            if tag is None and order_tags is not None:
+                tag = order_tags.new_tag(self.store.info[idx].tradingsymbol)
+                self.store.set_order(kind, idx, each_user, tag=tag)
+            tags[each_user] = tag
+        return tags
+
+    def _checkpoint(self, idx: int):
+        """journal the state of the row (after every transition)"""
+        self.journal.save_row(self.store, idx, self.risk)
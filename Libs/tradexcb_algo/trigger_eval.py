@@ -0,0 +1,61 @@
+"""
+Batch evaluation of the Default strategy triggers.
+
+Every function takes rows of `instrument_state.ROW_STATE_DTYPE` (the whole store, or the rows picked
+for this pass) and returns one boolean mask over them, computed in a single NumPy pass.
+The prices are compared as `price * multiplier`, so that the same comparison works for BUY (+1)
+and SELL (-1) trades.
+"""
+import typing
+
+import numpy as np
+
+from .instrument_state import STATUS_IDLE, STATUS_ENTRY_PLACED, STATUS_IN_POSITION, LEVEL_NONE
+
+
+class ExitSignals(typing.NamedTuple):
+    target_hit: np.ndarray
+    sl_hit: np.ndarray
+    close_requested: np.ndarray
+
+    def any(self) -> np.ndarray:
+        return self.target_hit | self.sl_hit | self.close_requested
+
+
+def entry_signals(rows: np.ndarray) -> np.ndarray:
+    """rows which have to take an entry at the current ltp"""
+    return (rows['status'] == STATUS_IDLE) & rows['active'] & ~np.isnan(rows['ltp'])
+
+
+def entry_fills(rows: np.ndarray) -> np.ndarray:
+    """rows with an entry order placed, where the ltp has crossed the entry price"""
+    multiplier = rows['multiplier']
+    with np.errstate(invalid='ignore'):
+        return (rows['status'] == STATUS_ENTRY_PLACED) & (rows['ltp'] * multiplier <= rows['entry_price'] * multiplier)
+
+
+def entry_expiries(rows: np.ndarray, now: float) -> np.ndarray:
+    """rows with an entry order placed, which waited longer than their `wait_time` (minutes)"""
+    with np.errstate(invalid='ignore'):
+        return (rows['status'] == STATUS_ENTRY_PLACED) & (now > rows['entry_time'] + rows['wait_time'] * 60)
+
+
+def exit_signals(rows: np.ndarray) -> ExitSignals:
+    """
+    exits of the open positions, in order of priority: target, stoploss, close requested from the UI.
+    A row fires at most one of them.
+    """
+    in_position = rows['status'] == STATUS_IN_POSITION
+    multiplier = rows['multiplier']
+    ltp = rows['ltp'] * multiplier
+    with np.errstate(invalid='ignore'):
+        target_hit = in_position & (rows['target_type'] != LEVEL_NONE) & (ltp >= rows['target_price'] * multiplier)
+        sl_hit = in_position & ~target_hit & (ltp <= rows['sl_price'] * multiplier)
+    close_requested = in_position & ~target_hit & ~sl_hit & (rows['close_positions'] == 1)
+    return ExitSignals(target_hit, sl_hit, close_requested)
+
+
+def open_profit(rows: np.ndarray) -> np.ndarray:
+    """mark-to-market profit of the rows (NaN for rows without an open position)"""
+    return ((rows['ltp'] - rows['entry_price']) * rows['multiplier'] *
+            rows['quantity'] * rows['lot_size'])